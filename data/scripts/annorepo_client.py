@@ -0,0 +1,409 @@
+"""
+Upload the annotations of AnnotationPages to our AnnoRepo container in bulk.
+
+The annotations are sent to the annotations-batch endpoint in batches, over
+a pooled keep-alive session with a bounded number of concurrent requests.
+Every uploaded batch is appended to a progress file, with the AnnoRepo name
+and etag of each annotation, so an interrupted upload resumes where it
+stopped and annotations are never uploaded twice.
+
+A batch is only sent again right away when it certainly wasn't stored: on a
+connection error, a 429 or a 503 (with backoff, see http_utils). After a
+read timeout or another error, AnnoRepo may have stored it anyway, so the
+batch is marked as pending in the progress file. Before a pending batch is
+sent again, the container is searched for its annotations (by content hash),
+and those that are found are recorded instead of uploaded.
+
+The token is read from ANNO_REPO_TOKEN (or ANNO_REPO_TOKEN_JONA), the
+instance from ANNO_REPO_BASE_URL, so a local stand-in server can be used:
+
+    ANNO_REPO_BASE_URL=http://localhost:8080 python annorepo_client.py results/*.json
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from http_utils import make_session, TIMEOUT
+
+BASE_URL = "https://annorepo.globalise.huygens.knaw.nl"
+CONTAINER = "necessary-reunions"
+BATCH_SIZE = 500  # annotations per request
+MAX_WORKERS = 4  # concurrent requests
+PROGRESS_FILE = "data/.cache/annorepo/uploaded.jsonl"
+
+# Responses that mean a batch was not stored
+BATCH_RETRY_STATUS = (429, 503)
+
+W3C_CONTENT_TYPE = 'application/ld+json; profile="http://www.w3.org/ns/anno.jsonld"'
+
+# Set or rewritten by AnnoRepo, so not part of what we compare
+SERVER_KEYS = ("id", "via", "@context", "created", "modified")
+
+# Set on every run by the scripts that make the annotations (segment_icons.py
+# timestamps the target), so not part of what we compare either
+GENERATED_KEYS = ("created", "modified")
+
+
+def content_hash(annotation: dict) -> str:
+    """
+    Hash of what an annotation says, the same for the local and the stored
+    copy, and for the annotations of a page that was made again.
+    """
+
+    content = {k: v for k, v in annotation.items() if k not in SERVER_KEYS}
+    if isinstance(content.get("target"), dict):
+        content["target"] = {
+            k: v for k, v in content["target"].items() if k not in GENERATED_KEYS
+        }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def annotation_name(annotation: dict) -> str:
+    """The AnnoRepo name of a stored annotation: the last part of its id."""
+    return annotation["id"].rstrip("/").rsplit("/", 1)[-1]
+
+
+class AnnoRepoClient:
+    def __init__(
+        self,
+        base_url: str = None,
+        container: str = CONTAINER,
+        token: str = None,
+        max_workers: int = MAX_WORKERS,
+        session: requests.Session = None,
+    ):
+        self.base_url = (
+            base_url or os.environ.get("ANNO_REPO_BASE_URL") or BASE_URL
+        ).rstrip("/")
+        self.container = container
+        self.token = (
+            token
+            or os.environ.get("ANNO_REPO_TOKEN")
+            or os.environ.get("ANNO_REPO_TOKEN_JONA")
+        )
+        self.max_workers = max_workers
+
+        self.session = session or make_session(pool_size=max_workers)
+
+        # A batch is only retried when it was certainly not stored
+        self.batch_session = session or make_session(
+            pool_size=max_workers,
+            allowed_methods={"POST"},
+            status_forcelist=BATCH_RETRY_STATUS,
+            read_retries=0,
+        )
+
+    def headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    def upload_batch(self, annotations: list) -> list:
+        """
+        POST annotations to the annotations-batch endpoint. Returns the
+        {annotationName, containerName, etag} of each, in the same order.
+        """
+
+        r = self.batch_session.post(
+            f"{self.base_url}/services/{self.container}/annotations-batch",
+            headers=self.headers(),
+            data=json.dumps(annotations),
+            timeout=TIMEOUT,
+        )
+        r.raise_for_status()
+
+        return r.json()
+
+    def w3c_url(self, name: str = "") -> str:
+        return f"{self.base_url}/w3c/{self.container}/{name}"
+
+    def w3c_headers(self, etag: str = None) -> dict:
+        headers = {"Content-Type": W3C_CONTENT_TYPE, "Accept": W3C_CONTENT_TYPE}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if etag:
+            headers["If-Match"] = etag
+        return headers
+
+    def list_annotations(self):
+        """Every annotation in the container, page by page."""
+
+        url = self.w3c_url() + "?page=0"
+        while url:
+            r = self.session.get(url, headers=self.w3c_headers(), timeout=TIMEOUT)
+            r.raise_for_status()
+            page = r.json()
+
+            # The container itself embeds its first page
+            if "first" in page and isinstance(page["first"], dict):
+                page = page["first"]
+
+            yield from page.get("items", [])
+            url = page.get("next")
+
+    def get_etag(self, name: str) -> str:
+        r = self.session.get(
+            self.w3c_url(name), headers=self.w3c_headers(), timeout=TIMEOUT
+        )
+        r.raise_for_status()
+        return r.headers.get("ETag")
+
+    def update_annotation(self, name: str, annotation: dict, etag: str) -> str:
+        """
+        Replace a stored annotation, if it still has `etag`. Returns the new
+        etag; a requests.HTTPError with status 412 means it was changed since.
+        """
+
+        r = self.session.put(
+            self.w3c_url(name),
+            headers=self.w3c_headers(etag),
+            data=json.dumps(annotation),
+            timeout=TIMEOUT,
+        )
+        r.raise_for_status()
+        return r.headers.get("ETag")
+
+    def delete_annotation(self, name: str, etag: str):
+        """Delete a stored annotation, if it still has `etag` (see update_annotation)."""
+
+        r = self.session.delete(
+            self.w3c_url(name), headers=self.w3c_headers(etag), timeout=TIMEOUT
+        )
+        r.raise_for_status()
+
+    def recover(self, annotations: list, progress, key: str = "") -> int:
+        """
+        Record the pending annotations (of failed batches) that AnnoRepo
+        stored anyway, found by content hash among the stored annotations no
+        record knows about. Returns how many were found.
+        """
+
+        known = {record["annotationName"] for record in progress.records()}
+        stored = {}  # content hash -> names
+        for annotation in self.list_annotations():
+            name = annotation_name(annotation)
+            if name not in known:
+                stored.setdefault(content_hash(annotation), []).append(name)
+
+        recovered = 0
+        for annotation in annotations:
+            if not progress.is_pending(key, annotation["id"]):
+                continue
+            names = stored.get(content_hash(annotation))
+            if names:
+                name = names.pop(0)
+                progress.set(key, annotation, name, self.get_etag(name))
+                recovered += 1
+
+        return recovered
+
+    def upload(
+        self,
+        annotations: list,
+        batch_size: int = BATCH_SIZE,
+        progress=None,
+        key: str = "",
+    ) -> int:
+        """
+        Upload the annotations that are not in `progress` yet, in concurrent
+        batches. `key` tells the annotations of this page apart from those of
+        other pages in the progress file. Returns the number of failed batches.
+        """
+
+        todo = [
+            a
+            for a in annotations
+            if progress is None or not progress.done(key, a["id"])
+        ]
+
+        # Failed batches may have been stored after all
+        if progress is not None and any(
+            progress.is_pending(key, a["id"]) for a in todo
+        ):
+            try:
+                recovered = self.recover(todo, progress, key)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Could not check the pending annotations of {key}: {e}")
+                return 1
+            if recovered:
+                print(f"{key}: {recovered} pending annotations were stored already")
+            todo = [a for a in todo if not progress.done(key, a["id"])]
+
+        batches = [todo[i : i + batch_size] for i in range(0, len(todo), batch_size)]
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.upload_batch, batch): batch for batch in batches
+            }
+
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    results = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    print(f"Failed to upload a batch of {len(batch)} annotations: {e}")
+                    failed += 1
+                    if progress is not None:
+                        progress.add_pending(key, batch)
+                    continue
+
+                if progress is not None:
+                    progress.add(key, batch, results)
+
+        return failed
+
+
+class UploadProgress:
+    """
+    Append-only JSON lines file of uploaded annotations: the page they came
+    from, their id, the name and etag AnnoRepo gave them and the hash of their
+    content. The last line about an annotation wins; a "deleted" line means
+    it is no longer stored, a "pending" line that it was in a failed batch and
+    may or may not be stored. annorepo_sync.py uses this as its local state.
+    """
+
+    def __init__(self, path: str = PROGRESS_FILE):
+        self.path = path
+        self.uploaded = {}  # (key, annotation id) -> record
+        self.pending = set()  # (key, annotation id)
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # half a line from an interrupted run
+                        continue
+                    self._apply(record)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a")
+
+    def _apply(self, record: dict):
+        annotation = (record["key"], record["id"])
+        self.pending.discard(annotation)
+
+        if record.get("deleted"):
+            self.uploaded.pop(annotation, None)
+        elif record.get("pending"):
+            self.pending.add(annotation)
+        else:
+            self.uploaded[annotation] = record
+
+    def done(self, key: str, annotation_id: str) -> bool:
+        return (key, annotation_id) in self.uploaded
+
+    def is_pending(self, key: str, annotation_id: str) -> bool:
+        return (key, annotation_id) in self.pending
+
+    def get(self, key: str, annotation_id: str) -> dict:
+        return self.uploaded.get((key, annotation_id))
+
+    def records(self, key: str = None) -> list:
+        return [r for (k, _), r in self.uploaded.items() if key is None or k == key]
+
+    def _write(self, record: dict):
+        self._apply(record)
+        self._file.write(json.dumps(record) + "\n")
+
+    def set(self, key: str, annotation: dict, name: str, etag: str):
+        self._write(
+            {
+                "key": key,
+                "id": annotation["id"],
+                "annotationName": name,
+                "etag": etag,
+                "hash": content_hash(annotation),
+            }
+        )
+        self._file.flush()
+
+    def forget(self, key: str, annotation_id: str):
+        self._write({"key": key, "id": annotation_id, "deleted": True})
+        self._file.flush()
+
+    def add_pending(self, key: str, annotations: list):
+        for annotation in annotations:
+            self._write({"key": key, "id": annotation["id"], "pending": True})
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, key: str, annotations: list, results: list):
+        for annotation, result in zip(annotations, results):
+            self._write(
+                {
+                    "key": key,
+                    "id": annotation["id"],
+                    "annotationName": result.get("annotationName"),
+                    "etag": result.get("etag"),
+                    "hash": content_hash(annotation),
+                }
+            )
+
+        # A batch is only done once it is on disk
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def main(
+    annotation_page_paths: list,
+    client: AnnoRepoClient,
+    batch_size: int = BATCH_SIZE,
+    progress_path: str = PROGRESS_FILE,
+) -> int:
+
+    progress = UploadProgress(progress_path)
+
+    failed = 0
+    try:
+        for path in annotation_page_paths:
+            with open(path) as f:
+                annotations = json.load(f)["items"]
+
+            key = os.path.splitext(os.path.basename(path))[0]
+            n_failed = client.upload(
+                annotations, batch_size=batch_size, progress=progress, key=key
+            )
+
+            uploaded = sum(progress.done(key, a["id"]) for a in annotations)
+            print(f"{key}: {uploaded} of {len(annotations)} annotations uploaded")
+            failed += n_failed
+    finally:
+        progress.close()
+
+    if failed:
+        print(f"{failed} batches failed, run again to retry them")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("annotation_pages", nargs="+", metavar="PAGE")
+    parser.add_argument("--container", default=CONTAINER)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--progress", default=PROGRESS_FILE)
+    args = parser.parse_args()
+
+    client = AnnoRepoClient(container=args.container, max_workers=args.max_workers)
+
+    parser.exit(main(args.annotation_pages, client, args.batch_size, args.progress))
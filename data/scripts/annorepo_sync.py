@@ -0,0 +1,357 @@
+"""
+Bring our AnnoRepo container in line with local AnnotationPages, sending
+only what changed.
+
+The annotations of each page are compared by id with the progress file of
+annorepo_client.py, which knows the AnnoRepo name, etag and content hash of
+everything uploaded. spot_text.py and segment_icons.py give every annotation
+a new id each time they run, so annotations whose id was never uploaded are
+paired with uploaded annotations that are no longer on the page: by content
+hash, then by target (a polygon whose text changed is an update). A page
+that was made again without changes gives an empty diff. The hash of the local annotation tells whether it
+changed here since, the hash of the stored one whether it was edited in
+AnnoRepo (e.g. in the viewer):
+
+- create: local annotations that were never uploaded, or that are gone
+  from the container, go through the annotations-batch endpoint
+- update: annotations that changed here only are replaced with a PUT
+- delete: uploaded annotations that are no longer on the local page, and
+  were not edited in AnnoRepo, are deleted
+- conflict: annotations that changed (or are gone) here and were edited in
+  AnnoRepo too; they are reported, and only sent with --force
+
+Annotations that were only edited in AnnoRepo are left as they are. Updates
+and deletes send the known etag as If-Match, so an edit made after the
+container was listed is a conflict too. The size of the diff is printed
+before anything is sent; --dry-run stops there.
+
+    python annorepo_sync.py data/scripts/textspotting/results/*.json --dry-run
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from annorepo_client import (
+    AnnoRepoClient,
+    UploadProgress,
+    content_hash,
+    annotation_name,
+    BATCH_SIZE,
+    MAX_WORKERS,
+    PROGRESS_FILE,
+    CONTAINER,
+)
+
+
+def target_hash(annotation: dict) -> str:
+    """Hash of where an annotation is: its target, without the run's timestamps."""
+    return content_hash({"target": annotation.get("target")})
+
+
+def pair_by_hash(
+    annotations: list, records: dict, annotation_hash, record_hashes: dict
+) -> tuple:
+    """
+    Pair annotations with the records ({id: record}) of uploaded annotations
+    that have their hash: annotation_hash(annotation) is one of
+    record_hashes[id]. Paired records are taken out of `records`. Returns the
+    (annotation, record) pairs and the annotations that are left.
+    """
+
+    by_hash = {}
+    for annotation_id, hashes in record_hashes.items():
+        for h in hashes:
+            by_hash.setdefault(h, []).append(annotation_id)
+
+    pairs, left = [], []
+    for annotation in annotations:
+        ids = [i for i in by_hash.get(annotation_hash(annotation), []) if i in records]
+        if ids:
+            pairs.append((annotation, records.pop(ids[0])))
+        else:
+            left.append(annotation)
+
+    return pairs, left
+
+
+def plan_sync(pages: dict, progress: UploadProgress, remote: dict) -> dict:
+    """
+    What to send for `pages` ({key: annotations}), given what was uploaded
+    (`progress`) and what the container holds (`remote`, {name: annotation}).
+    Conflicts are ("update", key, annotation, record) or ("delete", key,
+    None, record). Rekeys are (key, annotation, record) of annotations that
+    were paired with an upload of another id.
+    """
+
+    plan = {
+        "create": [],
+        "update": [],
+        "delete": [],
+        "conflict": [],
+        "rekey": [],
+        "unchanged": 0,
+        "edited": 0,
+    }
+
+    def edited(record):
+        """Whether the stored annotation differs from what we uploaded."""
+        name = record["annotationName"]
+        return name in remote and content_hash(remote[name]) != record.get("hash")
+
+    def compare(key, annotation, record):
+        local_hash = content_hash(annotation)
+        if local_hash == content_hash(remote[record["annotationName"]]):
+            plan["unchanged"] += 1
+        elif local_hash == record.get("hash"):
+            # Only edited in AnnoRepo: keep that edit
+            plan["edited"] += 1
+        elif edited(record):
+            plan["conflict"].append(("update", key, annotation, record))
+        else:
+            plan["update"].append((key, annotation, record))
+
+    for key, annotations in pages.items():
+        records = {record["id"]: record for record in progress.records(key)}
+
+        unmatched = []
+        for annotation in annotations:
+            record = records.pop(annotation["id"], None)
+            if record is None:
+                unmatched.append(annotation)
+            elif record["annotationName"] not in remote:
+                plan["create"].append((key, annotation))
+            else:
+                compare(key, annotation, record)
+
+        # The scripts give every annotation a new id each time they run, so
+        # the annotations of a page that was made again are paired with the
+        # uploaded ones by content (what was uploaded, or what is stored
+        # now), and what is left by target, e.g. a polygon with a new text
+        stored = {
+            annotation_id: remote[record["annotationName"]]
+            for annotation_id, record in records.items()
+            if record["annotationName"] in remote
+        }
+        by_content = {
+            annotation_id: {content_hash(annotation), records[annotation_id]["hash"]}
+            for annotation_id, annotation in stored.items()
+        }
+        by_target = {
+            annotation_id: {target_hash(annotation)}
+            for annotation_id, annotation in stored.items()
+        }
+
+        for annotation_hash, record_hashes in (
+            (content_hash, by_content),
+            (target_hash, by_target),
+        ):
+            pairs, unmatched = pair_by_hash(
+                unmatched, records, annotation_hash, record_hashes
+            )
+            for annotation, record in pairs:
+                plan["rekey"].append((key, annotation, record))
+                compare(key, annotation, record)
+
+        plan["create"].extend((key, annotation) for annotation in unmatched)
+
+        for record in records.values():
+            if edited(record):
+                plan["conflict"].append(("delete", key, None, record))
+            else:
+                plan["delete"].append((key, record))
+
+    # Stored annotations that no page of ours knows about, left alone
+    known = {record["annotationName"] for record in progress.records()}
+    plan["untracked"] = [name for name in remote if name not in known]
+
+    return plan
+
+
+def apply_sync(
+    client: AnnoRepoClient,
+    plan: dict,
+    progress: UploadProgress,
+    batch_size: int = BATCH_SIZE,
+    force: bool = False,
+) -> dict:
+    """Send the plan. Returns the number of conflicts and failures per kind."""
+
+    counts = {"conflicts": 0, "failed": 0}
+
+    def send(change):
+        kind, key, annotation, record = change
+        name, etag = record["annotationName"], record["etag"]
+
+        for attempt in (1, 2):
+            try:
+                if kind == "update":
+                    return client.update_annotation(name, annotation, etag)
+                client.delete_annotation(name, etag)
+                return None
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code == 404 and kind == "delete":
+                    return None  # already gone
+                if e.response.status_code != 412 or not force or attempt == 2:
+                    raise
+                etag = client.get_etag(name)
+
+    # Annotations that were paired by content are recorded under their new id
+    for key, annotation, record in plan["rekey"]:
+        progress.forget(key, record["id"])
+        progress.set(key, annotation, record["annotationName"], record["etag"])
+
+    changes = [("update", key, a, r) for key, a, r in plan["update"]] + [
+        ("delete", key, None, r) for key, r in plan["delete"]
+    ]
+
+    if force:
+        changes += plan["conflict"]
+    else:
+        for kind, key, annotation, record in plan["conflict"]:
+            print(f"Conflict: {record['annotationName']} was changed in AnnoRepo")
+        counts["conflicts"] += len(plan["conflict"])
+
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+        for change, future in [(c, executor.submit(send, c)) for c in changes]:
+            kind, key, annotation, record = change
+            try:
+                etag = future.result()
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code == 412:
+                    print(
+                        f"Conflict: {record['annotationName']} was changed in AnnoRepo"
+                    )
+                    counts["conflicts"] += 1
+                else:
+                    print(f"Failed to {kind} {record['annotationName']}: {e}")
+                    counts["failed"] += 1
+                continue
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to {kind} {record['annotationName']}: {e}")
+                counts["failed"] += 1
+                continue
+
+            if kind == "update":
+                progress.set(key, annotation, record["annotationName"], etag)
+            else:
+                progress.forget(key, record["id"])
+
+    # Creates go in batches, per page
+    creates = {}
+    for key, annotation in plan["create"]:
+        # A stale record (the annotation is gone from AnnoRepo) would skip it
+        if progress.done(key, annotation["id"]):
+            progress.forget(key, annotation["id"])
+        creates.setdefault(key, []).append(annotation)
+
+    for key, annotations in creates.items():
+        failed_batches = client.upload(
+            annotations, batch_size=batch_size, progress=progress, key=key
+        )
+        counts["failed"] += failed_batches
+
+    return counts
+
+
+def print_plan(plan: dict):
+    print(
+        f"{len(plan['create'])} to create, {len(plan['update'])} to update, "
+        f"{len(plan['delete'])} to delete, {len(plan['conflict'])} conflicts, "
+        f"{plan['unchanged']} unchanged, {plan['edited']} only edited in AnnoRepo"
+    )
+    if plan["rekey"]:
+        print(f"{len(plan['rekey'])} annotations were paired by content (new ids)")
+
+    per_page = {}
+    for kind in ("create", "update", "delete"):
+        for change in plan[kind]:
+            per_page.setdefault(change[0], {}).setdefault(kind, 0)
+            per_page[change[0]][kind] += 1
+    for change in plan["conflict"]:
+        per_page.setdefault(change[1], {}).setdefault("conflict", 0)
+        per_page[change[1]]["conflict"] += 1
+    for key, counts in sorted(per_page.items()):
+        print(
+            f"  {key}: "
+            + ", ".join(f"{n} {kind}" for kind, n in sorted(counts.items()))
+        )
+
+    if plan["untracked"]:
+        print(
+            f"{len(plan['untracked'])} annotations in AnnoRepo are not from these "
+            "uploads and are left alone"
+        )
+
+
+def main(
+    annotation_page_paths: list,
+    client: AnnoRepoClient,
+    batch_size: int = BATCH_SIZE,
+    progress_path: str = PROGRESS_FILE,
+    dry_run: bool = False,
+    force: bool = False,
+) -> int:
+
+    pages = {}
+    for path in annotation_page_paths:
+        with open(path) as f:
+            pages[os.path.splitext(os.path.basename(path))[0]] = json.load(f)["items"]
+
+    progress = UploadProgress(progress_path)
+    try:
+        remote = {annotation_name(a): a for a in client.list_annotations()}
+
+        plan = plan_sync(pages, progress, remote)
+        print_plan(plan)
+
+        if dry_run:
+            return 0
+
+        counts = apply_sync(client, plan, progress, batch_size, force=force)
+    finally:
+        progress.close()
+
+    if counts["conflicts"]:
+        print(f"{counts['conflicts']} conflicts, use --force to overwrite them")
+    if counts["failed"]:
+        print(f"{counts['failed']} changes failed, run again to retry them")
+
+    return 1 if counts["conflicts"] or counts["failed"] else 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("annotation_pages", nargs="+", metavar="PAGE")
+    parser.add_argument("--container", default=CONTAINER)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--progress", default=PROGRESS_FILE)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only print what would be sent"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Overwrite and delete annotations that were changed in AnnoRepo",
+    )
+    args = parser.parse_args()
+
+    client = AnnoRepoClient(container=args.container, max_workers=args.max_workers)
+
+    parser.exit(
+        main(
+            args.annotation_pages,
+            client,
+            args.batch_size,
+            args.progress,
+            dry_run=args.dry_run,
+            force=args.force,
+        )
+    )
@@ -0,0 +1,314 @@
+"""
+Columnar store of the generated annotations.
+
+The AnnotationPages of segment_icons, spot_text and integrate_htr_results
+are imported into one Parquet file with a row per annotation:
+
+    page        the page it came from (its path, without .json)
+    id          annotation id
+    canvas      target source
+    motivation
+    bbox        {xmin, ymin, xmax, ymax} of the polygon
+    polygon     the SvgSelector polygon as x0, y0, x1, y1, ...
+    text        the last TextualBody (the HTR result, if there is one)
+    generator   of that body, or of the target
+    annotation  the original W3C JSON, only read for the export
+
+Rows are sorted by canvas. Per canvas, an R-tree (shapely's STRtree) over
+the bboxes is built the first time the canvas is queried, so bbox queries
+over the whole corpus take milliseconds, and so do text queries, which run
+vectorized over the text column. export writes the AnnotationPages back,
+with the rest of every page (its @context, type, id and so on) as imported:
+it is kept as JSON in the "pages" key of the Parquet schema metadata.
+
+    python annotation_store.py import segmentation/annotations/*.json textspotting/results/*.json
+    python annotation_store.py bbox 1000 500 2000 1500 --canvas <canvas id>
+    python annotation_store.py text cochin
+    python annotation_store.py export exported/
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
+
+STORE = "data/.cache/annotations.parquet"
+
+BBOX = pa.struct(
+    [
+        ("xmin", pa.int32()),
+        ("ymin", pa.int32()),
+        ("xmax", pa.int32()),
+        ("ymax", pa.int32()),
+    ]
+)
+
+SCHEMA = pa.schema(
+    [
+        ("page", pa.string()),
+        ("id", pa.string()),
+        ("canvas", pa.string()),
+        ("motivation", pa.string()),
+        ("bbox", BBOX),
+        ("polygon", pa.list_(pa.int32())),
+        ("text", pa.string()),
+        ("generator", pa.string()),
+        ("annotation", pa.string()),
+    ]
+)
+QUERY_COLUMNS = [name for name in SCHEMA.names if name != "annotation"]
+
+PAGE_CONTEXT = "http://iiif.io/api/presentation/3/context.json"
+
+POINTS = re.compile(r'points="([^"]*)"')
+
+
+def get_id(value) -> str:
+    """The id of a value that is either a URI or an object with an id."""
+    return value.get("id") if isinstance(value, dict) else value
+
+
+def parse_annotation(annotation: dict, page: str) -> dict:
+    """The row of one W3C annotation."""
+
+    target = annotation.get("target", {})
+    if isinstance(target, list):
+        target = target[0] if target else {}
+    if isinstance(target, str):
+        target = {"source": target}
+
+    polygon, bbox = [], None
+    match = POINTS.search((target.get("selector") or {}).get("value", ""))
+    if match:
+        coordinates = re.split(r"[\s,]+", match.group(1).strip())
+        if len(coordinates) >= 2:
+            polygon = [int(round(float(c))) for c in coordinates]
+            xs, ys = polygon[0::2], polygon[1::2]
+            bbox = {"xmin": min(xs), "ymin": min(ys), "xmax": max(xs), "ymax": max(ys)}
+
+    body = annotation.get("body", [])
+    bodies = body if isinstance(body, list) else [body]
+    texts = [
+        b for b in bodies if isinstance(b, dict) and b.get("type") == "TextualBody"
+    ]
+    text_body = texts[-1] if texts else {}
+
+    return {
+        "page": page,
+        "id": annotation.get("id"),
+        "canvas": get_id(target.get("source")) or "",
+        "motivation": annotation.get("motivation"),
+        "bbox": bbox,
+        "polygon": polygon,
+        "text": text_body.get("value"),
+        "generator": get_id(text_body.get("generator") or target.get("generator")),
+        "annotation": json.dumps(annotation, ensure_ascii=False),
+    }
+
+
+def import_pages(annotation_page_paths: list) -> pa.Table:
+    """
+    One table of all annotations of the pages, sorted by canvas. Pages are
+    named by their path relative to the common folder of all pages; their
+    headers (the pages with empty items) go into the schema metadata.
+    """
+
+    paths = [os.path.abspath(path) for path in annotation_page_paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+
+    rows, headers = [], {}
+    for path in paths:
+        page = os.path.splitext(os.path.relpath(path, root))[0]
+        with open(path) as f:
+            annotation_page = json.load(f)
+        for annotation in annotation_page.get("items", []):
+            rows.append(parse_annotation(annotation, page))
+        headers[page] = {**annotation_page, "items": []}
+
+    table = pa.Table.from_pylist(rows, schema=SCHEMA)
+
+    # Stable, so every page keeps the order of its annotations
+    table = table.sort_by([("canvas", "ascending")])
+    return table.replace_schema_metadata(
+        {"pages": json.dumps(headers, ensure_ascii=False)}
+    )
+
+
+class AnnotationStore:
+    def __init__(self, table: pa.Table):
+        self.table = table
+        self._trees = {}  # canvas -> STRtree over the bboxes of its rows
+
+        # The rows of a canvas are one slice of the table
+        self._ranges = {}
+        offset = 0
+        for count in pc.value_counts(table["canvas"]).to_pylist():
+            self._ranges[count["values"]] = (offset, count["counts"])
+            offset += count["counts"]
+
+    @classmethod
+    def from_pages(cls, annotation_page_paths: list) -> "AnnotationStore":
+        return cls(import_pages(annotation_page_paths))
+
+    @classmethod
+    def load(cls, path: str = STORE, with_annotations: bool = False):
+        """Open a store; the original JSON is only read when asked for."""
+
+        columns = SCHEMA.names if with_annotations else QUERY_COLUMNS
+        return cls(pq.read_table(path, columns=columns, memory_map=True))
+
+    def save(self, path: str = STORE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        pq.write_table(self.table, path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def canvases(self) -> list:
+        return list(self._ranges)
+
+    def rows(self, canvas: str) -> pa.Table:
+        offset, length = self._ranges.get(canvas, (0, 0))
+        return self.table.slice(offset, length)
+
+    def _tree(self, canvas: str) -> shapely.STRtree:
+        if canvas not in self._trees:
+            bbox = self.rows(canvas)["bbox"].combine_chunks()
+            # Annotations without a polygon get no box, so they never match
+            boxes = shapely.box(
+                *[
+                    pc.fill_null(bbox.field(name), 0).to_numpy(zero_copy_only=False)
+                    for name in ("xmin", "ymin", "xmax", "ymax")
+                ]
+            )
+            boxes[~bbox.is_valid().to_numpy(zero_copy_only=False)] = None
+            self._trees[canvas] = shapely.STRtree(boxes)
+        return self._trees[canvas]
+
+    def query_bbox(self, xmin, ymin, xmax, ymax, canvas: str = None) -> pa.Table:
+        """Annotations whose bbox intersects the box, on one or all canvases."""
+
+        box = shapely.box(xmin, ymin, xmax, ymax)
+
+        results = []
+        for c in [canvas] if canvas is not None else self.canvases():
+            indices = np.sort(self._tree(c).query(box))
+            if len(indices):
+                results.append(self.rows(c).take(indices))
+
+        return pa.concat_tables(results) if results else self.table.slice(0, 0)
+
+    def search_text(
+        self,
+        pattern: str,
+        regex: bool = False,
+        ignore_case: bool = True,
+        canvas: str = None,
+    ) -> pa.Table:
+        """Annotations whose text contains `pattern` (or matches it, as a regex)."""
+
+        table = self.table if canvas is None else self.rows(canvas)
+        match = pc.match_substring_regex if regex else pc.match_substring
+        mask = match(table["text"], pattern, ignore_case=ignore_case)
+        return table.filter(pc.fill_null(mask, False))
+
+    def to_pages(self) -> dict:
+        """The W3C AnnotationPages, by page name (needs with_annotations)."""
+
+        if "annotation" not in self.table.column_names:
+            raise ValueError("Load the store with with_annotations=True to export it")
+
+        pages = {}
+        for page, annotation in zip(
+            self.table["page"].to_pylist(), self.table["annotation"].to_pylist()
+        ):
+            pages.setdefault(page, []).append(json.loads(annotation))
+
+        # Stores imported before the headers were kept get the default one
+        headers = json.loads((self.table.schema.metadata or {}).get(b"pages", "{}"))
+        for page in pages:
+            headers.setdefault(
+                page, {"@context": PAGE_CONTEXT, "type": "AnnotationPage", "items": []}
+            )
+
+        return {
+            page: {**header, "items": pages.get(page, [])}
+            for page, header in headers.items()
+        }
+
+    def export(self, folder: str):
+        for page, annotation_page in self.to_pages().items():
+            path = os.path.join(folder, page + ".json")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(annotation_page, f, indent=2, ensure_ascii=False)
+
+
+def print_rows(table: pa.Table, seconds: float, limit: int = 20):
+    print(f"{table.num_rows} annotations ({seconds * 1000:.1f} ms)")
+    for row in table.select(["page", "id", "bbox", "text"]).slice(0, limit).to_pylist():
+        bbox = row["bbox"] or {}
+        print(
+            f"  {row['page']} {row['id']} "
+            f"[{bbox.get('xmin')}, {bbox.get('ymin')}, {bbox.get('xmax')}, {bbox.get('ymax')}] "
+            f"{row['text'] or ''}"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--store", default=STORE)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="Import AnnotationPages")
+    import_parser.add_argument("annotation_pages", nargs="+", metavar="PAGE")
+
+    export_parser = commands.add_parser("export", help="Write the AnnotationPages")
+    export_parser.add_argument("folder")
+
+    bbox_parser = commands.add_parser("bbox", help="Annotations in a box")
+    for name in ("xmin", "ymin", "xmax", "ymax"):
+        bbox_parser.add_argument(name, type=int)
+    bbox_parser.add_argument("--canvas")
+
+    text_parser = commands.add_parser("text", help="Annotations with a text")
+    text_parser.add_argument("pattern")
+    text_parser.add_argument("--regex", action="store_true")
+    text_parser.add_argument("--canvas")
+
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = AnnotationStore.from_pages(args.annotation_pages)
+        store.save(args.store)
+        print(
+            f"Imported {len(store)} annotations on {len(store.canvases())} canvases "
+            f"into {args.store}"
+        )
+
+    elif args.command == "export":
+        AnnotationStore.load(args.store, with_annotations=True).export(args.folder)
+
+    else:
+        store = AnnotationStore.load(args.store)
+        start = time.perf_counter()
+        if args.command == "bbox":
+            result = store.query_bbox(
+                args.xmin, args.ymin, args.xmax, args.ymax, canvas=args.canvas
+            )
+        else:
+            result = store.search_text(
+                args.pattern, regex=args.regex, canvas=args.canvas
+            )
+        print_rows(result, time.perf_counter() - start)
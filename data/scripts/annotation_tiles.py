@@ -0,0 +1,357 @@
+"""
+Split the annotations of every canvas into spatial tiles at several zoom
+levels, so a viewer only fetches the shards that cover its viewport instead
+of whole AnnotationPages.
+
+Level 1 is full resolution, every next level covers twice as many canvas
+pixels per screen pixel (1, 2, 4, ...), up to the level where one tile
+covers the whole canvas (like the image tiles of IIIF and pyramid.py). A
+tile of level `s` covers tile_size * s canvas pixels. At level 1 a shard
+holds the annotations as they are (without their own @context). At coarser levels:
+
+- polygons are simplified to a tolerance of one screen pixel
+- annotations smaller than MIN_SIZE screen pixels are not drawn at that
+  zoom; they are aggregated into clusters of a CLUSTER_SIZE grid, with
+  their count and bbox
+
+An annotation goes into every tile its bbox overlaps, so a client collects
+the shards of its viewport and drops duplicates by id. The output folder:
+
+    index.json                  tile size and, per canvas, its size and the
+                                byte size of every non-empty shard
+    <canvas key>/<s>/<x>_<y>.json  an AnnotationPage (+ "clusters")
+
+The canvas key is a short hash of the canvas id. Canvas sizes are read from
+the manifest; canvases that are not in it get the extent of their
+annotations. --report prints the shard sizes and how many shards (and bytes)
+a viewport needs at every level:
+
+    python annotation_tiles.py tiles/ segmentation/annotations/*.json textspotting/results/*.json --report
+
+Needs ijson (pip install ijson) to read the manifest.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import argparse
+import statistics
+
+import ijson
+import numpy as np
+import shapely
+
+from annotation_store import parse_annotation
+
+TILE_SIZE = 1024  # screen pixels
+MIN_SIZE = 8  # screen pixels, smaller annotations are clustered
+CLUSTER_SIZE = 64  # screen pixels
+TOLERANCE = 1.0  # screen pixels
+VIEWPORT = (1920, 1080)
+
+PAGE_CONTEXT = "http://iiif.io/api/presentation/3/context.json"
+
+POINTS = re.compile(r'points="[^"]*"')
+
+
+def get_canvas_sizes(manifest_path: str) -> dict:
+    """Map the id of every canvas in the manifest to its (width, height)."""
+
+    sizes = {}
+    with open(manifest_path, "rb") as f:
+        for canvas in ijson.items(f, "items.item", use_float=True):
+            sizes[canvas["id"]] = (int(canvas["width"]), int(canvas["height"]))
+    return sizes
+
+
+def canvas_key(canvas: str) -> str:
+    return hashlib.sha1(canvas.encode()).hexdigest()[:16]
+
+
+def get_scale_factors(width: int, height: int, tile_size: int = TILE_SIZE) -> list:
+    scale_factors = [1]
+    while tile_size * scale_factors[-1] < max(width, height):
+        scale_factors.append(scale_factors[-1] * 2)
+    return scale_factors
+
+
+def get_polygons(rows: list) -> np.ndarray:
+    """Shapely polygons of the rows, None for those without (three) points."""
+
+    polygons = np.full(len(rows), None, dtype=object)
+    valid = [i for i, row in enumerate(rows) if len(row["polygon"]) >= 6]
+    if valid:
+        coordinates = [np.reshape(rows[i]["polygon"], (-1, 2)) for i in valid]
+        indices = np.repeat(np.arange(len(valid)), [len(c) for c in coordinates])
+        rings = shapely.linearrings(np.concatenate(coordinates), indices=indices)
+        polygons[valid] = shapely.polygons(rings)
+    return polygons
+
+
+def get_points(polygons: np.ndarray, tolerance: float) -> list:
+    """The SVG points of the polygons, simplified to `tolerance` (or None)."""
+
+    simplified = shapely.simplify(polygons, tolerance, preserve_topology=False)
+    rings = shapely.get_exterior_ring(simplified)
+    coordinates, indices = shapely.get_coordinates(rings, return_index=True)
+
+    points = [None] * len(polygons)
+    boundaries = np.flatnonzero(np.diff(indices)) + 1
+    for i, ring in zip(
+        np.unique(indices), np.split(np.rint(coordinates).astype(int), boundaries)
+    ):
+        # Rings are closed, the last point repeats the first
+        points[i] = " ".join(f"{x},{y}" for x, y in ring[:-1].tolist())
+    return points
+
+
+def with_points(annotation: dict, points: str) -> dict:
+    """A copy of the annotation with other points for its polygon."""
+
+    selector = dict(annotation["target"]["selector"])
+    selector["value"] = POINTS.sub(f'points="{points}"', selector["value"])
+    return {
+        **annotation,
+        "target": {**annotation["target"], "selector": selector},
+    }
+
+
+def tile_range(bbox: dict, size: int):
+    """The (x, y) of every tile of `size` canvas pixels that the bbox overlaps."""
+
+    for y in range(bbox["ymin"] // size, bbox["ymax"] // size + 1):
+        for x in range(bbox["xmin"] // size, bbox["xmax"] // size + 1):
+            yield x, y
+
+
+def tile_canvas(
+    rows: list,
+    width: int,
+    height: int,
+    tile_size: int = TILE_SIZE,
+    min_size: int = MIN_SIZE,
+    cluster_size: int = CLUSTER_SIZE,
+    tolerance: float = TOLERANCE,
+) -> dict:
+    """
+    The shards of one canvas: {scale factor: {(x, y): shard}}, from the rows
+    (see annotation_store.parse_annotation) of its annotations.
+    """
+
+    polygons = get_polygons(rows)
+
+    levels = {}
+    for s in get_scale_factors(width, height, tile_size):
+        points = get_points(polygons, tolerance * s) if s > 1 else None
+        tiles = {}
+        clusters = {}
+
+        for i, row in enumerate(rows):
+            bbox = row["bbox"]
+            if bbox is None:
+                continue
+
+            size = max(bbox["xmax"] - bbox["xmin"], bbox["ymax"] - bbox["ymin"])
+            if s > 1 and size < min_size * s:
+                cell = (
+                    (bbox["xmin"] + bbox["xmax"]) // 2 // (cluster_size * s),
+                    (bbox["ymin"] + bbox["ymax"]) // 2 // (cluster_size * s),
+                )
+                cluster = clusters.setdefault(
+                    cell, {"count": 0, "bbox": list(bbox.values()), "motivations": {}}
+                )
+                cluster["count"] += 1
+                cluster["bbox"] = [
+                    min(cluster["bbox"][0], bbox["xmin"]),
+                    min(cluster["bbox"][1], bbox["ymin"]),
+                    max(cluster["bbox"][2], bbox["xmax"]),
+                    max(cluster["bbox"][3], bbox["ymax"]),
+                ]
+                motivations = cluster["motivations"]
+                motivations[row["motivation"]] = (
+                    motivations.get(row["motivation"], 0) + 1
+                )
+                continue
+
+            annotation = row["annotation"]
+            if points is not None and points[i] is not None:
+                annotation = with_points(annotation, points[i])
+
+            for xy in tile_range(bbox, tile_size * s):
+                tiles.setdefault(xy, {"items": [], "clusters": []})
+                tiles[xy]["items"].append(annotation)
+
+        # The cells of the cluster grid fall within one tile each
+        cells_per_tile = tile_size // cluster_size
+        for (cx, cy), cluster in clusters.items():
+            xy = (cx // cells_per_tile, cy // cells_per_tile)
+            tiles.setdefault(xy, {"items": [], "clusters": []})
+            tiles[xy]["clusters"].append(cluster)
+
+        levels[s] = tiles
+
+    return levels
+
+
+def write_tiles(
+    annotation_page_paths: list,
+    output_folder: str,
+    canvas_sizes: dict = None,
+    tile_size: int = TILE_SIZE,
+    canvas: str = None,
+) -> dict:
+    """
+    Write the shards and index.json of all canvases of the pages into
+    `output_folder`, which is replaced as a whole. Returns the index. With
+    `canvas`, all annotations are taken to be on that canvas (the pages of
+    one map, not all of which point to its canvas yet).
+    """
+
+    canvases = {}
+    for path in annotation_page_paths:
+        with open(path) as f:
+            for annotation in json.load(f).get("items", []):
+                row = parse_annotation(annotation, "")
+                row["canvas"] = canvas or row["canvas"]
+                # The context of the shard covers that of the annotations
+                row["annotation"] = {
+                    k: v for k, v in annotation.items() if k != "@context"
+                }
+                canvases.setdefault(row["canvas"], []).append(row)
+
+    tmp_folder = output_folder.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    index = {"tileSize": tile_size, "canvases": {}}
+    for canvas, rows in canvases.items():
+        if canvas in (canvas_sizes or {}):
+            width, height = canvas_sizes[canvas]
+        else:
+            boxes = [row["bbox"] for row in rows if row["bbox"]]
+            width = max((b["xmax"] for b in boxes), default=0) + 1
+            height = max((b["ymax"] for b in boxes), default=0) + 1
+
+        key = canvas_key(canvas)
+        entry = {
+            "key": key,
+            "width": width,
+            "height": height,
+            "annotations": len(rows),
+            "levels": [],
+        }
+
+        levels = tile_canvas(rows, width, height, tile_size)
+        for s, tiles in levels.items():
+            folder = os.path.join(tmp_folder, key, str(s))
+            os.makedirs(folder)
+
+            sizes = {}
+            for (x, y), tile in sorted(tiles.items()):
+                shard = {
+                    "@context": PAGE_CONTEXT,
+                    "type": "AnnotationPage",
+                    "items": tile["items"],
+                    "clusters": tile["clusters"],
+                }
+                data = json.dumps(shard, separators=(",", ":"), ensure_ascii=False)
+                with open(os.path.join(folder, f"{x}_{y}.json"), "w") as f:
+                    f.write(data)
+                sizes[f"{x}_{y}"] = len(data.encode())
+
+            entry["levels"].append({"scaleFactor": s, "tiles": sizes})
+
+        index["canvases"][canvas] = entry
+
+    with open(os.path.join(tmp_folder, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.replace(tmp_folder, output_folder)
+
+    return index
+
+
+def viewport_shards(entry: dict, level: dict, tile_size: int, viewport=VIEWPORT):
+    """
+    (shards, bytes) a viewport needs at this level, for every position of
+    the viewport on the canvas in steps of half a viewport.
+    """
+
+    s = level["scaleFactor"]
+    size = tile_size * s
+    w, h = viewport[0] * s, viewport[1] * s
+
+    xs = range(0, max(entry["width"] - w, 0) + 1, max(w // 2, 1))
+    ys = range(0, max(entry["height"] - h, 0) + 1, max(h // 2, 1))
+
+    for y in ys:
+        for x in xs:
+            bbox = {"xmin": x, "ymin": y, "xmax": x + w - 1, "ymax": y + h - 1}
+            sizes = [
+                level["tiles"][f"{tx}_{ty}"]
+                for tx, ty in tile_range(bbox, size)
+                if f"{tx}_{ty}" in level["tiles"]
+            ]
+            yield len(sizes), sum(sizes)
+
+
+def print_report(index: dict, page_bytes: int, viewport=VIEWPORT):
+    tile_size = index["tileSize"]
+
+    per_level = {}
+    for entry in index["canvases"].values():
+        for level in entry["levels"]:
+            stats = per_level.setdefault(
+                level["scaleFactor"], {"sizes": [], "viewports": []}
+            )
+            stats["sizes"].extend(level["tiles"].values())
+            stats["viewports"].extend(
+                viewport_shards(entry, level, tile_size, viewport)
+            )
+
+    print(
+        f"{len(index['canvases'])} canvases, {page_bytes / 2**20:.1f} MB of "
+        f"AnnotationPages, viewport of {viewport[0]}x{viewport[1]} pixels"
+    )
+    print("level  shards  median kB  max kB  total MB  shards/viewport  kB/viewport")
+    for s, stats in sorted(per_level.items()):
+        sizes, viewports = stats["sizes"], stats["viewports"]
+        shards = [n for n, _ in viewports] or [0]
+        kbs = [b / 2**10 for _, b in viewports] or [0]
+        print(
+            f"{s:>5}  {len(sizes):>6}  {statistics.median(sizes or [0]) / 2**10:>9.1f}"
+            f"  {max(sizes or [0]) / 2**10:>6.1f}  {sum(sizes) / 2**20:>8.1f}"
+            f"  {statistics.mean(shards):>10.1f} ({max(shards)})"
+            f"  {statistics.mean(kbs):>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("output_folder")
+    parser.add_argument("annotation_pages", nargs="+", metavar="PAGE")
+    parser.add_argument("--manifest", default="data/manifest.json")
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument(
+        "--report", action="store_true", help="Print shard and viewport sizes"
+    )
+    args = parser.parse_args()
+
+    canvas_sizes = {}
+    if os.path.exists(args.manifest):
+        canvas_sizes = get_canvas_sizes(args.manifest)
+
+    index = write_tiles(
+        args.annotation_pages, args.output_folder, canvas_sizes, args.tile_size
+    )
+
+    if args.report:
+        print_report(
+            index, sum(os.path.getsize(path) for path in args.annotation_pages)
+        )
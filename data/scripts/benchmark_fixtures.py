@@ -0,0 +1,391 @@
+"""
+Synthetic inputs for benchmark_pipeline.py, so the pipeline scripts can be
+timed without a GPU, the models or the network:
+
+- make_map: a map scan with coastlines, icons and lettering
+- StubTextRunner: word polygons and texts, like the predictions of
+  MapTextRunner, and make_text_page to turn them into the AnnotationPage of
+  spot_text.py
+- make_htr_tsv: the results.tsv Loghi writes for the snippets of a page
+- StubMaskGenerator: the coco_rle masks of SAM2AutomaticMaskGenerator
+- make_cutouts: the cutouts of segment_icons.py, with the same icon found in
+  overlapping windows and at several resize factors, for filter_cutouts
+- make_canvases / make_priority_tsv: manifest canvases and HTR priority
+  rows with labels alike, for the label matching of gen-htr-priority.py
+
+Everything is seeded, so the same sizes give the same fixtures.
+"""
+
+import json
+import math
+import uuid
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+Image.MAX_IMAGE_PIXELS = None
+
+CANVAS_ID = "canvas:synthetic"
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg"><polygon points="{}" /></svg>'
+
+WORDS = [
+    "Cochin",
+    "Goa",
+    "rivier",
+    "Fort",
+    "Batavia",
+    "Ceylon",
+    "Malabaar",
+    "kust",
+    "eiland",
+    "baai",
+    "Mangalore",
+    "Calicut",
+    "Quilon",
+    "zandbank",
+    "rif",
+    "Negapatnam",
+    "Colombo",
+    "Galle",
+    "Tuticorin",
+    "Jaffna",
+    "Punta",
+    "de",
+]
+
+
+def get_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def to_points(coordinates) -> str:
+    return " ".join(f"{int(x)},{int(y)}" for x, y in coordinates)
+
+
+def rotated_rectangle(cx, cy, width, height, angle):
+    cos, sin = math.cos(angle), math.sin(angle)
+    return [
+        (cx + dx * cos - dy * sin, cy + dx * sin + dy * cos)
+        for dx, dy in [
+            (-width / 2, -height / 2),
+            (width / 2, -height / 2),
+            (width / 2, height / 2),
+            (-width / 2, height / 2),
+        ]
+    ]
+
+
+def make_map(path: str, width: int = 6000, height: int = 4000, seed: int = 0):
+    """A paper coloured scan with coastlines, filled icons and lettering."""
+
+    rng = np.random.default_rng(seed)
+
+    noise = rng.normal(0, 8, (height, width, 1))
+    paper = np.clip(np.array([226, 211, 178]) + noise, 0, 255).astype(np.uint8)
+    image = Image.fromarray(paper)
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(20):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        line = []
+        for _ in range(200):
+            x, y = x + rng.normal(0, 30), y + rng.normal(0, 30)
+            line.append((x, y))
+        draw.line(line, fill=(80, 60, 40), width=3)
+
+    for _ in range(width * height // 40_000):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        r = rng.uniform(8, 40)
+        color = tuple(int(c) for c in rng.integers(0, 160, 3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color, outline=(0, 0, 0))
+
+    for _ in range(width * height // 20_000):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        draw.text((x, y), WORDS[rng.integers(len(WORDS))], fill=(30, 30, 30))
+
+    image.save(path, quality=90)
+
+
+class StubTextRunner:
+    """
+    Stands in for MapTextRunner: run_all "spots" `n_words` words, rotated
+    rectangles with a text and score, spread over the map.
+    """
+
+    def __init__(self, width: int, height: int, n_words: int = 2000, seed: int = 0):
+        self.width = width
+        self.height = height
+        self.n_words = n_words
+        self.rng = random.Random(seed)
+        self.predictions = []
+
+    def run_all(self):
+        rng = self.rng
+        for _ in range(self.n_words):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+            width = max(40, 18 * len(text) * rng.uniform(0.8, 1.2))
+            height = rng.uniform(28, 60)
+            cx = rng.uniform(width, self.width - width)
+            cy = rng.uniform(height, self.height - height)
+            angle = rng.choice([0, 0, 0, rng.uniform(-math.pi / 2, math.pi / 2)])
+
+            self.predictions.append(
+                {
+                    "polygon": rotated_rectangle(cx, cy, width, height, angle),
+                    "text": text,
+                    "score": rng.uniform(0.5, 1.0),
+                }
+            )
+        return self.predictions
+
+
+def make_text_page(predictions: list, canvas_id: str = CANVAS_ID, seed: int = 0):
+    """The AnnotationPage spot_text.py makes of the predictions."""
+
+    rng = random.Random(seed)
+    generator = {
+        "id": "https://github.com/maps-as-data/MapTextPipeline",
+        "type": "Software",
+    }
+
+    items = []
+    for prediction in predictions:
+        polygon = prediction["polygon"]
+        items.append(
+            {
+                "@context": "http://www.w3.org/ns/anno.jsonld",
+                "id": get_uuid(rng),
+                "type": "Annotation",
+                "motivation": "textspotting",
+                "body": [
+                    {
+                        "type": "TextualBody",
+                        "value": prediction["text"],
+                        "format": "text/plain",
+                        "purpose": "supplementing",
+                        "generator": generator,
+                    }
+                ],
+                "target": {
+                    "source": canvas_id,
+                    "selector": {
+                        "type": "SvgSelector",
+                        "value": SVG.format(to_points(polygon + polygon[:1])),
+                    },
+                    "generator": generator,
+                },
+            }
+        )
+
+    return {
+        "@context": "http://iiif.io/api/presentation/3/context.json",
+        "type": "AnnotationPage",
+        "items": items,
+    }
+
+
+def make_htr_tsv(
+    path: str,
+    annotation_page: dict,
+    snippet_folder: str,
+    transcribed: float = 0.9,
+    seed: int = 0,
+):
+    """A Loghi results.tsv for `transcribed` of the annotations of the page."""
+
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for annotation in annotation_page["items"]:
+            if rng.random() >= transcribed:
+                continue
+            text = annotation["body"][0]["value"]
+            f.write(
+                f"{snippet_folder}/{annotation['id']}.png\t{rng.uniform(0.3, 1.0):.6f}\t{text}\n"
+            )
+
+
+class StubMaskGenerator:
+    """
+    Stands in for SAM2AutomaticMaskGenerator(output_mode="coco_rle"):
+    generate returns `n_masks` ellipses per window, as coco RLE, with the
+    bbox, point_coords and crop_box of SAM's results. The masks of a window
+    size are made once, so generate itself costs next to nothing.
+    """
+
+    def __init__(self, n_masks: int = 40, seed: int = 0):
+        self.n_masks = n_masks
+        self.seed = seed
+        self._masks = {}  # (height, width) -> results
+
+    def _make_masks(self, height: int, width: int) -> list:
+        from pycocotools import mask as mask_utils
+
+        rng = np.random.default_rng(self.seed)
+        ys, xs = np.ogrid[:height, :width]
+
+        results = []
+        for _ in range(self.n_masks):
+            rx, ry = rng.uniform(6, min(width, height) / 8, 2)
+            cx = rng.uniform(rx + 10, width - rx - 10)
+            cy = rng.uniform(ry + 10, height - ry - 10)
+
+            mask = (((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 1).astype(np.uint8)
+            rle = mask_utils.encode(np.asfortranarray(mask))
+
+            results.append(
+                {
+                    "segmentation": rle,
+                    "area": int(mask.sum()),
+                    "bbox": [cx - rx, cy - ry, 2 * rx, 2 * ry],
+                    "predicted_iou": float(rng.uniform(0.9, 1.0)),
+                    "point_coords": [[cx, cy]],
+                    "stability_score": float(rng.uniform(0.8, 1.0)),
+                    "crop_box": [0, 0, width, height],
+                }
+            )
+        return results
+
+    def generate(self, image: np.ndarray) -> list:
+        height, width = image.shape[:2]
+        if (height, width) not in self._masks:
+            self._masks[(height, width)] = self._make_masks(height, width)
+
+        # process_image changes the results it gets
+        return [
+            {**r, "segmentation": dict(r["segmentation"])}
+            for r in self._masks[(height, width)]
+        ]
+
+
+def make_cutouts(
+    n_icons: int = 300,
+    width: int = 6000,
+    height: int = 4000,
+    seed: int = 0,
+) -> dict:
+    """
+    The data segment_icons.py gives filter_cutouts: every icon is found one
+    to three times, in overlapping windows or at other resize factors, with
+    slightly different polygons.
+    """
+
+    rng = random.Random(seed)
+    cutouts = {}
+
+    for _ in range(n_icons):
+        cx, cy = rng.uniform(50, width - 50), rng.uniform(50, height - 50)
+        r = rng.uniform(8, 40)
+
+        for _ in range(rng.randint(1, 3)):
+            f = rng.choice([1.0, 0.5, 0.25])
+            jitter = r * 0.05
+            polygon = [
+                (
+                    cx + r * math.cos(a) + rng.uniform(-jitter, jitter),
+                    cy + r * math.sin(a) + rng.uniform(-jitter, jitter),
+                )
+                for a in np.linspace(0, 2 * math.pi, 24, endpoint=False)
+            ]
+
+            cutout = cutouts.setdefault(
+                (f, int(cx // 750), int(cy // 750)), {"f": f, "annotations": []}
+            )
+            cutout["annotations"].append(
+                {
+                    "@context": "http://www.w3.org/ns/anno.jsonld",
+                    "id": get_uuid(rng),
+                    "type": "Annotation",
+                    "motivation": "iconograpy",
+                    "body": [],
+                    "target": {
+                        "source": CANVAS_ID,
+                        "selector": {
+                            "type": "SvgSelector",
+                            "value": SVG.format(to_points(polygon + polygon[:1])),
+                        },
+                    },
+                }
+            )
+
+    return {"image": "synthetic.jpg", "cutouts": list(cutouts.values())}
+
+
+def make_canvases(n_canvases: int = 500, seed: int = 0) -> list:
+    """Manifest canvases with map titles like those of the Suriname collection."""
+
+    rng = random.Random(seed)
+
+    items = []
+    for n in range(n_canvases):
+        label = " ".join(
+            [
+                f"{rng.randint(1000, 9999)}",
+                "Kaart van de rivier",
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))),
+                f"met de plantages ({1700 + rng.randint(0, 150)})",
+            ]
+        )
+        if rng.random() < 0.3:
+            label += f" COLLBN {rng.randint(1, 999)}-{rng.randint(1, 99)}"
+
+        items.append(
+            {
+                "id": f"https://example.org/canvas/{n}",
+                "type": "Canvas",
+                "label": {"nl": [label]},
+                "items": [
+                    {
+                        "items": [
+                            {
+                                "body": {
+                                    "id": f"https://example.org/iiif/{n}/full/max/0/default.jpg",
+                                    "service": [
+                                        {"id": f"https://example.org/iiif/{n}"}
+                                    ],
+                                }
+                            }
+                        ]
+                    }
+                ],
+            }
+        )
+
+    return items
+
+
+def make_priority_tsv(path: str, canvases: list, with_url: float = 0.3, seed: int = 0):
+    """
+    An HTR priority TSV with a row for every canvas: a few match by their
+    IIIF info URL, the others only by a label with typos.
+    """
+
+    rng = random.Random(seed)
+    header = [f"column_{i}" for i in range(23)]
+
+    with open(path, "w") as f:
+        f.write("\t".join(header) + "\n")
+
+        for n, canvas in enumerate(rng.sample(canvases, len(canvases))):
+            label = list(canvas["label"]["nl"][0])
+            for _ in range(rng.randint(0, 3)):
+                label[rng.randrange(len(label))] = rng.choice("abcdefghij")
+
+            cols = ["-"] * 23
+            cols[0] = str(n)
+            cols[2] = f"https://hdl.handle.net/{n}"
+            cols[3] = str(rng.randint(1, 3))
+            cols[6] = "".join(label)
+            cols[16] = str(rng.choice([1, 1, 1, 2]))
+            if rng.random() < with_url:
+                cols[22] = (
+                    canvas["items"][0]["items"][0]["body"]["service"][0]["id"]
+                    + "/info.json"
+                )
+            f.write("\t".join(cols) + "\n")
+
+
+def write_json(path: str, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
@@ -0,0 +1,80 @@
+"""
+Match the synthetic HTR priority rows of benchmark_fixtures.py to their
+canvases by label (step 2 of scripts/gen-htr-priority.py) with the candidate
+index and with the full scan, for a few seeds. Both must match every canvas
+to the same row; the timings of both are printed.
+
+On real data, gen-htr-priority.py --check-parity does the same.
+
+Usage: python data/scripts/benchmark_label_parity.py [--canvases N] [--seeds N]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import benchmark_fixtures as fixtures
+from benchmark_pipeline import load_gen_htr_priority
+
+CANVASES = 500  # like benchmark_pipeline.py
+SEEDS = 3
+
+
+def check_parity(priority, folder: str, n_canvases: int, seed: int) -> dict:
+    """The seconds both ways and the canvases they matched differently."""
+
+    items = fixtures.make_canvases(n_canvases, seed=seed)
+    tsv_path = os.path.join(folder, f"priority-{seed}.tsv")
+    fixtures.make_priority_tsv(tsv_path, items, seed=seed)
+
+    tsv_rows = priority.load_tsv(tsv_path)
+    canvas_data = priority.build_canvas_data(items)
+    matched_canvases, matched_tsv = priority.match_by_url(
+        tsv_rows, priority.build_url_index(items)
+    )
+    unmatched = [tr for tr in tsv_rows if tr["row"] not in matched_tsv]
+
+    results, seconds = {}, {}
+    for name in ("index", "full scan"):
+        start = time.perf_counter()
+        index = priority.build_candidate_index(canvas_data) if name == "index" else None
+        results[name], _ = priority.match_by_label(
+            unmatched, canvas_data, matched_canvases, matched_tsv, index=index
+        )
+        seconds[name] = time.perf_counter() - start
+
+    return {
+        "rows": len(unmatched),
+        "seconds": seconds,
+        "differences": priority.compare_matches(results["index"], results["full scan"]),
+    }
+
+
+def main(n_canvases: int = CANVASES, seeds: int = SEEDS):
+
+    priority = load_gen_htr_priority()
+
+    with tempfile.TemporaryDirectory() as folder:
+        for seed in range(seeds):
+            result = check_parity(priority, folder, n_canvases, seed)
+            print(
+                f"seed {seed}: {result['rows']} rows, "
+                f"index {result['seconds']['index']:.2f}s, "
+                f"full scan {result['seconds']['full scan']:.2f}s, "
+                f"{len(result['differences'])} canvases matched differently"
+            )
+
+            assert result["differences"] == [], f"Parity: {result['differences']}"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--canvases", type=int, default=CANVASES)
+    parser.add_argument("--seeds", type=int, default=SEEDS)
+    args = parser.parse_args()
+
+    main(args.canvases, args.seeds)
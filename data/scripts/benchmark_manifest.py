@@ -0,0 +1,143 @@
+"""
+Benchmark writing a large manifest: building all canvases as iiif_prezi3
+objects and dumping the manifest at once, against streaming the canvases
+with make_manifest.dump_manifest. Both outputs must be byte-for-byte equal.
+
+The canvases are synthetic (no info.json or Allmaps requests), with
+metadata, a painting annotation, navPlace and an annotation reference, like
+the ones make_manifest makes.
+
+Usage: python data/scripts/benchmark_manifest.py [n_canvases]
+"""
+
+import io
+import sys
+import json
+import time
+import tracemalloc
+
+import iiif_prezi3
+
+from make_manifest import PREFIX, dump_manifest
+
+CONTEXT = [
+    "http://iiif.io/api/extension/navplace/context.json",
+    "http://iiif.io/api/presentation/3/context.json",
+]
+
+
+def make_canvas(n: int):
+    canvas_id = f"{PREFIX}canvas/{n}"
+    image_service = f"https://example.org/iiif/{n}"
+
+    canvas = iiif_prezi3.Canvas(
+        id=canvas_id,
+        label=f"Map {n}",
+        metadata=[
+            iiif_prezi3.KeyValueString(label="Title", value={"none": [f"Map {n}"]}),
+            iiif_prezi3.KeyValueString(label="Filename", value={"none": [f"map_{n}"]}),
+        ],
+    )
+    canvas.set_hwd(8000, 10000)
+
+    canvas.add_image(
+        image_url=f"{image_service}/full/max/0/default.jpg",
+        anno_page_id=f"{PREFIX}manifest.json/{n}/p1/page",
+        anno_id=f"{PREFIX}manifest.json/{n}/p1/page/anno",
+        format="image/jpeg",
+        height=8000,
+        width=10000,
+    )
+
+    # Appended after creation, as make_manifest.add_georeferencing does: a
+    # Reference doesn't pass validation as an item of Canvas.annotations
+    canvas.annotations = []
+    canvas.annotations.append(
+        iiif_prezi3.Reference(
+            id=f"{PREFIX}annotations/georeferencing/{n}.json",
+            label="Georeferencing Annotations made with Allmaps",
+            type="AnnotationPage",
+        )
+    )
+
+    ring = [[76.0 + i * 0.01, 10.0 + (i % 7) * 0.01] for i in range(40)]
+    canvas.navPlace = iiif_prezi3.NavPlace(
+        type="FeatureCollection",
+        features=[
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring + [ring[0]]]},
+            }
+        ],
+    )
+
+    return canvas
+
+
+def make_header():
+    return iiif_prezi3.Manifest(
+        id=f"{PREFIX}manifest.json",
+        label="Selection of maps for the Necessary Reunions project",
+    )
+
+
+def object_path(n_canvases: int, outfile):
+    manifest = make_header()
+
+    for n in range(n_canvases):
+        manifest.add_item(make_canvas(n))
+
+    manifest_jsonld = manifest.jsonld_dict()
+    manifest_jsonld["@context"] = CONTEXT
+
+    json.dump(manifest_jsonld, outfile, indent=2)
+
+
+def streaming_path(n_canvases: int, outfile):
+    manifest_jsonld = make_header().jsonld_dict()
+    manifest_jsonld["@context"] = CONTEXT
+
+    def canvases():
+        for n in range(n_canvases):
+            canvas_jsonld = make_canvas(n).jsonld_dict()
+            del canvas_jsonld["@context"]
+            yield canvas_jsonld
+
+    dump_manifest(manifest_jsonld, canvases(), outfile, indent=2)
+
+
+def measure(write, n_canvases: int):
+    outfile = io.StringIO()
+
+    start = time.perf_counter()
+    write(n_canvases, outfile)
+    seconds = time.perf_counter() - start
+
+    # Separate run for memory, tracemalloc slows everything down
+    tracemalloc.start()
+    write(n_canvases, io.StringIO())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    output = outfile.getvalue()
+
+    # The output itself is not what we want to measure
+    return seconds, peak - len(output), output
+
+
+def main(n_canvases: int = 10_000):
+
+    object_seconds, object_peak, object_output = measure(object_path, n_canvases)
+    stream_seconds, stream_peak, stream_output = measure(streaming_path, n_canvases)
+
+    assert object_output == stream_output, "Streaming output differs"
+
+    print(f"{n_canvases} canvases, {len(object_output) / 1e6:.1f} MB manifest")
+    print(f"  objects:   {object_seconds:.2f}s, peak {object_peak / 1e6:.1f} MB")
+    print(f"  streaming: {stream_seconds:.2f}s, peak {stream_peak / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    n_canvases = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    main(n_canvases)
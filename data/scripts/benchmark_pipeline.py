@@ -0,0 +1,382 @@
+"""
+Benchmark the hot paths of the data pipeline on synthetic fixtures (see
+benchmark_fixtures.py), without a GPU, the models or the network:
+
+    process_image     segment_icons.py: the post-processing of the masks of
+                      every window (the model is a StubMaskGenerator)
+    filter_cutouts    segment_icons.py: dropping the icons found twice
+    extract_snippets  textspotting/extract_snippets.py
+    integrate_htr     textspotting/integrate_htr_results.main
+    match_labels      scripts/gen-htr-priority.py: compute_match_score over
+                      the candidates of every row (match_labels_full_scan:
+                      over all canvases)
+    make_manifest     make_manifest.dump_manifest of synthetic canvases
+                      (see benchmark_manifest.py)
+
+Every benchmark runs --repeat times on fresh inputs. The timings, the
+fixture sizes, the commit and the machine are written as JSON, by default
+to data/.cache/benchmarks/<commit>.json, so two commits can be compared:
+
+    python data/scripts/benchmark_pipeline.py
+    git checkout other-branch
+    python data/scripts/benchmark_pipeline.py --compare data/.cache/benchmarks/<commit>.json
+
+Benchmarks whose script or one of its modules can't be imported
+(segment_icons.py needs torch and sam2) are reported as skipped, those that
+raise an error as failed.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import contextlib
+import subprocess
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..", "..")
+sys.path.extend(
+    [HERE, os.path.join(HERE, "textspotting"), os.path.join(HERE, "segmentation")]
+)
+
+import benchmark_fixtures as fixtures
+
+OUTPUT_FOLDER = "data/.cache/benchmarks"
+REPEAT = 3
+
+SIZES = {
+    "map_width": 3000,
+    "map_height": 2000,
+    "words": 300,  # text annotations on the map
+    "masks": 20,  # per segmentation window
+    "window_size": 1000,
+    "step_size": 750,
+    "icons": 500,  # for filter_cutouts, found up to three times each
+    "canvases": 500,
+    "manifest_canvases": 2000,
+}
+
+
+class Fixtures:
+    """The fixtures of one run, made on first use in `folder`."""
+
+    def __init__(self, folder: str, sizes: dict):
+        self.folder = folder
+        self.sizes = sizes
+        self._made = {}
+
+    def _get(self, name, make):
+        if name not in self._made:
+            self._made[name] = make()
+        return self._made[name]
+
+    def path(self, *parts) -> str:
+        return os.path.join(self.folder, *parts)
+
+    @property
+    def map_path(self) -> str:
+        def make():
+            path = self.path("images", "synthetic.jpg")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fixtures.make_map(path, self.sizes["map_width"], self.sizes["map_height"])
+            return path
+
+        return self._get("map", make)
+
+    @property
+    def text_page_path(self) -> str:
+        def make():
+            runner = fixtures.StubTextRunner(
+                self.sizes["map_width"], self.sizes["map_height"], self.sizes["words"]
+            )
+            path = self.path("textspotting", "synthetic.json")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fixtures.write_json(path, fixtures.make_text_page(runner.run_all()))
+            return path
+
+        return self._get("text_page", make)
+
+    @property
+    def htr_tsv_path(self) -> str:
+        def make():
+            path = self.path("snippets", "synthetic", "results.tsv")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(self.text_page_path) as f:
+                annotation_page = json.load(f)
+            fixtures.make_htr_tsv(path, annotation_page, os.path.dirname(path))
+            return path
+
+        return self._get("htr_tsv", make)
+
+
+def bench_process_image(fx: Fixtures):
+    import segment_icons
+    from PIL import Image
+
+    image = Image.open(fx.map_path)
+    image.load()
+    mask_generator = fixtures.StubMaskGenerator(fx.sizes["masks"])
+    output_folder = tempfile.mkdtemp(dir=fx.folder)
+
+    def run():
+        n = 0
+        for f, resized_image in segment_icons.get_resized_images(
+            image, fx.sizes["window_size"]
+        ):
+            for x, y, cutout in segment_icons.get_image_cutouts(
+                resized_image, fx.sizes["window_size"], fx.sizes["step_size"]
+            ):
+                segment_icons.process_image(
+                    cutout,
+                    fixtures.CANVAS_ID,
+                    x=x,
+                    y=y,
+                    original_image=image,
+                    original_height=image.height,
+                    original_width=image.width,
+                    resize_factor=f,
+                    mask_generator=mask_generator,
+                    output_folder=output_folder,
+                    folder_prefix=f'{"%.4f" % f}',
+                )
+                n += 1
+        return n
+
+    return run, "window"
+
+
+def bench_filter_cutouts(fx: Fixtures):
+    from segment_icons import filter_cutouts
+
+    data = fixtures.make_cutouts(
+        fx.sizes["icons"], fx.sizes["map_width"], fx.sizes["map_height"]
+    )
+    n = sum(len(cutout["annotations"]) for cutout in data["cutouts"])
+
+    def run():
+        filter_cutouts(data, output_folder=fx.folder, image_name="filtered")
+        return n
+
+    return run, "annotation"
+
+
+def bench_extract_snippets(fx: Fixtures):
+    from extract_snippets import extract_snippets
+
+    map_path, text_page_path = fx.map_path, fx.text_page_path
+    output_folder = fx.path("extracted")
+
+    def run():
+        shutil.rmtree(output_folder, ignore_errors=True)
+        extract_snippets(map_path, text_page_path, output_folder)
+        return fx.sizes["words"]
+
+    return run, "annotation"
+
+
+def bench_integrate_htr(fx: Fixtures):
+    from integrate_htr_results import main
+
+    # main changes the pages in place, so every run gets a fresh copy
+    snippets_folder = os.path.dirname(os.path.dirname(fx.htr_tsv_path))
+    page_folder = fx.path("integrate")
+
+    def setup():
+        os.makedirs(page_folder, exist_ok=True)
+        shutil.copyfile(fx.text_page_path, os.path.join(page_folder, "synthetic.json"))
+
+    def run():
+        main(snippets_folder, page_folder)
+        return fx.sizes["words"]
+
+    return run, "annotation", setup
+
+
+def load_gen_htr_priority():
+    path = os.path.join(ROOT, "scripts", "gen-htr-priority.py")
+    spec = importlib.util.spec_from_file_location("gen_htr_priority", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_match_labels(fx: Fixtures, full_scan: bool = False):
+    priority = load_gen_htr_priority()
+
+    items = fixtures.make_canvases(fx.sizes["canvases"])
+    tsv_path = fx.path("priority.tsv")
+    fixtures.make_priority_tsv(tsv_path, items)
+
+    tsv_rows = priority.load_tsv(tsv_path)
+    canvas_data = priority.build_canvas_data(items)
+    matched_canvases, matched_tsv = priority.match_by_url(
+        tsv_rows, priority.build_url_index(items)
+    )
+    unmatched = [tr for tr in tsv_rows if tr["row"] not in matched_tsv]
+
+    def run():
+        index = None if full_scan else priority.build_candidate_index(canvas_data)
+        priority.match_by_label(
+            unmatched, canvas_data, matched_canvases, matched_tsv, index=index
+        )
+        return len(unmatched)
+
+    return run, "row"
+
+
+def bench_make_manifest(fx: Fixtures):
+    from benchmark_manifest import streaming_path
+
+    def run():
+        streaming_path(fx.sizes["manifest_canvases"], io.StringIO())
+        return fx.sizes["manifest_canvases"]
+
+    return run, "canvas"
+
+
+BENCHMARKS = {
+    "process_image": bench_process_image,
+    "filter_cutouts": bench_filter_cutouts,
+    "extract_snippets": bench_extract_snippets,
+    "integrate_htr": bench_integrate_htr,
+    "match_labels": bench_match_labels,
+    "match_labels_full_scan": lambda fx: bench_match_labels(fx, full_scan=True),
+    "make_manifest": bench_make_manifest,
+}
+
+
+def measure(benchmark, fx: Fixtures, repeat: int = REPEAT) -> dict:
+    # The scripts print a line per window or annotation, which is not timed
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            run, unit, *setup = benchmark(fx)
+        except ImportError as e:
+            return {"skipped": str(e)}
+
+        seconds = []
+        try:
+            for _ in range(repeat):
+                for s in setup:
+                    s()
+                start = time.perf_counter()
+                n = run()
+                seconds.append(time.perf_counter() - start)
+        except ModuleNotFoundError as e:  # a lazy import, e.g. cv2
+            return {"skipped": str(e)}
+        except Exception as e:  # one broken script shouldn't stop the others
+            return {"failed": f"{type(e).__name__}: {e}".splitlines()[0]}
+
+    median = statistics.median(seconds)
+    return {
+        "seconds": seconds,
+        "median": median,
+        "min": min(seconds),
+        "items": n,
+        "unit": unit,
+        "per_item_ms": median / n * 1000 if n else None,
+    }
+
+
+def get_commit() -> dict:
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "-uno")),
+    }
+
+
+def run_benchmarks(names: list, sizes: dict, repeat: int = REPEAT) -> dict:
+    results = {
+        **get_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} cpus",
+        "repeat": repeat,
+        "sizes": sizes,
+        "benchmarks": {},
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        fx = Fixtures(folder, sizes)
+        for name in names:
+            result = measure(BENCHMARKS[name], fx, repeat)
+            results["benchmarks"][name] = result
+            print_result(name, result)
+
+    return results
+
+
+def print_result(name: str, result: dict, baseline: dict = None):
+    for status in ("skipped", "failed"):
+        if status in result:
+            print(f"{name:<24} {status}: {result[status]}")
+            return
+
+    line = (
+        f"{name:<24} {result['median']:>8.3f}s  "
+        f"{result['per_item_ms']:>8.3f} ms/{result['unit']}"
+    )
+    if baseline and "median" in baseline:
+        line += f"  (was {baseline['median']:.3f}s, speedup {baseline['median'] / result['median']:.2f}x)"
+    print(line)
+
+
+def compare(results: dict, baseline: dict):
+    print(
+        f"\n{baseline.get('commit', '?')[:10]} -> {results.get('commit', '?')[:10]}"
+        + (" (dirty)" if results.get("dirty") else "")
+    )
+    if baseline.get("sizes") != results.get("sizes"):
+        print("The fixture sizes differ, the timings are not comparable")
+
+    for name, result in results["benchmarks"].items():
+        print_result(name, result, baseline.get("benchmarks", {}).get(name))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"Default: all of them ({', '.join(BENCHMARKS)})",
+    )
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help=f"Default: {OUTPUT_FOLDER}/<commit>.json")
+    parser.add_argument("--compare", metavar="JSON", help="Results of another run")
+    for name, default in SIZES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=default)
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    sizes = {name: getattr(args, name) for name in SIZES}
+    results = run_benchmarks(args.benchmarks or list(BENCHMARKS), sizes, args.repeat)
+
+    output = args.output or os.path.join(
+        OUTPUT_FOLDER, f"{results['commit'][:12] or 'results'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,202 @@
+"""
+Rebuild the manifest against a local stand-in for the image servers and
+Allmaps: once with an empty HTTP cache, then with nothing changed upstream,
+and once more with --max-age. The stand-in answers every request after a
+delay, like a remote server, and honours If-None-Match, so the second build
+only gets 304s and the third only asks for what was not found. The
+manifests must be byte-for-byte equal.
+
+The selection is data/selection.csv, with the info.json URLs pointed at the
+stand-in. It serves a synthetic info.json per map, and the georeferencing
+annotations of data/annotations/georeferencing/ as Allmaps would.
+
+Usage: python data/scripts/benchmark_rebuild.py [--latency SECONDS] [--streaming]
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+
+import make_manifest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SELECTION = os.path.join(HERE, "..", "selection.csv")
+GEOREFERENCING = os.path.join(HERE, "..", "annotations", "georeferencing")
+
+LATENCY = 0.2  # seconds per request
+
+
+class StandIn(ThreadingHTTPServer):
+    """The image servers (/iiif/<index>/info.json) and Allmaps (/allmaps/?url=)."""
+
+    def __init__(self, latency: float = LATENCY):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.statuses = {}  # status -> number of responses
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def count(self, status: int):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def get_body(self, url):
+        parts = url.path.strip("/").split("/")
+
+        if parts[0] == "iiif" and parts[-1] == "info.json":
+            return {
+                "@context": "http://iiif.io/api/image/3/context.json",
+                "id": self.server.url + "/".join(parts[:-1]),
+                "type": "ImageService3",
+                "protocol": "http://iiif.io/api/image",
+                "profile": "level1",
+                "width": 10000,
+                "height": 8000,
+            }
+
+        if parts[0] == "allmaps":
+            index = parse_qs(url.query)["url"][0].rstrip("/").split("/")[-2]
+            path = os.path.join(GEOREFERENCING, f"{index}.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    page = json.load(f)
+                page.pop("id", None)  # make_manifest adds its own
+                return page
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        body = self.get_body(urlparse(self.path))
+        if body is None:
+            self.server.count(404)
+            self.send_error(404)
+            return
+
+        content = json.dumps(body).encode()
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.server.count(200)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@contextlib.contextmanager
+def serve(latency: float = LATENCY):
+    server = StandIn(latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def build(
+    server: StandIn,
+    folder: str,
+    selection: str,
+    output: str,
+    streaming: bool = False,
+    max_age: float = 0,
+) -> float:
+    """Run make_manifest.main, returning the seconds it took."""
+
+    server.statuses.clear()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(None):
+        make_manifest.main(
+            selection_filepath=selection,
+            output_filepath=output,
+            annotations_folder=folder,
+            cache_folder=os.path.join(folder, "cache"),
+            max_age=max_age,
+            allmaps_url=server.url + "allmaps/",
+            state_filepath=os.path.join(folder, "state.json"),
+            streaming=streaming,
+        )
+    return time.perf_counter() - start
+
+
+def main(latency: float = LATENCY, streaming: bool = False):
+
+    with tempfile.TemporaryDirectory() as folder, serve(latency) as server:
+        os.makedirs(os.path.join(folder, "georeferencing"))
+
+        df = pd.read_csv(SELECTION)
+        df["iiif_info_url"] = [
+            f"{server.url}iiif/{index}/info.json" for index in df["index"]
+        ]
+        selection = os.path.join(folder, "selection.csv")
+        df.to_csv(selection, index=False)
+
+        # Maps without georeferencing get a 404 from Allmaps every time
+        runs = [
+            ("cold", 0, {200, 404}),
+            ("warm", 0, {304, 404}),
+            ("warm, --max-age 3600", 3600, {404}),
+        ]
+
+        outputs = []
+        for n, (name, max_age, expected) in enumerate(runs):
+            output = os.path.join(folder, f"{n}.json")
+            seconds = build(server, folder, selection, output, streaming, max_age)
+            statuses = ", ".join(
+                f"{count}x {status}"
+                for status, count in sorted(server.statuses.items())
+            )
+            print(f"{name}: {seconds:.2f}s ({statuses})")
+
+            assert set(server.statuses) <= expected, f"Unexpected responses: {name}"
+            with open(output, "rb") as f:
+                outputs.append(f.read())
+
+        assert len(set(outputs)) == 1, "The rebuilt manifest differs"
+
+    print(
+        f"{len(df)} maps, {latency:.2f}s per response, "
+        f"at most {make_manifest.MAX_WORKERS} in flight"
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument(
+        "--streaming", action="store_true", help="Build with make_manifest --streaming"
+    )
+    args = parser.parse_args()
+
+    main(args.latency, args.streaming)
@@ -0,0 +1,237 @@
+"""
+Sync synthetic AnnotationPages with a local stand-in for AnnoRepo, the way
+spot_text.py and segment_icons.py make them again: with the same content,
+but a new id for every annotation and a new timestamp. The stand-in keeps
+the annotations in memory, gives out etags and honours If-Match, like
+AnnoRepo.
+
+    upload        the page is uploaded with annorepo_client.py
+    again         the page made again, with new ids: nothing may be sent
+    changed       made again with one text changed, one word gone and one
+                  new: one update (paired by target), one delete and one
+                  create
+    edited        made again after a text was edited in AnnoRepo: the edit
+                  is kept
+
+Every step prints its plan, the requests it sent and the time it took.
+
+Usage: python data/scripts/benchmark_sync.py [--words N]
+"""
+
+import os
+import json
+import time
+import uuid
+import argparse
+import datetime
+import tempfile
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import annorepo_sync
+from annorepo_client import AnnoRepoClient, UploadProgress, annotation_name
+from benchmark_fixtures import StubTextRunner, make_text_page, write_json
+
+CONTAINER = "synthetic"
+WORDS = 2000
+
+
+class StandIn(ThreadingHTTPServer):
+    """The annotations-batch endpoint and the W3C API of one container."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.annotations = {}  # name -> (annotation, etag)
+        self.requests = {}  # method -> number of requests
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def store(self, name: str, annotation: dict) -> str:
+        etag = f'"{uuid.uuid4()}"'
+        stored = {
+            **annotation,
+            "id": f"{self.url}/w3c/{CONTAINER}/{name}",
+            "via": annotation.get("id"),
+        }
+        self.annotations[name] = (stored, etag)
+        return etag
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body=None, etag: str = None):
+        content = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        return json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def handle_request(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.command] = server.requests.get(self.command, 0) + 1
+
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+
+        if self.command == "POST" and parts[-1] == "annotations-batch":
+            results = []
+            with server.lock:
+                for annotation in self.read_body():
+                    name = str(uuid.uuid4())
+                    etag = server.store(name, annotation)
+                    results.append(
+                        {
+                            "annotationName": name,
+                            "containerName": CONTAINER,
+                            "etag": etag,
+                        }
+                    )
+            return self.reply(200, results)
+
+        if parts[:2] != ["w3c", CONTAINER]:
+            return self.reply(404)
+
+        if len(parts) == 2:
+            # One page with everything, like a container with a large page size
+            with server.lock:
+                items = [annotation for annotation, _ in server.annotations.values()]
+            return self.reply(200, {"type": "AnnotationPage", "items": items})
+
+        name = parts[2]
+        with server.lock:
+            if name not in server.annotations:
+                return self.reply(404)
+            annotation, etag = server.annotations[name]
+
+            if self.command == "GET":
+                return self.reply(200, annotation, etag)
+
+            if self.headers.get("If-Match") != etag:
+                return self.reply(412)
+
+            if self.command == "PUT":
+                return self.reply(200, None, server.store(name, self.read_body()))
+
+            del server.annotations[name]
+            return self.reply(204)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+@contextlib.contextmanager
+def serve():
+    server = StandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def sync(server: StandIn, page_path: str, progress_path: str) -> dict:
+    """Run annorepo_sync.main, returning its plan and what was sent."""
+
+    client = AnnoRepoClient(base_url=server.url, container=CONTAINER)
+
+    progress = UploadProgress(progress_path)
+    try:
+        with open(page_path) as f:
+            pages = {"synthetic": json.load(f)["items"]}
+        remote = {annotation_name(a): a for a in client.list_annotations()}
+        plan = annorepo_sync.plan_sync(pages, progress, remote)
+    finally:
+        progress.close()
+
+    server.requests.clear()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(None):
+        status = annorepo_sync.main([page_path], client, progress_path=progress_path)
+    seconds = time.perf_counter() - start
+
+    assert status == 0, "The sync failed"
+
+    return {
+        **{kind: len(plan[kind]) for kind in ("create", "update", "delete")},
+        "conflict": len(plan["conflict"]),
+        "unchanged": plan["unchanged"],
+        "edited": plan["edited"],
+        "requests": dict(server.requests),
+        "seconds": seconds,
+    }
+
+
+def main(n_words: int = WORDS):
+
+    predictions = StubTextRunner(6000, 4000, n_words).run_all()
+
+    with tempfile.TemporaryDirectory() as folder, serve() as server:
+        page_path = os.path.join(folder, "synthetic.json")
+        progress_path = os.path.join(folder, "uploaded.jsonl")
+
+        def run(name, seed, expected):
+            # Another seed gives every annotation another id, and the target
+            # is timestamped like segment_icons.py does
+            page = make_text_page(predictions, seed=seed)
+            for annotation in page["items"]:
+                annotation["target"]["created"] = datetime.datetime.now().isoformat()
+            write_json(page_path, page)
+            result = sync(server, page_path, progress_path)
+
+            requests = ", ".join(
+                f"{n} {method}" for method, n in sorted(result["requests"].items())
+            )
+            print(
+                f"{name:<8} {result['create']} create, {result['update']} update, "
+                f"{result['delete']} delete, {result['unchanged']} unchanged, "
+                f"{result['edited']} edited in AnnoRepo: {requests} "
+                f"in {result['seconds']:.2f}s"
+            )
+
+            for kind, n in expected.items():
+                assert result[kind] == n, f"{name}: {result[kind]} {kind}, not {n}"
+
+        nothing = {"create": 0, "update": 0, "delete": 0, "conflict": 0}
+
+        run("upload", 0, {"create": n_words})
+        run("again", 1, {**nothing, "unchanged": n_words})
+        assert set(server.requests) == {"GET"}, "A page made again was sent"
+
+        # One text changed, one word gone and one new
+        predictions[0] = {**predictions[0], "text": predictions[0]["text"] + "s"}
+        del predictions[1]
+        predictions.append(StubTextRunner(6000, 4000, 1, seed=1).run_all()[0])
+        run("changed", 2, {"create": 1, "update": 1, "delete": 1, "conflict": 0})
+
+        # A text edited in AnnoRepo, e.g. in the viewer
+        name, (annotation, etag) = next(iter(server.annotations.items()))
+        annotation["body"][0]["value"] = "Coetchin"
+        run("edited", 3, {**nothing, "edited": 1})
+        assert server.annotations[name][0]["body"][0]["value"] == "Coetchin"
+
+    print(f"{n_words} annotations")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--words", type=int, default=WORDS)
+    args = parser.parse_args()
+
+    main(args.words)
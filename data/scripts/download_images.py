@@ -1,13 +1,202 @@
 """
-Download images using dezoomify-rs.
+Download the full resolution images of the selected maps.
+
+By default, the tiles are fetched directly from the IIIF Image API service
+(`iiif_info_url`), over a pooled session with a bounded number of concurrent
+requests, and stitched together. Tiles are kept on disk until the map is
+complete, so an interrupted download resumes where it stopped.
+
+With --format tif, the maps are saved as tiled pyramidal TIFF instead of
+one big JPEG, so extract_snippets.py reads the regions around the snippets
+without decoding the whole scan (see pyramid.py). This needs tifffile and
+imagecodecs (pip install tifffile imagecodecs).
+
+The previous method, using dezoomify-rs, is still available with --dezoomify.
 For more information, visit: https://github.com/lovasoa/dezoomify-rs
 """
 
+import io
 import os
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import pandas as pd
+from PIL import Image
+
+from http_utils import make_session, TIMEOUT
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
+
+MAX_WORKERS = 16  # concurrent tile requests
+DEFAULT_TILE_SIZE = 1024  # when the image service doesn't advertise tiles
+
+
+def get_tile_regions(info: dict):
+    """Full resolution regions (x, y, w, h) that cover the image, in rows."""
+
+    width, height = info["width"], info["height"]
+
+    tiles = info.get("tiles") or [{"width": DEFAULT_TILE_SIZE}]
+    tile_width = tiles[0]["width"]
+    tile_height = tiles[0].get("height", tile_width)
+
+    for y in range(0, height, tile_height):
+        for x in range(0, width, tile_width):
+            yield x, y, min(tile_width, width - x), min(tile_height, height - y)
+
+
+def get_tile_url(info: dict, region) -> str:
+    x, y, w, h = region
+
+    if "@id" in info:  # IIIF Image API 2
+        return f"{info['@id']}/{x},{y},{w},{h}/{w},/0/default.jpg"
+    else:  # IIIF Image API 3
+        return f"{info['id']}/{x},{y},{w},{h}/{w},{h}/0/default.jpg"
+
+
+def download_tile(session, url: str, tile_path: str, region):
+    """Fetch one tile, check that it decodes to the requested size and save it."""
+
+    if os.path.exists(tile_path):  # done in an earlier run
+        return
+
+    r = session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+
+    with Image.open(io.BytesIO(r.content)) as tile:
+        tile.load()
+        if tile.size != tuple(region[2:]):
+            raise ValueError(f"Tile {url} is {tile.size}, expected {region[2:]}")
+
+    # Write to a temporary file first, so an interrupted write doesn't count as done
+    with open(tile_path + ".tmp", "wb") as f:
+        f.write(r.content)
+    os.replace(tile_path + ".tmp", tile_path)
+
+
+def get_tile_path(tile_folder: str, region) -> str:
+    x, y, _, _ = region
+    return os.path.join(tile_folder, f"{x}_{y}.jpg")
+
+
+def stitch_tiles(info: dict, regions: list, tile_folder: str) -> Image.Image:
+    """Paste all tiles together, after checking that they are all there."""
+
+    missing = [r for r in regions if not os.path.exists(get_tile_path(tile_folder, r))]
+    if missing:
+        raise ValueError(f"{len(missing)}/{len(regions)} tiles are missing")
+
+    image = Image.new("RGB", (info["width"], info["height"]))
+
+    for region in regions:
+        with Image.open(get_tile_path(tile_folder, region)) as tile:
+            image.paste(tile.convert("RGB"), region[:2])
+
+    return image
 
 
 def download_images(
+    csv_file,
+    output_dir,
+    name_column="file_name",
+    url_column="iiif_info_url",
+    max_workers=MAX_WORKERS,
+    output_format="jpg",
+):
+
+    df = pd.read_csv(csv_file)
+
+    download_maps(
+        zip(df[name_column], df[url_column]),
+        output_dir,
+        max_workers=max_workers,
+        output_format=output_format,
+    )
+
+
+def download_maps(maps, output_dir, max_workers=MAX_WORKERS, output_format="jpg"):
+    """Download (name, iiif_info_url) pairs to `output_dir`/name.`output_format`."""
+
+    session = make_session(pool_size=max_workers)
+
+    todo = []
+    for name, url in maps:
+
+        target_file_path = os.path.join(output_dir, f"{name}.{output_format}")
+
+        if os.path.exists(target_file_path):
+            print(f"Skipping {name}, already downloaded")
+            continue
+
+        todo.append((name, url, target_file_path))
+
+    def get_info(url):
+        try:
+            r = session.get(url, timeout=TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(e)
+
+    # All tiles of all maps share one pool, so the next maps are downloading
+    # while the previous ones are stitched.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        infos = executor.map(get_info, [url for _, url, _ in todo])
+
+        downloads = []
+        for (name, _, target_file_path), info in zip(todo, infos):
+
+            if info is None:
+                print(f"Failed to download {name}: no image information")
+                continue
+
+            tile_folder = target_file_path + ".tiles"
+            os.makedirs(tile_folder, exist_ok=True)
+
+            regions = list(get_tile_regions(info))
+            futures = [
+                executor.submit(
+                    download_tile,
+                    session,
+                    get_tile_url(info, region),
+                    get_tile_path(tile_folder, region),
+                    region,
+                )
+                for region in regions
+            ]
+
+            downloads.append((name, info, target_file_path, regions, futures))
+
+        for name, info, target_file_path, regions, futures in downloads:
+
+            tile_folder = target_file_path + ".tiles"
+
+            errors = [f.exception() for f in futures if f.exception()]
+            if errors:
+                print(f"Failed to download {name}: {len(errors)} tiles failed")
+                print(errors[0])
+                continue
+
+            print(f"Stitching {len(regions)} tiles of {name} to {target_file_path}")
+            image = stitch_tiles(info, regions, tile_folder)
+
+            if output_format == "tif":
+                # pyramid.py needs tifffile, which only --format tif does
+                from pyramid import write_pyramid
+
+                write_pyramid(image, target_file_path + ".tmp")
+            else:
+                image.save(target_file_path + ".tmp", "JPEG", quality=100)
+            os.replace(target_file_path + ".tmp", target_file_path)
+
+            shutil.rmtree(tile_folder)
+
+
+def download_images_dezoomify(
     csv_file, output_dir, name_column="file_name", url_column="iiif_info_url"
 ):
 
@@ -18,19 +207,55 @@ def download_images(
         target_file_path = os.path.join(output_dir, name)
 
         print(f"Downloading {name} from {url} to {target_file_path}")
-        os.system(
-            f'dezoomify-rs --dezoomer iiif --largest "{url}" "{target_file_path}".jpg --compression 0'
+        result = subprocess.run(
+            [
+                "dezoomify-rs",
+                "--dezoomer",
+                "iiif",
+                "--largest",
+                url,
+                f"{target_file_path}.jpg",
+                "--compression",
+                "0",
+            ]
         )
 
+        if result.returncode != 0:
+            print(f"Failed to download {name} (exit code {result.returncode})")
+
 
 if __name__ == "__main__":
 
-    csv_file = "data/selection.csv"
-    output_dir = "data/images"
-    name_column = "file_name"
-    url_column = "iiif_info_url"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--csv-file", default="data/selection.csv")
+    parser.add_argument("--output-dir", default="data/images")
+    parser.add_argument("--name-column", default="file_name")
+    parser.add_argument("--url-column", default="iiif_info_url")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        "--format",
+        choices=["jpg", "tif"],
+        default="jpg",
+        help="One JPEG per map, or a tiled pyramidal TIFF (needs tifffile and imagecodecs)",
+    )
+    parser.add_argument("--dezoomify", action="store_true")
+    args = parser.parse_args()
 
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
 
-    download_images(csv_file, output_dir, name_column, url_column)
+    if args.dezoomify:
+        download_images_dezoomify(
+            args.csv_file, args.output_dir, args.name_column, args.url_column
+        )
+    else:
+        download_images(
+            args.csv_file,
+            args.output_dir,
+            args.name_column,
+            args.url_column,
+            max_workers=args.max_workers,
+            output_format=args.format,
+        )
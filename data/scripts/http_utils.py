@@ -0,0 +1,146 @@
+"""
+HTTP helpers for the data scripts: a pooled session that retries with
+backoff, and an on-disk cache that revalidates with ETag/Last-Modified.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TIMEOUT = 30  # seconds
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def make_session(
+    pool_size: int = 16,
+    retries: int = 3,
+    backoff_factor: float = 0.5,
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+    status_forcelist=RETRY_STATUS,
+    read_retries: int = None,
+) -> requests.Session:
+    """
+    A keep-alive session with room for `pool_size` connections per host, that
+    retries connection errors and 429/5xx responses with exponential backoff
+    (honouring Retry-After). With `read_retries=0`, a request whose response
+    didn't arrive in time is not sent again.
+    """
+
+    retry = Retry(
+        total=retries,
+        read=read_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=allowed_methods,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+class HTTPCache:
+    """
+    GET requests through a shared session, cached on disk.
+
+    A cached response is revalidated with If-None-Match/If-Modified-Since, so
+    an unchanged resource costs a 304 instead of a full download. Entries
+    younger than `max_age` seconds are served without asking the server at
+    all. Without a `folder`, nothing is cached.
+    """
+
+    def __init__(
+        self,
+        folder: str = "",
+        session: requests.Session = None,
+        max_age: float = 0,
+        timeout: float = TIMEOUT,
+    ):
+        self.folder = folder
+        self.session = session or make_session()
+        self.max_age = max_age
+        self.timeout = timeout
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def _entry_path(self, url: str) -> str:
+        return os.path.join(
+            self.folder, hashlib.sha1(url.encode()).hexdigest() + ".json"
+        )
+
+    def _read_entry(self, url: str) -> dict:
+        if not self.folder:
+            return None
+
+        try:
+            with open(self._entry_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return entry if entry.get("url") == url else None
+
+    def _write_entry(self, url: str, entry: dict):
+        # Write to a temporary file first, so concurrent readers never see half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._entry_path(url))
+
+    def get_text(self, url: str, params: dict = None) -> str:
+        """Return the body of `url`, raising requests.HTTPError on failure."""
+
+        if params:
+            url = requests.Request("GET", url, params=params).prepare().url
+
+        entry = self._read_entry(url)
+
+        if entry and time.time() - entry["fetched"] < self.max_age:
+            return entry["body"]
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if r.status_code == 304 and entry:
+            entry["fetched"] = time.time()
+            self._write_entry(url, entry)
+            return entry["body"]
+
+        r.raise_for_status()
+
+        if self.folder:
+            self._write_entry(
+                url,
+                {
+                    "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched": time.time(),
+                    "body": r.text,
+                },
+            )
+
+        return r.text
+
+    def get_json(self, url: str, params: dict = None):
+        return json.loads(self.get_text(url, params=params))
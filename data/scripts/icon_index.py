@@ -0,0 +1,305 @@
+"""
+Find the icons that look like a given one, across all segmented maps.
+
+Every icon cutout of segment_icons.py (a PNG with the mask as alpha) gets a
+descriptor of 128 bits: difference hashes of the horizontal and the vertical
+gradients of the icon, blurred and on a white background, at HASH_SIZE by
+HASH_SIZE. Alike icons differ in few bits, so similarity is the Hamming
+distance. A descriptor takes about a millisecond on a CPU, without a model.
+
+The index is approximate, by multi-index hashing: the 128 bits are split
+into CHUNKS chunks of 16 bits, and for every chunk the codes are kept sorted
+by its value. A query only looks at the codes that have one of its chunks
+exactly, or with one bit flipped. Every icon within 2 * CHUNKS - 1 bits of
+the query is found that way. When fewer than k icons are found, all codes
+are compared.
+
+The descriptors of a map are a shard of their own (<map>.npz in the index
+folder), so a map that is segmented again only replaces its shard, and
+IconIndex.add merges a new map into a loaded index without sorting it
+again:
+
+    python icon_index.py add data/.cache/icons segmentation/cutouts/<map> \\
+        --annotation-page segmentation/annotations/<map>.json
+    python icon_index.py query data/.cache/icons fort.png -k 20
+    python icon_index.py similar data/.cache/icons <icon id>
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+INDEX = "data/.cache/icons"
+
+HASH_SIZE = 8  # bits per direction: HASH_SIZE * HASH_SIZE
+THUMBNAIL = 36  # pixels, the icon is blurred at this size
+BLUR = 1  # radius, in pixels of the thumbnail
+CHUNKS = 8  # of 16 bits
+K = 10
+
+# Bits set in every byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def get_code(image: Image.Image, hash_size: int = HASH_SIZE) -> np.ndarray:
+    """The 128 bit descriptor of an icon cutout, as two uint64."""
+
+    background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+    gray = Image.alpha_composite(background, image.convert("RGBA")).convert("L")
+    gray = gray.resize((THUMBNAIL, THUMBNAIL), Image.Resampling.BOX)
+    gray = gray.filter(ImageFilter.GaussianBlur(BLUR))
+
+    pixels = np.asarray(
+        gray.resize((hash_size + 1, hash_size + 1), Image.Resampling.BILINEAR),
+        dtype=np.int16,
+    )
+    horizontal = pixels[:hash_size, 1:] > pixels[:hash_size, :-1]
+    vertical = pixels[1:, :hash_size] > pixels[:-1, :hash_size]
+
+    bits = np.concatenate([horizontal.flatten(), vertical.flatten()])
+    return np.packbits(bits).view(">u8").astype(np.uint64)
+
+
+def hamming(codes: np.ndarray, code: np.ndarray) -> np.ndarray:
+    """Bits that differ between every row of `codes` and `code`."""
+
+    xor = np.ascontiguousarray(codes ^ code)
+    return POPCOUNT[xor.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+
+def get_chunks(codes: np.ndarray) -> np.ndarray:
+    """The CHUNKS chunks of 16 bits of every code, as columns."""
+    return np.ascontiguousarray(codes).view(np.uint16).reshape(len(codes), CHUNKS)
+
+
+def read_cutouts(cutout_folder: str, annotation_page_path: str = None):
+    """
+    The ids, paths (relative to `cutout_folder`) and descriptors of the
+    cutouts of one map. With its AnnotationPage, only the icons that
+    filter_cutouts kept.
+    """
+
+    keep = None
+    if annotation_page_path:
+        with open(annotation_page_path) as f:
+            keep = {annotation["id"] for annotation in json.load(f)["items"]}
+
+    ids, paths, codes = [], [], []
+    for path in sorted(glob.glob(os.path.join(cutout_folder, "*", "*.png"))):
+        icon_id = os.path.splitext(os.path.basename(path))[0]
+        if keep is not None and icon_id not in keep:
+            continue
+
+        with Image.open(path) as image:
+            codes.append(get_code(image))
+        ids.append(icon_id)
+        paths.append(os.path.relpath(path, cutout_folder))
+
+    return ids, paths, np.array(codes, dtype=np.uint64).reshape(-1, 2)
+
+
+def write_shard(index_folder: str, map_name: str, ids, paths, codes):
+    os.makedirs(index_folder, exist_ok=True)
+    path = os.path.join(index_folder, f"{map_name}.npz")
+
+    # np.savez adds .npz to names without it
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, ids=np.array(ids), paths=np.array(paths), codes=codes)
+    os.replace(path + ".tmp", path)
+
+
+class IconIndex:
+    def __init__(self):
+        self.maps = []  # map name of every shard
+        self.ids = np.array([], dtype=str)
+        self.paths = np.array([], dtype=str)
+        self.shards = np.array([], dtype=np.int32)  # index in self.maps
+        self.codes = np.zeros((0, 2), dtype=np.uint64)
+
+        # Per chunk, the row numbers sorted by the value of that chunk
+        self._order = np.zeros((CHUNKS, 0), dtype=np.int64)
+        self._sorted = np.zeros((CHUNKS, 0), dtype=np.uint16)
+
+    @classmethod
+    def load(cls, index_folder: str = INDEX) -> "IconIndex":
+        index = cls()
+
+        ids, paths, shards, codes = [], [], [], []
+        for path in sorted(glob.glob(os.path.join(index_folder, "*.npz"))):
+            with np.load(path) as shard:
+                ids.append(shard["ids"])
+                paths.append(shard["paths"])
+                codes.append(shard["codes"].reshape(-1, 2))
+            shards.append(np.full(len(ids[-1]), len(index.maps), dtype=np.int32))
+            index.maps.append(os.path.basename(path)[: -len(".npz")])
+
+        if index.maps:
+            index.ids = np.concatenate(ids)
+            index.paths = np.concatenate(paths)
+            index.shards = np.concatenate(shards)
+            index.codes = np.concatenate(codes)
+
+            chunks = get_chunks(index.codes).T
+            index._order = np.argsort(chunks, axis=1, kind="stable")
+            index._sorted = np.take_along_axis(chunks, index._order, axis=1)
+
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, map_name: str, ids, paths, codes: np.ndarray):
+        """Merge the icons of a new map into the sorted chunks (no full sort)."""
+
+        if map_name in self.maps:
+            raise ValueError(f"{map_name} is already in the index, load it again")
+
+        offset = len(self)
+        self.shards = np.concatenate(
+            [self.shards, np.full(len(ids), len(self.maps), dtype=np.int32)]
+        )
+        self.maps.append(map_name)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=str)])
+        self.paths = np.concatenate([self.paths, np.asarray(paths, dtype=str)])
+        self.codes = np.concatenate([self.codes, codes])
+
+        chunks = get_chunks(codes).T
+        new_order = np.argsort(chunks, axis=1, kind="stable")
+        new_sorted = np.take_along_axis(chunks, new_order, axis=1)
+
+        order, sorted_chunks = [], []
+        for c in range(CHUNKS):
+            positions = np.searchsorted(self._sorted[c], new_sorted[c], side="right")
+            sorted_chunks.append(np.insert(self._sorted[c], positions, new_sorted[c]))
+            order.append(np.insert(self._order[c], positions, new_order[c] + offset))
+        self._order, self._sorted = np.array(order), np.array(sorted_chunks)
+
+    def _candidates(self, code: np.ndarray, flips: bool) -> np.ndarray:
+        """Rows that have a chunk of `code` (or with one bit flipped)."""
+
+        rows = []
+        for c, value in enumerate(get_chunks(code.reshape(1, 2))[0]):
+            values = np.array([value], dtype=np.uint16)
+            if flips:
+                values = np.concatenate(
+                    [values, value ^ (np.uint16(1) << np.arange(16, dtype=np.uint16))]
+                )
+            left = np.searchsorted(self._sorted[c], values, side="left")
+            right = np.searchsorted(self._sorted[c], values, side="right")
+            for start, end in zip(left.tolist(), right.tolist()):
+                if start < end:
+                    rows.append(self._order[c, start:end])
+
+        return np.unique(np.concatenate(rows)) if rows else np.array([], dtype=int)
+
+    def query(self, code: np.ndarray, k: int = K, exclude: str = None) -> list:
+        """The k icons nearest to `code`, as dicts with their distance."""
+
+        candidates = self._candidates(code, flips=True)
+        if exclude is not None:
+            candidates = candidates[self.ids[candidates] != exclude]
+        if len(candidates) < k:
+            candidates = np.flatnonzero(self.ids != exclude)
+
+        distances = hamming(self.codes[candidates], code)
+        nearest = np.argsort(distances, kind="stable")[:k]
+
+        return [
+            {
+                "id": str(self.ids[candidates[i]]),
+                "map": self.maps[self.shards[candidates[i]]],
+                "path": str(self.paths[candidates[i]]),
+                "distance": int(distances[i]),
+            }
+            for i in nearest
+        ]
+
+    def similar(self, icon_id: str, k: int = K) -> list:
+        """The k icons most like an icon in the index."""
+
+        rows = np.flatnonzero(self.ids == icon_id)
+        if not len(rows):
+            raise KeyError(f"{icon_id} is not in the index")
+        return self.query(self.codes[rows[0]], k, exclude=icon_id)
+
+
+def index_map(
+    index_folder: str,
+    cutout_folder: str,
+    annotation_page_path: str = None,
+    map_name: str = None,
+) -> int:
+    """Write (or replace) the shard of one map. Returns its number of icons."""
+
+    ids, paths, codes = read_cutouts(cutout_folder, annotation_page_path)
+    write_shard(
+        index_folder,
+        map_name or os.path.basename(os.path.normpath(cutout_folder)),
+        ids,
+        paths,
+        codes,
+    )
+    return len(ids)
+
+
+def print_results(results: list, seconds: float):
+    print(f"{len(results)} icons ({seconds * 1000:.1f} ms)")
+    for result in results:
+        print(f"  {result['distance']:>3}  {result['map']}/{result['path']}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = commands.add_parser("add", help="Index the cutouts of maps")
+    add_parser.add_argument("index", help="Index folder, e.g. " + INDEX)
+    add_parser.add_argument("cutout_folders", nargs="+", metavar="CUTOUT_FOLDER")
+    add_parser.add_argument(
+        "--annotation-page",
+        nargs="+",
+        default=[],
+        help="Per cutout folder, to leave out the icons filter_cutouts dropped",
+    )
+
+    query_parser = commands.add_parser("query", help="Icons like an image")
+    query_parser.add_argument("index")
+    query_parser.add_argument("image")
+    query_parser.add_argument("-k", type=int, default=K)
+
+    similar_parser = commands.add_parser("similar", help="Icons like an icon")
+    similar_parser.add_argument("index")
+    similar_parser.add_argument("icon_id")
+    similar_parser.add_argument("-k", type=int, default=K)
+
+    args = parser.parse_args()
+
+    if args.command == "add":
+        pages = args.annotation_page or [None] * len(args.cutout_folders)
+        if len(pages) != len(args.cutout_folders):
+            parser.error("Give an annotation page for every cutout folder")
+
+        for cutout_folder, page in zip(args.cutout_folders, pages):
+            n = index_map(args.index, cutout_folder, page)
+            print(f"Indexed {n} icons of {cutout_folder}")
+
+    else:
+        start = time.perf_counter()
+        index = IconIndex.load(args.index)
+        print(f"Loaded {len(index)} icons ({time.perf_counter() - start:.2f}s)")
+
+        start = time.perf_counter()
+        if args.command == "query":
+            with Image.open(args.image) as image:
+                results = index.query(get_code(image), args.k)
+        else:
+            results = index.similar(args.icon_id, args.k)
+        print_results(results, time.perf_counter() - start)
@@ -0,0 +1,179 @@
+"""
+Decoded-image cache shared by the processing stages.
+
+Every scan is decoded once into a raw .npy array file, keyed by the SHA-256
+of the image file. After that, spot_text and extract_snippets (and every
+worker process running them) open it with np.load(mmap_mode="r"): no JPEG
+decoding, no copy, and the OS page cache is shared between processes.
+segment_icons works on a PIL image, which can't map an RGB array, so
+open_image skips the decoding but still copies the scan into PIL's memory.
+
+When the cache grows over its disk budget, the least recently used entries
+are removed. The hash index and the eviction are guarded by a lock on
+cache.lock, shared by all processes using the folder.
+"""
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
+
+CACHE_FOLDER = "data/.cache/decoded"
+CACHE_BUDGET = "50G"
+
+
+def parse_size(size) -> int:
+    """Number of bytes in a size like 512M, 50G or 1.5T (plain numbers are bytes)."""
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "_KMGT".index(unit.upper() or "_"))
+
+
+class ImageCache:
+    def __init__(self, folder: str = CACHE_FOLDER, budget=CACHE_BUDGET):
+        self.folder = folder
+        self.budget = parse_size(budget)
+
+        os.makedirs(folder, exist_ok=True)
+
+        # Hashing a scan of hundreds of MB takes a while, so we remember the
+        # hash of every file by its path, size and modification time.
+        self._index_path = os.path.join(folder, "index.json")
+        self._lock_path = os.path.join(folder, "cache.lock")
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock of the whole cache (index.json and eviction)."""
+        with open(self._lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def file_hash(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        index_key = f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        index = self._read_index()
+        if index_key in index:
+            return index[index_key]
+
+        sha256 = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                sha256.update(chunk)
+
+        # Read again under the lock, so hashes other processes added are kept
+        with self._locked():
+            index = self._read_index()
+            index[index_key] = sha256.hexdigest()
+            self._write_index(index)
+
+        return index[index_key]
+
+    def path(self, image_path: str) -> str:
+        """Path of the decoded array of `image_path`, decoding it if needed."""
+
+        key = self.file_hash(image_path)
+        array_path = os.path.join(self.folder, f"{key}.npy")
+
+        with self._locked():
+            if os.path.exists(array_path):
+                os.utime(array_path)  # mark as recently used
+                return array_path
+
+        # Only one process decodes a scan, the others wait for it
+        with open(os.path.join(self.folder, f"{key}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if not os.path.exists(array_path):
+                print(f"Decoding {image_path} into the image cache")
+
+                with Image.open(image_path) as image:
+                    array = np.asarray(image.convert("RGB"))
+
+                fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, array_path)
+
+                del array
+                self.evict(keep=array_path)
+
+        return array_path
+
+    def open(self, image_path: str) -> np.ndarray:
+        """The decoded (height, width, 3) RGB array of `image_path`, mapped read-only."""
+
+        array_path = self.path(image_path)
+
+        # Mapped under the lock, so an eviction can't remove it in between;
+        # once mapped, removing the file does no harm
+        with self._locked():
+            if os.path.exists(array_path):
+                return np.load(array_path, mmap_mode="r")
+
+        return self.open(image_path)  # evicted meanwhile, decode it again
+
+    def open_image(self, image_path: str) -> Image.Image:
+        """
+        Same as Image.open(image_path).convert("RGB"), but without decoding.
+        The image is a copy of the mapped array in PIL's own memory.
+        """
+        return Image.fromarray(self.open(image_path))
+
+    def evict(self, keep: str = ""):
+        """Remove the least recently used arrays until the cache fits its budget."""
+
+        with self._locked():
+            self._evict(keep)
+
+    def _evict(self, keep: str):
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy"):
+                path = os.path.join(self.folder, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        # Processes that still have an evicted array mapped can keep using it
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+
+            os.remove(path)
+            lock_path = path[: -len(".npy")] + ".lock"
+            if os.path.exists(lock_path):
+                os.remove(lock_path)
+
+            total -= size
@@ -1,17 +1,81 @@
+"""
+Make the IIIF Manifest of the selected maps, with their georeferencing
+annotations from Allmaps. The navPlace features are derived from the
+georeferencing annotations locally (georeference.py), or fetched from
+Allmaps with --allmaps-navplace.
+
+The info.json of every image and the Allmaps annotations are fetched
+concurrently, through one pooled session with retries and an on-disk cache
+revalidated with ETag/Last-Modified (http_utils.py), so a rebuild with
+nothing changed upstream costs a 304 per request. benchmark_rebuild.py runs
+it against a local stand-in server.
+"""
+
 import os
 import json
 import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import pandas as pd
 import iiif_prezi3
 
+from http_utils import HTTPCache, make_session
+import georeference
+
 iiif_prezi3.config.configs["helpers.auto_fields.AutoLang"].auto_lang = "en"
 iiif_prezi3.load_bundled_extensions()
 
 PREFIX = "https://globalise-huygens.github.io/necessary-reunions/"
+ALLMAPS_ANNOTATIONS_URL = "https://annotations.allmaps.org/"
+
+MAX_WORKERS = 8  # concurrent requests to Allmaps and the image servers
+
+
+def get_info_json_url(iiif_info_url: str) -> str:
+    """The info.json URL iiif_prezi3's make_canvas_from_iiif requests."""
+
+    if iiif_info_url.endswith("info.json"):
+        return iiif_info_url
+    return f"{iiif_info_url.rstrip('/')}/info.json"
+
+
+def fetch_info_json(
+    iiif_info_urls, http: HTTPCache = None, max_workers: int = MAX_WORKERS
+) -> dict:
+    """
+    The body of the info.json of every image, by URL, fetched concurrently
+    with at most `max_workers` requests in flight.
+    """
+
+    http = http or HTTPCache(session=make_session(pool_size=max_workers))
+    urls = list(dict.fromkeys(get_info_json_url(url) for url in iiif_info_urls))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(urls, executor.map(http.get_text, urls)))
+
+
+class PrefetchedInfo:
+    """
+    Stands in for the requests session of make_canvas_from_iiif, answering
+    with the info.json bodies of fetch_info_json instead of fetching them
+    one at a time.
+    """
 
+    def __init__(self, bodies: dict):
+        self.bodies = bodies
 
-def make_manifest(df):
+    def get(self, url, **kwargs) -> requests.Response:
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response._content = self.bodies[url].encode("utf-8")
+        return response
+
+
+def make_manifest(df, info: PrefetchedInfo = None):
 
     manifest = iiif_prezi3.Manifest(
         id=f"{PREFIX}manifest.json",
@@ -31,6 +95,7 @@ def make_manifest(df):
 
         manifest.make_canvas_from_iiif(
             url=iiif_info_url,
+            iiif_session=info,
             id=canvas_id,
             anno_page_id=f"{PREFIX}manifest.json/{index}/p1/page",
             anno_id=f"{PREFIX}manifest.json/{index}/p1/page/anno",
@@ -55,22 +120,26 @@ def make_manifest(df):
 
 
 def get_georeferencing_annotations(
-    identifier, iiif_info_url, canvas_id, manifest, annotations_folder, embedded=False
+    identifier,
+    iiif_info_url,
+    canvas_id,
+    manifest,
+    annotations_folder,
+    embedded=False,
+    http: HTTPCache = None,
+    allmaps_url: str = ALLMAPS_ANNOTATIONS_URL,
 ):
 
     annotation_page_id = f"{PREFIX}annotations/georeferencing/{identifier}.json"
 
+    http = http or HTTPCache()
+
     try:
-        r = requests.get(
-            "https://annotations.allmaps.org/", params={"url": iiif_info_url}
-        )
-        r.raise_for_status()
+        ap = http.get_json(allmaps_url, params={"url": iiif_info_url})
     except requests.exceptions.RequestException as e:
         print(e)
         return
 
-    ap = r.json()
-
     # Change target from image to Canvas
     for item in ap["items"]:
         item["target"]["source"] = {
@@ -96,72 +165,250 @@ def get_georeferencing_annotations(
         return ap
 
 
-def get_navplace_feature(iiif_info_url):
+def get_navplace_feature(
+    iiif_info_url, http: HTTPCache = None, allmaps_url: str = ALLMAPS_ANNOTATIONS_URL
+):
 
     if iiif_info_url.endswith("/info.json"):
         iiif_info_url = iiif_info_url.replace("/info.json", "")
 
     allmaps_image_id = hashlib.sha1(iiif_info_url.encode()).hexdigest()[:16]
 
+    http = http or HTTPCache()
+
     try:
-        r = requests.get(
-            f"https://annotations.allmaps.org/images/{allmaps_image_id}.geojson"
+        feature_collection = http.get_json(
+            f"{allmaps_url}images/{allmaps_image_id}.geojson"
         )
-        r.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(e)
         return
 
-    feature_collection = r.json()
-
     for feature in feature_collection["features"]:
         del feature["properties"]
 
     return feature_collection
 
 
-def main(
-    selection_filepath="selectie.csv",
-    output_filepath="manifest.json",
-    annotations_folder="annotations/",
+def fetch_georeferencing(
+    df,
+    manifest,
+    annotations_folder,
     embedded=False,
+    http: HTTPCache = None,
+    allmaps_url: str = ALLMAPS_ANNOTATIONS_URL,
+    max_workers: int = MAX_WORKERS,
+    allmaps_navplace: bool = False,
 ):
+    """
+    Fetch the georeferencing annotations of all rows concurrently, with at
+    most `max_workers` requests in flight, and derive their navPlace features
+    (or fetch them too, with `allmaps_navplace`). Returns a list of
+    (canvas_id, annotation page, navPlace feature) in row order.
+    """
 
-    df = pd.read_csv(selection_filepath)
-
-    # First, make the manifest
-    manifest = make_manifest(df)
-
-    # Then, add georeferencing annotations and save the annotation pages
-    for i in df.itertuples():
-
-        identifier = i.index
-        iiif_info_url = i.iiif_info_url
-        canvas_id = i.iiif_canvas_id
+    http = http or HTTPCache(session=make_session(pool_size=max_workers))
 
+    def fetch(row):
         ap = get_georeferencing_annotations(
-            identifier,
-            iiif_info_url,
-            canvas_id,
+            row.index,
+            row.iiif_info_url,
+            row.iiif_canvas_id,
             manifest,
             annotations_folder,
             embedded=embedded,
+            http=http,
+            allmaps_url=allmaps_url,
         )
 
         if ap is None:
+            return row.iiif_canvas_id, None, None
+
+        if allmaps_navplace:
+            feature_collection = get_navplace_feature(
+                row.iiif_info_url, http=http, allmaps_url=allmaps_url
+            )
+        elif embedded:
+            feature_collection = georeference.get_navplace_feature(ap)
+        else:
+            with open(
+                os.path.join(annotations_folder, f"georeferencing/{row.index}.json")
+            ) as f:
+                feature_collection = georeference.get_navplace_feature(json.load(f))
+
+        # No mask to derive the footprint from, ask Allmaps
+        if not allmaps_navplace and not feature_collection["features"]:
+            feature_collection = get_navplace_feature(
+                row.iiif_info_url, http=http, allmaps_url=allmaps_url
+            )
+
+        return row.iiif_canvas_id, ap, feature_collection
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, df.itertuples()))
+
+
+def add_georeferencing(canvas, ap, feature_collection):
+
+    if not canvas.annotations:
+        canvas.annotations = []
+
+    canvas.annotations.append(ap)
+
+    if feature_collection:
+        canvas.navPlace = iiif_prezi3.NavPlace(**feature_collection)
+
+
+def iter_canvases_jsonld(df, georeferencing, info: PrefetchedInfo = None):
+    """
+    Make the canvases one at a time, each in a manifest of its own, and yield
+    them as JSON-LD. Only one canvas object is alive at any time.
+    """
+
+    for n, (_, ap, feature_collection) in enumerate(georeferencing):
+        manifest = make_manifest(df.iloc[[n]], info)
+
+        if ap is not None:
+            add_georeferencing(manifest.items[0], ap, feature_collection)
+
+        yield manifest.jsonld_dict()["items"][0]
+
+
+def merge_canvases(canvas_ids, previous_canvases: dict, new_canvases):
+    """
+    Yield the canvases in selection order: from the previous build when
+    unchanged, otherwise the next one of `new_canvases`.
+    """
+
+    for canvas_id in canvas_ids:
+        if canvas_id in previous_canvases:
+            yield previous_canvases[canvas_id]
+        else:
+            yield next(new_canvases)
+
+
+def dump_manifest(manifest_jsonld: dict, canvases, outfile, indent: int = 2):
+    """
+    Write `manifest_jsonld` exactly as json.dump(manifest_jsonld, outfile,
+    indent=indent) would, except that the items are taken from the `canvases`
+    iterable and encoded one at a time.
+    """
+
+    pad = " " * indent
+
+    def encode(value, level):
+        # Nested values are indented one level deeper by prefixing every line
+        return json.dumps(value, indent=indent).replace("\n", "\n" + pad * level)
+
+    outfile.write("{")
+
+    for n, (key, value) in enumerate(manifest_jsonld.items()):
+        outfile.write(("," if n else "") + "\n" + pad + json.dumps(key) + ": ")
+
+        if key != "items":
+            outfile.write(encode(value, 1))
             continue
 
-        navPlace = iiif_prezi3.NavPlace(**get_navplace_feature(iiif_info_url))
+        empty = True
+        for canvas in canvases:
+            outfile.write(("[" if empty else ",") + "\n" + pad * 2 + encode(canvas, 2))
+            empty = False
+
+        outfile.write("[]" if empty else "\n" + pad + "]")
+
+    outfile.write("\n}")
+
+
+def row_hash(row: dict, embedded: bool = False) -> str:
+    """Content hash of a selection row and the settings that shape its canvas."""
+
+    content = {"row": row, "embedded": embedded, "prefix": PREFIX}
 
-        for c in manifest.items:
-            if c.id == canvas_id:
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
 
-                if not c.annotations:
-                    c.annotations = []
 
-                c.annotations.append(ap)
+def load_previous_build(output_filepath: str, state_filepath: str, hashes: dict):
+    """
+    Return the canvases of the previous build (by canvas id) whose selection
+    row did not change since. Anything missing or unreadable means a full build.
+    """
 
-                c.navPlace = navPlace
+    try:
+        with open(output_filepath) as infile:
+            previous_manifest = json.load(infile)
+        with open(state_filepath) as infile:
+            previous_hashes = json.load(infile)["canvases"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+    return {
+        c["id"]: c
+        for c in previous_manifest.get("items", [])
+        if c["id"] in hashes and previous_hashes.get(c["id"]) == hashes[c["id"]]
+    }
+
+
+def main(
+    selection_filepath="selectie.csv",
+    output_filepath="manifest.json",
+    annotations_folder="annotations/",
+    embedded=False,
+    cache_folder="",
+    max_age=0,
+    max_workers=MAX_WORKERS,
+    allmaps_url=ALLMAPS_ANNOTATIONS_URL,
+    incremental=False,
+    state_filepath="",
+    streaming=False,
+    allmaps_navplace=False,
+):
+
+    df = pd.read_csv(selection_filepath)
+
+    http = HTTPCache(
+        cache_folder, session=make_session(pool_size=max_workers), max_age=max_age
+    )
+
+    state_filepath = state_filepath or f"{output_filepath}.state.json"
+    hashes = {
+        row["iiif_canvas_id"]: row_hash(row, embedded) for row in df.to_dict("records")
+    }
+
+    # In incremental mode, only rows that were added or changed are rebuilt
+    previous_canvases = {}
+    if incremental:
+        previous_canvases = load_previous_build(output_filepath, state_filepath, hashes)
+
+    df_changed = df[~df["iiif_canvas_id"].isin(previous_canvases.keys())]
+    print(f"Making {len(df_changed)}/{len(df)} canvases")
+
+    # First, make the manifest. When streaming, it stays empty and every canvas
+    # is made, serialized and written on its own.
+    info = PrefetchedInfo(
+        fetch_info_json(df_changed["iiif_info_url"], http, max_workers)
+    )
+    manifest = make_manifest(df.iloc[:0] if streaming else df_changed, info)
+
+    # Then, add georeferencing annotations and save the annotation pages
+    georeferencing = fetch_georeferencing(
+        df_changed,
+        manifest,
+        annotations_folder,
+        embedded=embedded,
+        http=http,
+        allmaps_url=allmaps_url,
+        max_workers=max_workers,
+        allmaps_navplace=allmaps_navplace,
+    )
+
+    if not streaming:
+        canvases = {c.id: c for c in manifest.items}
+
+        for canvas_id, ap, feature_collection in georeferencing:
+            if ap is not None:
+                add_georeferencing(canvases[canvas_id], ap, feature_collection)
 
     # Edit context
     manifest_jsonld = manifest.jsonld_dict()
@@ -170,16 +417,82 @@ def main(
         "http://iiif.io/api/presentation/3/context.json",
     ]
 
+    if streaming:
+        new_canvases = iter_canvases_jsonld(df_changed, georeferencing, info)
+    else:
+        new_canvases = iter(manifest_jsonld["items"])
+
+    # Put the new canvases and the ones from the previous build in selection order
+    canvases_jsonld = merge_canvases(
+        df["iiif_canvas_id"], previous_canvases, new_canvases
+    )
+
     # Save the manifest
     with open(output_filepath, "w") as outfile:
-        json.dump(manifest_jsonld, outfile, indent=2)
+        if streaming:
+            dump_manifest(manifest_jsonld, canvases_jsonld, outfile, indent=2)
+        else:
+            manifest_jsonld["items"] = list(canvases_jsonld)
+            json.dump(manifest_jsonld, outfile, indent=2)
+
+    # Save the content hashes, to compare against on the next incremental build
+    os.makedirs(os.path.dirname(state_filepath) or ".", exist_ok=True)
+    with open(state_filepath, "w") as outfile:
+        json.dump({"canvases": hashes}, outfile, indent=2)
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--selection", default="data/selection.csv")
+    parser.add_argument("--output", default="data/manifest.json")
+    parser.add_argument("--annotations", default="data/annotations/")
+    parser.add_argument(
+        "--cache-folder",
+        default="data/.cache/allmaps",
+        help="On-disk HTTP cache, revalidated with ETag/Last-Modified ('' to disable)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=0,
+        help="Use cached responses younger than this many seconds without revalidating",
+    )
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--allmaps-url", default=ALLMAPS_ANNOTATIONS_URL)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rebuild the canvases of rows that changed since the last build",
+    )
+    parser.add_argument(
+        "--state",
+        default="data/.cache/manifest.state.json",
+        help="Content hashes of the last build, used by --incremental",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Write the canvases one at a time instead of building the whole manifest",
+    )
+    parser.add_argument(
+        "--allmaps-navplace",
+        action="store_true",
+        help="Fetch the navPlace features from Allmaps instead of deriving them",
+    )
+    args = parser.parse_args()
+
     # One manifest with external (referenced) annotations
     main(
-        selection_filepath="data/selection.csv",
-        output_filepath="data/manifest.json",
-        annotations_folder="data/annotations/",
+        selection_filepath=args.selection,
+        output_filepath=args.output,
+        annotations_folder=args.annotations,
+        cache_folder=args.cache_folder,
+        max_age=args.max_age,
+        max_workers=args.max_workers,
+        allmaps_url=args.allmaps_url,
+        incremental=args.incremental,
+        state_filepath=args.state,
+        streaming=args.streaming,
+        allmaps_navplace=args.allmaps_navplace,
     )
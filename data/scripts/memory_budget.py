@@ -0,0 +1,187 @@
+"""
+Keep the pipeline within a memory budget (--memory-budget).
+
+Every task reserves what it is estimated to need before it starts, and
+waits while the tasks that are running hold too much of the budget. So the
+number of tasks that run at the same time follows the size of the maps,
+not just --max-workers: many small maps run side by side, the biggest scans
+run alone. A task that needs more than the whole budget waits until it is
+the only one.
+
+The estimates count 3 bytes per decoded pixel of the scan. For segment_icons,
+plan_segmentation leaves out the coarsest resized levels until the scan,
+the resized level and the masks of one window fit (see
+estimate_segmentation). With a budget, the pipeline decodes every scan once
+into the image cache (image_cache.py), so extract_snippets only reads the
+regions around the snippets from the memory-mapped array and spot_text
+doesn't decode the JPEG again.
+
+RSSMonitor samples the resident memory of the whole process while a task
+runs. The stages run in threads of one process, so that is not the memory
+of the task itself: the peak includes whatever ran alongside, and is only
+reported as the process peak during the stage, against the budget.
+"""
+
+import os
+import sys
+import resource
+import threading
+import contextlib
+
+from PIL import Image
+
+from image_cache import parse_size
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
+
+BYTES_PER_PIXEL = 3  # RGB
+SAMPLE_INTERVAL = 0.05  # seconds between RSS samples
+
+# Bytes per pixel of the original resolution region of a segmentation window
+# in process_image: the upscaled mask, its RLE copy and decoded copy
+WINDOW_BYTES_PER_PIXEL = 3
+
+# When the size of a scan isn't known yet (before it is downloaded)
+DEFAULT_PIXELS = 250_000_000  # about the largest scan in the selection
+
+JSON_BYTES_FACTOR = 10  # parsed JSON takes about this many times its file size
+
+
+def get_rss() -> int:
+    """The resident memory of this process, in bytes."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux: the peak so far, in bytes on macOS and kB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RSSMonitor:
+    """
+    Context manager that samples the RSS of the process in a thread, for
+    the peak while it was active (of everything in the process, not only
+    the code in the block):
+
+        with RSSMonitor() as monitor:
+            ...
+        print(monitor.peak)
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def __enter__(self):
+        self.peak = get_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_rss())
+
+
+class MemoryBudget:
+    def __init__(self, budget):
+        self.budget = parse_size(budget)
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes: int):
+        """Hold `nbytes` of the budget, once they are free, while in the block."""
+
+        # More than the whole budget: wait until nothing else runs
+        nbytes = min(nbytes, self.budget)
+
+        with self._condition:
+            self._condition.wait_for(lambda: self.reserved + nbytes <= self.budget)
+            self.reserved += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= nbytes
+                self._condition.notify_all()
+
+
+def get_image_size(image_path: str):
+    """(width, height) of a scan, from its header (nothing is decoded)."""
+    with Image.open(image_path) as image:
+        return image.size
+
+
+def get_resize_factors(
+    width: int, height: int, window_size: int, resize_factor: int = 2
+) -> list:
+    """The factors segment_icons.get_resized_images resizes a scan with."""
+
+    width -= width % resize_factor
+    height -= height % resize_factor
+    f_min = min(window_size / width, window_size / height)
+
+    factors = []
+    resized_width, resized_height = width, height
+    while resized_width > window_size or resized_height > window_size:
+        f = max(f_min, resize_factor ** -len(factors))
+        factors.append(f)
+        resized_width, resized_height = int(width * f), int(height * f)
+
+    return factors
+
+
+def estimate_segmentation(
+    width: int, height: int, window_size: int, max_levels: int = None
+) -> int:
+    """
+    Peak bytes of segment_icons for one scan: the scan, the resized level
+    that is cut into windows and the masks of one window. A window of a
+    level with factor f covers window_size / f pixels of the scan, at the
+    coarsest level (nearly) all of it.
+    """
+
+    peak = 0
+    for f in get_resize_factors(width, height, window_size)[:max_levels]:
+        level = int(width * f) * int(height * f) * BYTES_PER_PIXEL
+        region = min(window_size / f, width) * min(window_size / f, height)
+        peak = max(peak, level + region * WINDOW_BYTES_PER_PIXEL)
+
+    return width * height * BYTES_PER_PIXEL + int(peak)
+
+
+def plan_segmentation(width: int, height: int, window_size: int, budget: int):
+    """
+    The number of resized levels (None for all of them) segment_icons can
+    process within `budget` bytes, and its estimated peak. Levels are left
+    out from the coarsest one, which finds the largest icons; at least the
+    full resolution is always processed.
+    """
+
+    n_levels = len(get_resize_factors(width, height, window_size))
+
+    for max_levels in range(n_levels, 0, -1):
+        peak = estimate_segmentation(width, height, window_size, max_levels)
+        if peak <= budget:
+            return (None if max_levels == n_levels else max_levels), peak
+
+    # Not even the full resolution fits (or the scan is smaller than a window)
+    return (1 if n_levels else None), estimate_segmentation(
+        width, height, window_size, 1
+    )
+
+
+def format_size(nbytes: int) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if abs(nbytes) < 1024 or unit == "G":
+            return f"{nbytes:.0f}{unit}" if unit == "B" else f"{nbytes:.1f}{unit}"
+        nbytes /= 1024
@@ -0,0 +1,141 @@
+"""
+One command line for the data scripts:
+
+    python data/scripts/neru.py <command> [arguments of its script]
+    python data/scripts/neru.py segment --help
+
+A command runs its script as if it was started by itself, and only imports
+that script. The scripts import their heavy libraries where they are used,
+so a command only loads the libraries it needs: filter-cutouts, store or
+queue start without torch, sam2 or mapreader.
+
+    python data/scripts/neru.py import-times
+
+starts a fresh interpreter for every command and prints how long importing
+its script takes, to check that a command doesn't pull in more than it
+needs.
+"""
+
+import os
+import sys
+import runpy
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter by import-times, with the script as argument
+IMPORT_TIME = """
+import os, sys, time, runpy
+sys.path[:0] = [os.path.dirname(sys.argv[1]), sys.argv[2]]
+start = time.perf_counter()
+runpy.run_path(sys.argv[1], run_name="__import_time__")
+print(time.perf_counter() - start)
+"""
+
+
+class Command:
+    def __init__(self, script, help, run=None):
+        self.script = script  # relative to this folder
+        self.help = help
+        self.run = run  # run(argv), instead of the script's own command line
+
+    @property
+    def path(self) -> str:
+        return os.path.join(HERE, self.script)
+
+
+def run_script(path: str, argv: list):
+    """Run a script as __main__, with its folder on the path like python does."""
+
+    sys.path[:0] = [os.path.dirname(path), HERE]
+    sys.argv = [path, *argv]
+    runpy.run_path(path, run_name="__main__")
+
+
+def filter_cutouts(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="neru.py filter-cutouts",
+        description="Filter the cutouts of earlier segment_icons runs again",
+    )
+    parser.add_argument("output_folder", help="The output_folder of segment_icons")
+    parser.add_argument("annotation_folder")
+    args = parser.parse_args(argv)
+
+    sys.path.append(os.path.join(HERE, "segmentation"))
+    from segment_icons import filter_outputs
+
+    os.makedirs(args.annotation_folder, exist_ok=True)
+    filter_outputs(args.output_folder, args.annotation_folder)
+
+
+def measure_import_time(command: Command) -> str:
+    process = subprocess.run(
+        [sys.executable, "-c", IMPORT_TIME, command.path, HERE],
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode:
+        return process.stderr.strip().splitlines()[-1]
+    return f"{float(process.stdout):.3f}s"
+
+
+def print_import_times(argv: list):
+    for name, command in COMMANDS.items():
+        if command.script:
+            print(f"{name:<16} {measure_import_time(command)}")
+
+
+COMMANDS = {
+    "download": Command("download_images.py", "Download the scans"),
+    "segment": Command("segmentation/segment_icons.py", "Segment the icons"),
+    "autotune": Command(
+        "segmentation/autotune_segmentation.py", "Tune the segmentation windows"
+    ),
+    "labels": Command("segmentation/label_raster.py", "Look up icons in label rasters"),
+    "filter-cutouts": Command(
+        "segmentation/segment_icons.py",
+        "Filter earlier segmentation results again",
+        run=filter_cutouts,
+    ),
+    "spot": Command("textspotting/spot_text.py", "Spot the text on a map"),
+    "snippets": Command(
+        "textspotting/extract_snippets.py", "Cut out the spotted text for Loghi"
+    ),
+    "integrate": Command(
+        "textspotting/integrate_htr_results.py", "Add the HTR results"
+    ),
+    "canvas-ids": Command("update_canvas_ids.py", "Point annotations to canvases"),
+    "manifest": Command("make_manifest.py", "Make the IIIF Manifest"),
+    "tiles": Command("annotation_tiles.py", "Split annotations into tiles"),
+    "icons": Command("icon_index.py", "Find icons that look alike"),
+    "georeference": Command("georeference.py", "Project annotations to GeoJSON"),
+    "store": Command("annotation_store.py", "Query the annotation store"),
+    "upload": Command("annorepo_client.py", "Upload annotations to AnnoRepo"),
+    "sync": Command("annorepo_sync.py", "Sync annotations with AnnoRepo"),
+    "pipeline": Command("pipeline.py", "Run all stages for every map"),
+    "queue": Command("work_queue.py", "Share the pipeline between machines"),
+    "benchmark": Command("benchmark_pipeline.py", "Benchmark the pipeline"),
+    "import-times": Command(
+        None, "Time the imports of every command", run=print_import_times
+    ),
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Commands:\n"
+        + "\n".join(f"  {name:<16} {c.help}" for name, c in COMMANDS.items()),
+    )
+    parser.add_argument("command", choices=list(COMMANDS), metavar="COMMAND")
+    parser.add_argument("argv", nargs=argparse.REMAINDER, metavar="...")
+    args = parser.parse_args()
+
+    command = COMMANDS[args.command]
+    if command.run is not None:
+        command.run(args.argv)
+    else:
+        run_script(command.path, args.argv)
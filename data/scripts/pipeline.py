@@ -0,0 +1,882 @@
+"""
+Run the processing stages of every selected map as one pipeline:
+
+    download ─┬─ segment ─┬───────────────────────────────────────┬─ tiles
+              │           ├─ icons                                ├─ geo
+              │           ├─ labels                               │
+              └─ spot ── snippets ── htr ── integrate ── canvas ──┘
+
+Each stage of each map is a task. A task is skipped when its key, a hash of
+the outputs of the stages it depends on, its parameters and the code of its
+script, is the same as in the previous run and its output is unchanged on
+disk. So after a change only the affected stages of the affected maps run
+again. Independent tasks run in parallel (--max-workers), with at most
+--gpu-workers running segment_icons or spot_text at the same time.
+
+With --memory-budget, a task only starts when its estimated memory fits
+next to the tasks that run, segment_icons leaves out resized levels of
+scans too large for the budget, and the scans are decoded once into an
+image cache (see memory_budget.py). At the end, the peak RSS of the
+process while each stage ran is printed. The stages run in threads of this
+process, so the peak of a stage includes the tasks that ran alongside it.
+
+The HTR stage runs Loghi through --htr-command, a shell command with
+{lines} (the lines.txt of the snippets) and {results} (the TSV to write)
+placeholders. Without it, the results are expected at work/htr/<map>.tsv,
+and the maps without them wait there until the next run. Likewise, the geo
+stage waits for maps that have no georeferencing annotations (found by
+canvas id in --georeferencing) yet.
+
+All outputs go into the work folder:
+
+    images/<map>.jpg                     download_images.py
+    segmentation/annotations/<map>.json  segmentation/segment_icons.py
+    textspotting/<map>.json              textspotting/spot_text.py
+    snippets/<map>/lines.txt             textspotting/extract_snippets.py
+    htr/<map>.tsv                        Loghi
+    htr-annotations/<map>.json           textspotting/integrate_htr_results.py
+    annotations/<map>.json               update_canvas_ids.py
+    tiles/<map>/index.json               annotation_tiles.py
+    icons/<map>.npz                      icon_index.py
+    geo/<map>.geojson                    georeference.py
+    labels/<map>.labels                  segmentation/label_raster.py
+
+Stages that are left out with --stages use the outputs of their previous run.
+"""
+
+import os
+import sys
+import glob
+import json
+import shlex
+import shutil
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.extend(
+    [HERE, os.path.join(HERE, "textspotting"), os.path.join(HERE, "segmentation")]
+)
+
+WORK_FOLDER = "data/.cache/pipeline"
+MAX_WORKERS = 4  # tasks at the same time
+GPU_WORKERS = 1  # of which segment/spot tasks
+
+OUTPUTS = {
+    "download": "images/{name}.{format}",
+    "segment": "segmentation/annotations/{name}.json",
+    "spot": "textspotting/{name}.json",
+    "snippets": "snippets/{name}/lines.txt",
+    "htr": "htr/{name}.tsv",
+    "integrate": "htr-annotations/{name}.json",
+    "canvas": "annotations/{name}.json",
+    "tiles": "tiles/{name}/index.json",
+    "icons": "icons/{name}.npz",
+    "geo": "geo/{name}.geojson",
+    "labels": "labels/{name}.labels",
+}
+
+
+class Waiting(Exception):
+    """The input of a stage is not there yet (e.g. HTR results made by hand)."""
+
+
+class Stage:
+    def __init__(
+        self, name, run, deps=(), code=(), params=None, gpu=False, memory=None
+    ):
+        self.name = name
+        self.run = run  # run(pipeline, map) writes pipeline.output(name, map)
+        self.deps = deps
+        self.code = code  # scripts, relative to this folder, that invalidate the stage
+        self.params = params or (lambda pipeline, m: {})
+        self.gpu = gpu
+        # memory(pipeline, map) estimates the peak bytes (see memory_budget.py)
+        self.memory = memory or (lambda pipeline, m: 0)
+
+
+def run_download(pipeline, m):
+    from download_images import download_maps
+
+    download_maps(
+        [(m["name"], m["url"])],
+        os.path.dirname(pipeline.output("download", m)),
+        max_workers=pipeline.options["download_workers"],
+        output_format=pipeline.options["format"],
+    )
+
+    # download_maps reports failures instead of raising
+    if not os.path.exists(pipeline.output("download", m)):
+        raise RuntimeError(f"Download of {m['name']} failed")
+
+
+def run_segment(pipeline, m):
+    import segment_icons
+
+    annotation_folder = os.path.dirname(pipeline.output("segment", m))
+    cutout_folder = os.path.join(pipeline.work_folder, "segmentation", "cutouts")
+    shutil.rmtree(os.path.join(cutout_folder, m["name"]), ignore_errors=True)
+    os.makedirs(annotation_folder, exist_ok=True)
+
+    segment_icons.main(
+        [pipeline.output("download", m)],
+        output_folder=cutout_folder,
+        annotation_output_folder=annotation_folder,
+        window_size=pipeline.options["window_size"],
+        step_size=pipeline.options["step_size"],
+        model=pipeline.options["sam_model"],
+        model_type=pipeline.options["sam_config"],
+        image_cache=pipeline.image_cache,
+        max_levels=pipeline.segmentation_plan(m)[0],
+    )
+
+
+def run_spot(pipeline, m):
+    import spot_text
+
+    # The model files are relative to the working directory by default
+    spot_text.cfg_file = pipeline.options["spot_config"]
+    spot_text.weights_file = pipeline.options["spot_weights"]
+
+    predictions_df = spot_text.recognize_text(
+        pipeline.output("download", m), image_cache=pipeline.image_cache
+    )
+    predictions_df = spot_text.suppress_duplicates(predictions_df)
+    annotation_page = spot_text.convert_to_annotations(
+        predictions_df, f"canvas:{m['name']}"
+    )
+
+    write_json(pipeline.output("spot", m), annotation_page)
+
+
+def run_snippets(pipeline, m):
+    from extract_snippets import extract_snippets
+
+    # Snippets are named after the annotation ids, so old ones would linger
+    snippet_folder = os.path.dirname(pipeline.output("snippets", m))
+    shutil.rmtree(snippet_folder, ignore_errors=True)
+
+    extract_snippets(
+        pipeline.output("download", m),
+        pipeline.output("spot", m),
+        os.path.dirname(snippet_folder),
+        image_cache=pipeline.image_cache,
+    )
+
+
+def run_htr(pipeline, m):
+    results_path = pipeline.output("htr", m)
+    command = pipeline.options["htr_command"]
+
+    if not command:
+        if not os.path.exists(results_path):
+            raise Waiting(f"No HTR results at {results_path}")
+        return
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    subprocess.run(
+        command.format(
+            lines=shlex.quote(os.path.abspath(pipeline.output("snippets", m))),
+            results=shlex.quote(os.path.abspath(results_path)),
+        ),
+        shell=True,
+        check=True,
+    )
+
+
+def htr_params(pipeline, m):
+    command = pipeline.options["htr_command"]
+    if command:
+        return {"command": command}
+
+    # Results made outside of the pipeline are an input, not an output
+    results_path = pipeline.output("htr", m)
+    return {
+        "results": (
+            pipeline.hash_file(results_path) if os.path.exists(results_path) else None
+        )
+    }
+
+
+def run_integrate(pipeline, m):
+    from integrate_htr_results import integrate_htr_results
+
+    output_path = pipeline.output("integrate", m)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    # The groups of near-identical snippets that share a transcription
+    groups_path = os.path.join(
+        os.path.dirname(pipeline.output("snippets", m)), "groups.json"
+    )
+
+    integrate_htr_results(
+        pipeline.output("spot", m),
+        pipeline.output("htr", m),
+        output_path,
+        groups_path=groups_path,
+    )
+
+
+def run_canvas(pipeline, m):
+    from update_canvas_ids import update_annotation_page
+
+    canvas_id = pipeline.canvas_ids().get(m["name"])
+    if canvas_id is None:
+        raise Waiting(f"{m['name']} is not in {pipeline.options['manifest']}")
+
+    output_path = pipeline.output("canvas", m)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    shutil.copyfile(pipeline.output("integrate", m), output_path + ".tmp")
+    update_annotation_page(output_path + ".tmp", canvas_id)
+    os.replace(output_path + ".tmp", output_path)
+
+
+def run_tiles(pipeline, m):
+    from annotation_tiles import write_tiles, get_canvas_sizes
+
+    canvas_id = pipeline.canvas_ids().get(m["name"])
+    if canvas_id is None:
+        raise Waiting(f"{m['name']} is not in {pipeline.options['manifest']}")
+
+    write_tiles(
+        [pipeline.output("segment", m), pipeline.output("canvas", m)],
+        os.path.dirname(pipeline.output("tiles", m)),
+        get_canvas_sizes(pipeline.options["manifest"]),
+        canvas=canvas_id,
+    )
+
+
+def run_icons(pipeline, m):
+    from icon_index import index_map
+
+    # The shards of all maps in the icons folder make up the index
+    index_map(
+        os.path.dirname(pipeline.output("icons", m)),
+        os.path.join(pipeline.work_folder, "segmentation", "cutouts", m["name"]),
+        annotation_page_path=pipeline.output("segment", m),
+        map_name=m["name"],
+    )
+
+
+def run_geo(pipeline, m):
+    from georeference import georeference_pages
+
+    georeferencing_page_path = pipeline.georeferencing_page(m)
+    if georeferencing_page_path is None:
+        raise Waiting(f"{m['name']} has no georeferencing annotations")
+
+    feature_collection = georeference_pages(
+        georeferencing_page_path,
+        [pipeline.output("segment", m), pipeline.output("canvas", m)],
+    )
+    write_json(pipeline.output("geo", m), feature_collection)
+
+
+def raw_segmentation(pipeline, m) -> str:
+    """The JSON of segment_icons with the masks of all cutouts, before filtering."""
+    return os.path.join(
+        pipeline.work_folder, "segmentation", "cutouts", m["name"], f"{m['name']}.json"
+    )
+
+
+def run_labels(pipeline, m):
+    from label_raster import build_label_raster
+
+    build_label_raster(
+        raw_segmentation(pipeline, m),
+        pipeline.output("segment", m),
+        pipeline.output("labels", m),
+        scale=pipeline.options["label_scale"],
+    )
+
+
+def labels_memory(pipeline, m):
+    from memory_budget import JSON_BYTES_FACTOR
+
+    # The raster (uint16) and the masks of segment_icons
+    pixels = pipeline.image_pixels(m) * pipeline.options["label_scale"] ** 2
+    path = raw_segmentation(pipeline, m)
+    return int(2 * pixels) + (
+        JSON_BYTES_FACTOR * os.path.getsize(path) if os.path.exists(path) else 0
+    )
+
+
+def geo_params(pipeline, m):
+    # A map is georeferenced again when its control points change
+    path = pipeline.georeferencing_page(m)
+    return {"georeferencing": pipeline.hash_file(path) if path else None}
+
+
+def json_memory(*stage_names):
+    """Memory estimate of a stage that parses the JSON outputs of others."""
+
+    def memory(pipeline, m):
+        from memory_budget import JSON_BYTES_FACTOR
+
+        paths = [pipeline.output(name, m) for name in stage_names]
+        return JSON_BYTES_FACTOR * sum(
+            os.path.getsize(path) for path in paths if os.path.exists(path)
+        )
+
+    return memory
+
+
+def snippets_memory(pipeline, m):
+    # From the image cache, only the regions around the snippets are read
+    if pipeline.image_cache is not None:
+        return json_memory("spot")(pipeline, m)
+    return pipeline.image_bytes(m)
+
+
+STAGES = [
+    Stage(
+        "download",
+        run_download,
+        code=("download_images.py", "pyramid.py"),
+        params=lambda p, m: {"url": m["url"], "format": p.options["format"]},
+        # The stitched scan and its JPEG or pyramid levels
+        memory=lambda p, m: p.image_bytes(m) * 3 // 2,
+    ),
+    Stage(
+        "segment",
+        run_segment,
+        deps=("download",),
+        code=("segmentation/segment_icons.py",),
+        params=lambda p, m: {
+            "window_size": p.options["window_size"],
+            "step_size": p.options["step_size"],
+            "model": p.hash_file(p.options["sam_model"]),
+            "config": p.options["sam_config"],
+            "max_levels": p.segmentation_plan(m)[0],
+        },
+        gpu=True,
+        memory=lambda p, m: p.segmentation_plan(m)[1],
+    ),
+    Stage(
+        "spot",
+        run_spot,
+        deps=("download",),
+        code=("textspotting/spot_text.py",),
+        params=lambda p, m: {
+            "config": p.hash_file(p.options["spot_config"]),
+            "weights": p.hash_file(p.options["spot_weights"]),
+        },
+        gpu=True,
+        memory=lambda p, m: p.image_bytes(m),
+    ),
+    Stage(
+        "snippets",
+        run_snippets,
+        deps=("download", "spot"),
+        code=("textspotting/extract_snippets.py", "textspotting/dedup_snippets.py"),
+        memory=snippets_memory,
+    ),
+    # Loghi runs in a process of its own
+    Stage("htr", run_htr, deps=("snippets",), params=htr_params),
+    Stage(
+        "integrate",
+        run_integrate,
+        deps=("spot", "snippets", "htr"),
+        code=(
+            "textspotting/integrate_htr_results.py",
+            "textspotting/dedup_snippets.py",
+        ),
+        memory=json_memory("spot"),
+    ),
+    Stage(
+        "canvas",
+        run_canvas,
+        deps=("integrate",),
+        code=("update_canvas_ids.py",),
+        params=lambda p, m: {"canvas_id": p.canvas_ids().get(m["name"])},
+    ),
+    Stage(
+        "tiles",
+        run_tiles,
+        deps=("segment", "canvas"),
+        code=("annotation_tiles.py", "annotation_store.py"),
+        params=lambda p, m: {"canvas_id": p.canvas_ids().get(m["name"])},
+        memory=json_memory("segment", "canvas"),
+    ),
+    Stage("icons", run_icons, deps=("segment",), code=("icon_index.py",)),
+    Stage(
+        "geo",
+        run_geo,
+        deps=("segment", "canvas"),
+        code=("georeference.py",),
+        params=geo_params,
+        memory=json_memory("segment", "canvas"),
+    ),
+    Stage(
+        "labels",
+        run_labels,
+        deps=("segment",),
+        code=("segmentation/label_raster.py",),
+        params=lambda p, m: {"scale": p.options["label_scale"]},
+        memory=labels_memory,
+    ),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def write_json(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class Pipeline:
+    def __init__(
+        self,
+        work_folder: str = WORK_FOLDER,
+        image_cache=None,
+        memory_budget=None,
+        **options,
+    ):
+        self.work_folder = work_folder
+        self.image_cache = image_cache
+        self.memory_budget = memory_budget  # a memory_budget.MemoryBudget
+        self.options = options
+        # (map name, stage name) -> peak process RSS during its last run
+        self.peak_rss = {}
+
+        self.state_folder = os.path.join(work_folder, ".pipeline")
+        os.makedirs(self.state_folder, exist_ok=True)
+
+        # One lock for the state files and the hash memo, shared by all tasks
+        self._lock = threading.Lock()
+        self._hashes_path = os.path.join(self.state_folder, "hashes.json")
+        self._hashes = read_json(self._hashes_path, {})
+        self._canvas_ids = None
+        self._georeferencing_pages = None
+
+    def output(self, stage_name: str, m: dict) -> str:
+        return os.path.join(
+            self.work_folder,
+            OUTPUTS[stage_name].format(name=m["name"], format=self.options["format"]),
+        )
+
+    def canvas_ids(self) -> dict:
+        if self._canvas_ids is None:
+            from update_canvas_ids import get_canvas_ids
+
+            self._canvas_ids = get_canvas_ids(self.options["manifest"])
+        return self._canvas_ids
+
+    def georeferencing_page(self, m: dict) -> str:
+        """The georeferencing AnnotationPage of a map, or None."""
+
+        if self._georeferencing_pages is None:
+            pages = {}
+            folder = self.options["georeferencing"]
+            for path in sorted(glob.glob(os.path.join(folder, "*.json"))):
+                items = read_json(path, {}).get("items") or [{}]
+                pages[items[0].get("target", {}).get("source", {}).get("id")] = path
+            self._georeferencing_pages = pages
+
+        return self._georeferencing_pages.get(self.canvas_ids().get(m["name"]))
+
+    def image_pixels(self, m: dict) -> int:
+        """Pixels of the scan of a map, or a guess before it is downloaded."""
+
+        from memory_budget import DEFAULT_PIXELS, get_image_size
+
+        path = self.output("download", m)
+        if not os.path.exists(path):
+            return DEFAULT_PIXELS
+        width, height = get_image_size(path)
+        return width * height
+
+    def image_bytes(self, m: dict) -> int:
+        from memory_budget import BYTES_PER_PIXEL
+
+        return self.image_pixels(m) * BYTES_PER_PIXEL
+
+    def segmentation_plan(self, m: dict) -> tuple:
+        """
+        (max_levels, estimated peak bytes) of segment_icons for a map: all
+        levels without a budget, or before the scan is downloaded.
+        """
+
+        from memory_budget import get_image_size, plan_segmentation
+
+        path = self.output("download", m)
+        if not os.path.exists(path):
+            return None, self.image_bytes(m)
+
+        width, height = get_image_size(path)
+        budget = self.memory_budget.budget if self.memory_budget else float("inf")
+        return plan_segmentation(width, height, self.options["window_size"], budget)
+
+    def hash_file(self, path: str) -> str:
+        """SHA-256 of a file, remembered by its path, size and modification time."""
+
+        stat = os.stat(path)
+        memo_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        with self._lock:
+            if memo_key in self._hashes:
+                return self._hashes[memo_key]
+
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                sha256.update(chunk)
+
+        with self._lock:
+            self._hashes[memo_key] = sha256.hexdigest()
+        return sha256.hexdigest()
+
+    def _state_path(self, m: dict) -> str:
+        return os.path.join(self.state_folder, f"{m['name']}.json")
+
+    def get_record(self, m: dict, stage_name: str) -> dict:
+        with self._lock:
+            return read_json(self._state_path(m), {}).get(stage_name)
+
+    def set_record(self, m: dict, stage_name: str, record: dict):
+        with self._lock:
+            state = read_json(self._state_path(m), {})
+            state[stage_name] = record
+            write_json(self._state_path(m), state)
+            write_json(self._hashes_path, self._hashes)
+
+    def task_key(self, stage: Stage, m: dict) -> str:
+        inputs = {
+            "stage": stage.name,
+            "params": stage.params(self, m),
+            "code": [self.hash_file(os.path.join(HERE, path)) for path in stage.code],
+            "deps": {},
+        }
+        for dep in stage.deps:
+            record = self.get_record(m, dep)
+            if record is None:
+                raise Waiting(f"The {dep} stage has not run yet")
+            inputs["deps"][dep] = record["output"]
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def run_task(self, stage: Stage, m: dict, gpu_slots: threading.Semaphore) -> str:
+        """Run one stage for one map, unless it is up to date. Returns "ran" or "cached"."""
+
+        key = self.task_key(stage, m)
+        output_path = self.output(stage.name, m)
+
+        record = self.get_record(m, stage.name)
+        if (
+            record
+            and record["key"] == key
+            and os.path.exists(output_path)
+            and self.hash_file(output_path) == record["output"]
+        ):
+            return "cached"
+
+        from memory_budget import RSSMonitor
+
+        print(f"Running {stage.name} for {m['name']}")
+        with gpu_slots if stage.gpu else contextlib.nullcontext():
+            with (
+                self.memory_budget.reserve(stage.memory(self, m))
+                if self.memory_budget
+                else contextlib.nullcontext()
+            ):
+                with RSSMonitor() as monitor:
+                    stage.run(self, m)
+
+        self.peak_rss[(m["name"], stage.name)] = monitor.peak
+        self.set_record(
+            m,
+            stage.name,
+            {
+                "key": key,
+                "output": self.hash_file(output_path),
+                "peak_rss": monitor.peak,
+            },
+        )
+        return "ran"
+
+    def run(
+        self,
+        maps: list,
+        stage_names: list,
+        max_workers: int = MAX_WORKERS,
+        gpu_workers: int = GPU_WORKERS,
+        on_task=None,
+    ) -> dict:
+        """
+        Run the selected stages for all maps. Returns the status of every
+        (map, stage) task, and calls on_task(map, stage name, status, seconds)
+        when a task is finished.
+        """
+
+        stages = [stage for stage in STAGES if stage.name in stage_names]
+        gpu_slots = threading.Semaphore(gpu_workers)
+
+        pending = [(m, stage) for m in maps for stage in stages]
+        status = {}  # (map name, stage name) -> ran, cached, waiting, failed or blocked
+
+        # (map name, stage name) -> time.monotonic() at the start of the task
+        started = {}
+
+        def run_timed_task(stage, m):
+            started[(m["name"], stage.name)] = time.monotonic()
+            return self.run_task(stage, m, gpu_slots)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            while pending or running:
+                for m, stage in list(pending):
+                    # Dependencies that were left out count as done (see task_key)
+                    deps = [
+                        status.get((m["name"], dep)) if dep in stage_names else "cached"
+                        for dep in stage.deps
+                    ]
+
+                    if any(s in ("waiting", "failed", "blocked") for s in deps):
+                        status[(m["name"], stage.name)] = "blocked"
+                        pending.remove((m, stage))
+                    elif all(s in ("ran", "cached") for s in deps):
+                        future = executor.submit(run_timed_task, stage, m)
+                        running[future] = (m, stage)
+                        pending.remove((m, stage))
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    m, stage = running.pop(future)
+                    try:
+                        status[(m["name"], stage.name)] = future.result()
+                    except Waiting as e:
+                        print(f"{m['name']} waits at {stage.name}: {e}")
+                        status[(m["name"], stage.name)] = "waiting"
+                    except Exception as e:
+                        print(f"{stage.name} failed for {m['name']}: {e!r}")
+                        status[(m["name"], stage.name)] = "failed"
+
+                    if on_task is not None:
+                        key = (m["name"], stage.name)
+                        on_task(
+                            m, stage.name, status[key], time.monotonic() - started[key]
+                        )
+
+        return status
+
+
+def load_maps(
+    csv_file: str,
+    name_column: str = "file_name",
+    url_column: str = "iiif_info_url",
+    only: list = None,
+) -> list:
+    import pandas as pd  # not needed by work_queue.py status
+
+    df = pd.read_csv(csv_file)
+    return [
+        {"name": name, "url": url}
+        for name, url in zip(df[name_column], df[url_column])
+        if not only or name in only
+    ]
+
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser):
+    """The options of a Pipeline and its stages, shared with work_queue.py."""
+
+    parser.add_argument("--work-folder", default=WORK_FOLDER)
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--gpu-workers", type=int, default=GPU_WORKERS)
+    parser.add_argument(
+        "--image-cache",
+        metavar="FOLDER",
+        default="",
+        help="Decode every map once into this cache (see image_cache.py)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        metavar="SIZE",
+        default="",
+        help="e.g. 32G: run tasks, and segment, within it (see memory_budget.py)",
+    )
+    parser.add_argument("--manifest", default="data/manifest.json")
+    parser.add_argument(
+        "--georeferencing",
+        default="data/annotations/georeferencing",
+        help="The georeferencing AnnotationPages of make_manifest.py",
+    )
+    parser.add_argument("--format", choices=["jpg", "tif"], default="jpg")
+    parser.add_argument("--download-workers", type=int, default=16)
+    parser.add_argument("--window-size", type=int, default=1000)
+    parser.add_argument("--step-size", type=int, default=750)
+    parser.add_argument(
+        "--label-scale",
+        type=float,
+        default=1.0,
+        help="Resolution of the icon label rasters, relative to the scans",
+    )
+    parser.add_argument(
+        "--sam-model",
+        default=os.path.join(HERE, "segmentation", "model", "sam2.1_hiera_large.pt"),
+    )
+    parser.add_argument("--sam-config", default="configs/sam2.1/sam2.1_hiera_l.yaml")
+    parser.add_argument(
+        "--spot-config",
+        default=os.path.join(
+            HERE,
+            "textspotting",
+            "MapTextPipeline/configs/ViTAEv2_S/rumsey/final_rumsey.yaml",
+        ),
+    )
+    parser.add_argument(
+        "--spot-weights",
+        default=os.path.join(HERE, "textspotting", "rumsey-finetune.pth"),
+    )
+    parser.add_argument(
+        "--htr-command",
+        default="",
+        help="Shell command that transcribes {lines} into {results}",
+    )
+
+
+def make_pipeline(args: argparse.Namespace) -> Pipeline:
+    """A Pipeline from the options of add_pipeline_arguments."""
+
+    image_cache = None
+    if args.image_cache:
+        from image_cache import ImageCache
+
+        image_cache = ImageCache(args.image_cache)
+
+    memory_budget = None
+    if args.memory_budget:
+        from memory_budget import MemoryBudget
+
+        memory_budget = MemoryBudget(args.memory_budget)
+
+        # Within a budget, the scans are read from disk rather than decoded again
+        if image_cache is None:
+            from image_cache import ImageCache
+
+            image_cache = ImageCache(os.path.join(args.work_folder, "decoded"))
+
+    return Pipeline(
+        args.work_folder,
+        image_cache=image_cache,
+        memory_budget=memory_budget,
+        manifest=args.manifest,
+        georeferencing=args.georeferencing,
+        format=args.format,
+        download_workers=args.download_workers,
+        window_size=args.window_size,
+        step_size=args.step_size,
+        label_scale=args.label_scale,
+        sam_model=args.sam_model,
+        sam_config=args.sam_config,
+        spot_config=args.spot_config,
+        spot_weights=args.spot_weights,
+        htr_command=args.htr_command,
+    )
+
+
+def main(
+    pipeline: Pipeline,
+    maps: list,
+    stage_names: list = None,
+    max_workers: int = MAX_WORKERS,
+    gpu_workers: int = GPU_WORKERS,
+) -> int:
+
+    status = pipeline.run(
+        maps,
+        stage_names or list(STAGES_BY_NAME),
+        max_workers=max_workers,
+        gpu_workers=gpu_workers,
+    )
+
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(
+        f"{len(maps)} maps: " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items()))
+    )
+    print_peak_rss(pipeline)
+
+    return 1 if counts.get("failed") else 0
+
+
+def print_peak_rss(pipeline: Pipeline):
+    """
+    The highest peak RSS of the process while each stage ran, against the
+    budget. It is not the memory of the stage alone: other tasks ran
+    in the same process at the same time.
+    """
+
+    from memory_budget import format_size
+
+    peaks = {}
+    for (name, stage_name), peak in pipeline.peak_rss.items():
+        if peak > peaks.get(stage_name, (0, None))[0]:
+            peaks[stage_name] = (peak, name)
+    if not peaks:
+        return
+
+    budget = pipeline.memory_budget.budget if pipeline.memory_budget else None
+    print(
+        "Peak process RSS while each stage ran, other tasks included"
+        + (f" (budget {format_size(budget)})" if budget else "")
+        + ":"
+    )
+    for stage_name in STAGES_BY_NAME:
+        if stage_name in peaks:
+            peak, name = peaks[stage_name]
+            over = " OVER BUDGET" if budget and peak > budget else ""
+            print(f"  {stage_name:<10} {format_size(peak):>8} ({name}){over}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--csv-file", default="data/selection.csv")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES_BY_NAME),
+        help="Default: all stages",
+    )
+    parser.add_argument(
+        "--only", nargs="+", metavar="MAP", help="Only these maps (file_name)"
+    )
+    parser.add_argument("--name-column", default="file_name")
+    parser.add_argument("--url-column", default="iiif_info_url")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+
+    sys.exit(
+        main(
+            make_pipeline(args),
+            load_maps(args.csv_file, args.name_column, args.url_column, args.only),
+            stage_names=args.stages,
+            max_workers=args.max_workers,
+            gpu_workers=args.gpu_workers,
+        )
+    )
@@ -0,0 +1,181 @@
+"""
+Tiled, multi-resolution (pyramidal) TIFF files for the downloaded scans.
+
+Level 0 is the full resolution image, every next level is half the size of
+the previous one. PyramidReader.read(level, x, y, w, h) only reads and
+decodes the tiles that overlap the requested region. extract_snippets.py
+crops its snippets this way; segment_icons.py and spot_text.py still decode
+the whole scan, so for them a TIFF brings no gain yet.
+
+Needs tifffile, and imagecodecs for the JPEG compressed tiles:
+
+    pip install tifffile imagecodecs
+"""
+
+import threading
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
+
+TILE_SIZE = 512
+COMPRESSION = "jpeg"
+QUALITY = 95
+
+
+def get_pyramid_levels(image: Image.Image, min_size: int = TILE_SIZE):
+    """Yield the image and every halved version of it, down to `min_size`."""
+
+    yield image
+
+    while max(image.size) > min_size:
+        image = image.reduce(2)
+        yield image
+
+
+def write_pyramid(
+    image: Image.Image,
+    path: str,
+    tile_size: int = TILE_SIZE,
+    compression: str = COMPRESSION,
+    quality: int = QUALITY,
+):
+    """
+    Save `image` as tiled pyramidal TIFF, with the reduced levels as SubIFDs
+    of the full resolution one (like OME-TIFF and most slide viewers expect).
+    JPEG compression needs the imagecodecs package.
+    """
+
+    image = image.convert("RGB")
+    levels = list(get_pyramid_levels(image, min_size=tile_size))
+
+    options = dict(
+        tile=(tile_size, tile_size),
+        photometric="rgb",
+        compression=compression,
+        compressionargs={"level": quality} if compression == "jpeg" else None,
+    )
+
+    # Classic TIFF can't address more than 4 GB
+    bigtiff = image.width * image.height * 3 > 2**31
+
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+        tif.write(np.asarray(levels[0]), subifds=len(levels) - 1, **options)
+
+        for level in levels[1:]:
+            tif.write(np.asarray(level), subfiletype=1, **options)
+
+
+class PyramidReader:
+    """
+    Read regions from a pyramidal TIFF written by write_pyramid.
+
+    Usage:
+        with PyramidReader("NL-HaNA_4.VEL_881.tif") as reader:
+            region = reader.read(0, x=1000, y=2000, w=1024, h=1024)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tif = tifffile.TiffFile(path)
+        self.levels = [level.keyframe for level in self.tif.series[0].levels]
+
+        # The file handle is shared, so reads from several threads take turns
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.tif.close()
+
+    @property
+    def level_count(self) -> int:
+        return len(self.levels)
+
+    def size(self, level: int = 0):
+        """(width, height) of a level."""
+        page = self.levels[level]
+        return page.imagewidth, page.imagelength
+
+    def best_level(self, scale: float) -> int:
+        """The smallest level with at least `scale` times the full resolution."""
+
+        width = self.size(0)[0]
+
+        for level in reversed(range(self.level_count)):
+            if self.size(level)[0] >= scale * width:
+                return level
+
+        return 0
+
+    def read(self, level: int, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """
+        Return the (h, w, 3) region at (x, y) of `level`, in that level's pixel
+        coordinates. Parts outside the image are black.
+        """
+
+        page = self.levels[level]
+        width, height = self.size(level)
+        tile_width, tile_height = page.tilewidth, page.tilelength
+        tiles_across = -(-width // tile_width)
+
+        region = np.zeros((h, w, page.samplesperpixel), dtype=page.dtype)
+
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, width), min(y + h, height)
+        if x0 >= x1 or y0 >= y1:
+            return region
+
+        decode = page.decode
+        filehandle = self.tif.filehandle
+
+        for tile_y in range(y0 // tile_height, (y1 - 1) // tile_height + 1):
+            for tile_x in range(x0 // tile_width, (x1 - 1) // tile_width + 1):
+
+                index = tile_y * tiles_across + tile_x
+
+                with self._lock:
+                    filehandle.seek(page.dataoffsets[index])
+                    data = filehandle.read(page.databytecounts[index])
+
+                tile, _, _ = decode(data, index, jpegtables=page.jpegtables)
+                tile = tile[0]  # (depth, length, width, samples)
+
+                # Overlap of this tile and the region, in level coordinates
+                left, top = tile_x * tile_width, tile_y * tile_height
+                ox0, oy0 = max(x0, left), max(y0, top)
+                ox1 = min(x1, left + tile_width)
+                oy1 = min(y1, top + tile_height)
+
+                region[oy0 - y : oy1 - y, ox0 - x : ox1 - x] = tile[
+                    oy0 - top : oy1 - top, ox0 - left : ox1 - left
+                ]
+
+        return region
+
+    def read_image(self, level: int = 0) -> Image.Image:
+        """A whole level as PIL Image."""
+        width, height = self.size(level)
+        return Image.fromarray(self.read(level, 0, 0, width, height))
+
+
+def read_region(path: str, x: int, y: int, w: int, h: int, level: int = 0):
+    """
+    Read a region of a scan, either from a pyramidal TIFF (decoding only the
+    tiles it needs) or from any other image PIL can open.
+    """
+
+    if path.endswith((".tif", ".tiff")):
+        with PyramidReader(path) as reader:
+            return reader.read(level, x, y, w, h)
+
+    with Image.open(path) as image:
+        if level:
+            image = image.reduce(2**level)
+        return np.asarray(image.convert("RGB").crop((x, y, x + w, y + h)))
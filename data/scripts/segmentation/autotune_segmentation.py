@@ -0,0 +1,342 @@
+"""
+Find the window size, step size and batch size (SAM2's points_per_batch) of
+segment_icons.py for a kind of scan on a machine.
+
+A few regions (--samples of --sample-size pixels) are taken from a map at
+full resolution and segmented with segment_icons.process_image for every
+candidate window and step size. For each candidate it measures:
+
+    seconds/Mpx  inference time per megapixel of scan
+    memory       peak RSS above what the model holds (and the peak CUDA
+                 memory on a GPU)
+    recall       the part of the masks of the reference setting (the current
+                 1000/750) that the candidate finds again, with a mask IoU
+                 of at least 0.5
+
+The batch size doesn't change the masks, only time and memory, so it is only
+varied for the best window and step size. The fastest candidate that keeps
+--min-recall of the reference masks (within --max-memory) is written to a
+configuration that segment_icons.py loads:
+
+    python autotune_segmentation.py map.jpg --output segment_config.json
+    python segment_icons.py images output annotations --config segment_config.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from memory_budget import RSSMonitor, format_size, get_rss
+from image_cache import parse_size
+from segment_icons import (
+    MODEL,
+    MODEL_TYPE,
+    DEVICE,
+    POINTS_PER_BATCH,
+    CONFIG_KEYS,
+    build_model,
+    make_mask_generator,
+    get_image_cutouts,
+    process_image,
+)
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
+
+WINDOW_SIZES = (512, 768, 1000)
+STEP_FRACTIONS = (0.75, 0.9)  # step size as a part of the window size
+BATCH_SIZES = (32, 64, 128)
+REFERENCE = (1000, 750)  # the window and step size of segment_icons.main
+
+SAMPLES = 3
+SAMPLE_SIZE = 1500
+MIN_RECALL = 0.9
+MATCH_IOU = 0.5
+
+
+def sample_regions(image: Image, n: int, size: int, seed: int = 0) -> list:
+    """`n` random regions of `size` by `size` pixels (or the whole scan)."""
+
+    rng = random.Random(seed)
+    width, height = image.size
+
+    regions = []
+    for _ in range(n):
+        x = rng.randint(0, max(0, width - size))
+        y = rng.randint(0, max(0, height - size))
+        region = image.crop((x, y, min(x + size, width), min(y + size, height)))
+        region.load()
+        regions.append(region)
+
+    return regions
+
+
+def segment_region(
+    region: Image, window_size: int, step_size: int, mask_generator
+) -> list:
+    """The masks of segment_icons' rolling window, as RLE of the whole region."""
+
+    from pycocotools import mask as mask_utils
+
+    width, height = region.size
+
+    rles = []
+    for x, y, cutout in get_image_cutouts(region, window_size, step_size):
+        data = process_image(
+            cutout,
+            "",
+            x=x,
+            y=y,
+            original_image=region,
+            original_width=width,
+            original_height=height,
+            resize_factor=1,
+            mask_generator=mask_generator,
+        )
+
+        for r in data["results"]:
+            mask = mask_utils.decode(r["segmentation"])
+            h, w = min(mask.shape[0], height - y), min(mask.shape[1], width - x)
+
+            # Windows at the border reach outside the region
+            if not mask[:h, :w].any():
+                continue
+
+            placed = np.zeros((height, width), dtype=np.uint8)
+            placed[y : y + h, x : x + w] = mask[:h, :w]
+            rles.append(mask_utils.encode(np.asfortranarray(placed)))
+
+    return rles
+
+
+def get_recall(reference: list, masks: list, threshold: float = MATCH_IOU) -> float:
+    """The part of the reference masks with a mask of at least `threshold` IoU."""
+
+    from pycocotools import mask as mask_utils
+
+    if not reference:
+        return 1.0
+    if not masks:
+        return 0.0
+
+    ious = np.asarray(mask_utils.iou(masks, reference, [0] * len(reference)))
+    return float((ious.max(axis=0) >= threshold).mean())
+
+
+def get_cuda_peak(reset: bool = False):
+    import torch
+
+    if not torch.cuda.is_available():
+        return None
+    if reset:
+        torch.cuda.reset_peak_memory_stats()
+    return torch.cuda.max_memory_allocated()
+
+
+def measure(
+    regions: list,
+    sam2,
+    window_size: int,
+    step_size: int,
+    points_per_batch: int,
+) -> tuple:
+    """The measurements of one setting over all regions, and its masks."""
+
+    mask_generator = make_mask_generator(sam2, points_per_batch=points_per_batch)
+
+    get_cuda_peak(reset=True)
+    rss = get_rss()
+
+    # process_image prints a line per window
+    with RSSMonitor() as monitor, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        masks = [
+            segment_region(region, window_size, step_size, mask_generator)
+            for region in regions
+        ]
+        seconds = time.perf_counter() - start
+
+    megapixels = sum(region.width * region.height for region in regions) / 1e6
+
+    result = {
+        "window_size": window_size,
+        "step_size": step_size,
+        "points_per_batch": points_per_batch,
+        "seconds_per_megapixel": seconds / megapixels,
+        "memory": max(0, monitor.peak - rss),
+        "cuda_memory": get_cuda_peak(),
+        "masks": sum(len(m) for m in masks),
+    }
+    return result, masks
+
+
+def get_memory(result: dict) -> int:
+    """What limits the setting: CUDA memory on a GPU, RSS otherwise."""
+    if result["cuda_memory"] is not None:
+        return result["cuda_memory"]
+    return result["memory"]
+
+
+def recommend(results: list, min_recall: float, max_memory: int = None) -> dict:
+    """The fastest result with enough recall, within the memory limit."""
+
+    eligible = [
+        r
+        for r in results
+        if r["recall"] >= min_recall
+        and (max_memory is None or get_memory(r) <= max_memory)
+    ]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda r: r["seconds_per_megapixel"])
+
+
+def print_result(result: dict):
+    cuda = (
+        f"  cuda {format_size(result['cuda_memory'])}"
+        if result["cuda_memory"] is not None
+        else ""
+    )
+    print(
+        f"window {result['window_size']:>5}  step {result['step_size']:>5}  "
+        f"batch {result['points_per_batch']:>4}  "
+        f"{result['seconds_per_megapixel']:>7.2f} s/Mpx  "
+        f"memory {format_size(result['memory']):>7}{cuda}  "
+        f"masks {result['masks']:>5}  recall {result['recall']:.2f}"
+    )
+
+
+def autotune(
+    image: Image,
+    sam2,
+    window_sizes: list = WINDOW_SIZES,
+    step_fractions: list = STEP_FRACTIONS,
+    batch_sizes: list = BATCH_SIZES,
+    reference: tuple = REFERENCE,
+    samples: int = SAMPLES,
+    sample_size: int = SAMPLE_SIZE,
+    min_recall: float = MIN_RECALL,
+    max_memory: int = None,
+    seed: int = 0,
+) -> dict:
+
+    regions = sample_regions(image, samples, sample_size, seed=seed)
+
+    # The first run also pays for loading kernels and allocating buffers
+    with contextlib.redirect_stdout(io.StringIO()):
+        segment_region(
+            regions[0].crop((0, 0, min(window_sizes), min(window_sizes))),
+            min(window_sizes),
+            min(window_sizes),
+            make_mask_generator(sam2),
+        )
+
+    reference_result, reference_masks = measure(
+        regions, sam2, *reference, POINTS_PER_BATCH
+    )
+    reference_result["recall"] = 1.0
+    print_result(reference_result)
+    results = [reference_result]
+
+    def add(window_size, step_size, points_per_batch):
+        result, masks = measure(regions, sam2, window_size, step_size, points_per_batch)
+        result["recall"] = float(
+            np.mean(
+                [
+                    get_recall(region_reference, region_masks)
+                    for region_reference, region_masks in zip(reference_masks, masks)
+                ]
+            )
+        )
+        print_result(result)
+        results.append(result)
+
+    for window_size in window_sizes:
+        for fraction in step_fractions:
+            step_size = int(window_size * fraction)
+            if (window_size, step_size) != tuple(reference):
+                add(window_size, step_size, POINTS_PER_BATCH)
+
+    best = recommend(results, min_recall, max_memory) or reference_result
+    for points_per_batch in batch_sizes:
+        if points_per_batch != best["points_per_batch"]:
+            add(best["window_size"], best["step_size"], points_per_batch)
+
+    best = recommend(results, min_recall, max_memory)
+    if best is None:
+        print("No setting fits within the memory limit, keeping the reference")
+        best = reference_result
+
+    return {
+        **{key: best[key] for key in CONFIG_KEYS},
+        "autotune": {
+            "samples": samples,
+            "sample_size": sample_size,
+            "min_recall": min_recall,
+            "max_memory": max_memory,
+            "results": results,
+        },
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("image_path")
+    parser.add_argument("--output", default="segment_config.json")
+    parser.add_argument("--window-sizes", nargs="+", type=int, default=WINDOW_SIZES)
+    parser.add_argument(
+        "--step-fractions", nargs="+", type=float, default=STEP_FRACTIONS
+    )
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=BATCH_SIZES)
+    parser.add_argument(
+        "--reference",
+        nargs=2,
+        type=int,
+        default=REFERENCE,
+        metavar=("WINDOW_SIZE", "STEP_SIZE"),
+    )
+    parser.add_argument("--samples", type=int, default=SAMPLES)
+    parser.add_argument("--sample-size", type=int, default=SAMPLE_SIZE)
+    parser.add_argument("--min-recall", type=float, default=MIN_RECALL)
+    parser.add_argument("--max-memory", metavar="SIZE", help="e.g. 12G")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--model-type", default=MODEL_TYPE)
+    parser.add_argument("--device", default=DEVICE)
+    args = parser.parse_args()
+
+    config = autotune(
+        Image.open(args.image_path),
+        build_model(args.model, args.model_type, args.device),
+        window_sizes=args.window_sizes,
+        step_fractions=args.step_fractions,
+        batch_sizes=args.batch_sizes,
+        reference=tuple(args.reference),
+        samples=args.samples,
+        sample_size=args.sample_size,
+        min_recall=args.min_recall,
+        max_memory=parse_size(args.max_memory) if args.max_memory else None,
+        seed=args.seed,
+    )
+    config["autotune"]["image"] = args.image_path
+
+    with open(args.output, "w") as f:
+        json.dump(config, f, indent=2)
+
+    print(
+        f"Recommended: window size {config['window_size']}, step size "
+        f"{config['step_size']}, points per batch {config['points_per_batch']} "
+        f"(written to {args.output})"
+    )
@@ -0,0 +1,413 @@
+"""
+One label raster per canvas, for the icon masks that filter_cutouts kept.
+
+segment_icons.py keeps the masks as RLE of their cutout (in the JSON of the
+output folder) and as PNGs. A label raster paints them onto the canvas
+instead: every pixel holds the label of the icon that covers it (the index
+in `ids` plus one, 0 for none), so "which icon is at this pixel" or "which
+icons are in this region" only reads a few tiles. Where icons overlap, the
+smaller one is on top, as that is the one a click means.
+
+The raster is stored in tiles of TILE_SIZE pixels, each compressed with
+zlib, after a JSON header (ids, areas and bounding boxes of the icons, and
+the offset of every tile). The file is memory-mapped, and tiles are only
+decompressed (and kept in an LRU cache) when a lookup needs them. Tiles
+without icons take no space. With --scale, the raster has a reduced
+resolution; lookups still take canvas pixels.
+
+    python label_raster.py build <output folder>/<map>/<map>.json \\
+        annotations/<map>.json <map>.labels
+    python label_raster.py at <map>.labels 5120 2048
+    python label_raster.py region <map>.labels 4000 1000 2000 2000
+    python label_raster.py stats <map>.labels
+"""
+
+import io
+import os
+import json
+import mmap
+import time
+import zlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b"NERULBL1"
+TILE_SIZE = 256
+CACHE_TILES = 256  # decompressed tiles kept by a LabelRaster
+COMPRESSION = 6  # zlib level
+
+
+def read_masks(data: dict, keep: set) -> list:
+    """
+    The kept masks of the raw output of segment_icons, as (id, x, y, mask)
+    with the mask cropped to its pixels and (x, y) its place on the canvas.
+    """
+
+    from pycocotools import mask as mask_utils
+
+    masks = []
+    for cutout in data["cutouts"]:
+        for r in cutout["results"]:
+            if r["uuid"] not in keep:
+                continue
+
+            mask = mask_utils.decode(r["segmentation"]).astype(bool)
+            rows = np.flatnonzero(mask.any(axis=1))
+            columns = np.flatnonzero(mask.any(axis=0))
+            if not len(rows):
+                continue
+
+            masks.append(
+                (
+                    r["uuid"],
+                    cutout["x"] + int(columns[0]),
+                    cutout["y"] + int(rows[0]),
+                    mask[rows[0] : rows[-1] + 1, columns[0] : columns[-1] + 1],
+                )
+            )
+
+    return masks
+
+
+def sample(start: int, size: int, scale: float, limit: int) -> tuple:
+    """
+    The first raster pixel of a mask of `size` pixels from canvas pixel
+    `start`, and the mask pixel at the centre of every raster pixel it covers.
+    """
+
+    first = int(np.floor(start * scale))
+    last = min(limit, int(np.ceil((start + size) * scale)))
+    indices = ((np.arange(first, last) + 0.5) / scale).astype(np.int64) - start
+
+    inside = np.flatnonzero((indices >= 0) & (indices < size))
+    if not len(inside):
+        return first, inside
+    return first + int(inside[0]), indices[inside]
+
+
+def paint(masks: list, width: int, height: int, scale: float = 1.0) -> np.ndarray:
+    """The label raster of the masks, largest first so smaller icons are on top."""
+
+    dtype = np.uint16 if len(masks) < 2**16 else np.uint32
+    raster = np.zeros(
+        (int(np.ceil(height * scale)), int(np.ceil(width * scale))), dtype
+    )
+
+    areas = [int(mask.sum()) for _, _, _, mask in masks]
+    for i in np.argsort(areas, kind="stable")[::-1]:
+        _, x, y, mask = masks[i]
+        h, w = mask.shape
+
+        x0, columns = sample(x, w, scale, raster.shape[1])
+        y0, rows = sample(y, h, scale, raster.shape[0])
+
+        region = raster[y0 : y0 + len(rows), x0 : x0 + len(columns)]
+        region[mask[np.ix_(rows, columns)]] = i + 1
+
+    return raster
+
+
+def write_label_raster(
+    path: str,
+    raster: np.ndarray,
+    masks: list,
+    width: int,
+    height: int,
+    scale: float = 1.0,
+    tile_size: int = TILE_SIZE,
+):
+    data, tiles = io.BytesIO(), []
+    for ty in range(0, raster.shape[0], tile_size):
+        for tx in range(0, raster.shape[1], tile_size):
+            tile = raster[ty : ty + tile_size, tx : tx + tile_size]
+            if not tile.any():
+                tiles.append([0, 0])
+                continue
+
+            compressed = zlib.compress(
+                np.ascontiguousarray(tile).tobytes(), COMPRESSION
+            )
+            tiles.append([data.tell(), len(compressed)])
+            data.write(compressed)
+
+    header = json.dumps(
+        {
+            "width": width,
+            "height": height,
+            "scale": scale,
+            "tile_size": tile_size,
+            "dtype": raster.dtype.name,
+            "ids": [annotation_id for annotation_id, _, _, _ in masks],
+            "areas": [int(mask.sum()) for _, _, _, mask in masks],
+            "bboxes": [[x, y, mask.shape[1], mask.shape[0]] for _, x, y, mask in masks],
+            "tiles": tiles,
+        }
+    ).encode()
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(data.getbuffer())
+    os.replace(path + ".tmp", path)
+
+
+def build_label_raster(
+    output_path: str,
+    annotation_page_path: str,
+    label_raster_path: str,
+    scale: float = 1.0,
+    tile_size: int = TILE_SIZE,
+) -> int:
+    """
+    Write the label raster of the raw output of segment_icons (output_path),
+    with the icons of its filtered AnnotationPage. Returns the number of icons.
+    """
+
+    with open(output_path) as f:
+        data = json.load(f)
+    with open(annotation_page_path) as f:
+        keep = {annotation["id"] for annotation in json.load(f)["items"]}
+
+    masks = read_masks(data, keep)
+    raster = paint(masks, data["width"], data["height"], scale)
+
+    os.makedirs(os.path.dirname(label_raster_path) or ".", exist_ok=True)
+    write_label_raster(
+        label_raster_path,
+        raster,
+        masks,
+        data["width"],
+        data["height"],
+        scale,
+        tile_size,
+    )
+    return len(masks)
+
+
+class LabelRaster:
+    def __init__(self, path: str, cache_tiles: int = CACHE_TILES):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a label raster")
+        length = int.from_bytes(self._mmap[len(MAGIC) : len(MAGIC) + 8], "little")
+        start = len(MAGIC) + 8
+        header = json.loads(self._mmap[start : start + length])
+
+        self.width, self.height = header["width"], header["height"]
+        self.scale = header["scale"]
+        self.tile_size = header["tile_size"]
+        self.dtype = np.dtype(header["dtype"])
+
+        self.ids = np.array(header["ids"], dtype=str)
+        self.areas = np.array(header["areas"], dtype=np.int64)
+        self.bboxes = np.array(header["bboxes"], dtype=np.int64).reshape(-1, 4)
+
+        self.shape = (
+            int(np.ceil(self.height * self.scale)),
+            int(np.ceil(self.width * self.scale)),
+        )
+        self.columns = -(-self.shape[1] // self.tile_size)
+        self._tiles = np.array(header["tiles"], dtype=np.int64).reshape(-1, 2)
+        self._data = start + length
+
+        self.cache_tiles = cache_tiles
+        self._cache = OrderedDict()
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def tile(self, tx: int, ty: int) -> np.ndarray:
+        """The labels of one tile (read-only)."""
+
+        key = ty * self.columns + tx
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        h = min(self.tile_size, self.shape[0] - ty * self.tile_size)
+        w = min(self.tile_size, self.shape[1] - tx * self.tile_size)
+
+        offset, length = self._tiles[key].tolist()
+        if length:
+            start = self._data + offset
+            buffer = zlib.decompress(self._mmap[start : start + length])
+            tile = np.frombuffer(buffer, dtype=self.dtype).reshape(h, w)
+        else:
+            tile = np.zeros((h, w), dtype=self.dtype)
+            tile.flags.writeable = False
+
+        self._cache[key] = tile
+        if len(self._cache) > self.cache_tiles:
+            self._cache.popitem(last=False)
+        return tile
+
+    def lookup(self, xs, ys) -> np.ndarray:
+        """The labels at canvas pixels (0 outside the canvas or any icon)."""
+
+        xs = np.atleast_1d(np.asarray(xs, dtype=float))
+        ys = np.atleast_1d(np.asarray(ys, dtype=float))
+        columns = np.floor(xs * self.scale).astype(np.int64)
+        rows = np.floor(ys * self.scale).astype(np.int64)
+
+        labels = np.zeros(len(xs), dtype=self.dtype)
+        inside = (
+            (columns >= 0)
+            & (columns < self.shape[1])
+            & (rows >= 0)
+            & (rows < self.shape[0])
+        )
+
+        # Grouped by tile, so every tile is decompressed once
+        points = np.flatnonzero(inside)
+        keys = (rows[points] // self.tile_size) * self.columns + (
+            columns[points] // self.tile_size
+        )
+        order = np.argsort(keys, kind="stable")
+        points, keys = points[order], keys[order]
+        unique, starts = np.unique(keys, return_index=True)
+
+        for key, group in zip(unique.tolist(), np.split(points, starts[1:])):
+            tile = self.tile(key % self.columns, key // self.columns)
+            labels[group] = tile[
+                rows[group] % self.tile_size, columns[group] % self.tile_size
+            ]
+
+        return labels
+
+    def at(self, x: float, y: float) -> str:
+        """The id of the icon at a canvas pixel, or None."""
+
+        label = int(self.lookup([x], [y])[0])
+        return str(self.ids[label - 1]) if label else None
+
+    def labels(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """The labels of a canvas region, at the resolution of the raster."""
+
+        x0 = max(0, int(np.floor(x * self.scale)))
+        y0 = max(0, int(np.floor(y * self.scale)))
+        x1 = min(self.shape[1], int(np.ceil((x + width) * self.scale)))
+        y1 = min(self.shape[0], int(np.ceil((y + height) * self.scale)))
+
+        region = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=self.dtype)
+        size = self.tile_size
+        for ty in range(y0 // size, -(-y1 // size)):
+            for tx in range(x0 // size, -(-x1 // size)):
+                tile = self.tile(tx, ty)
+
+                # The part of the tile in the region, in raster pixels
+                top, left = max(y0, ty * size), max(x0, tx * size)
+                bottom = min(y1, ty * size + tile.shape[0])
+                right = min(x1, tx * size + tile.shape[1])
+                region[top - y0 : bottom - y0, left - x0 : right - x0] = tile[
+                    top - ty * size : bottom - ty * size,
+                    left - tx * size : right - tx * size,
+                ]
+
+        return region
+
+    def region(self, x: int, y: int, width: int, height: int) -> dict:
+        """The icons in a canvas region, with their visible area in it (pixels)."""
+
+        counts = np.bincount(
+            self.labels(x, y, width, height).ravel(), minlength=len(self) + 1
+        )
+        labels = np.flatnonzero(counts[1:]) + 1
+        return {
+            str(self.ids[label - 1]): float(counts[label] / self.scale**2)
+            for label in labels.tolist()
+        }
+
+    def stats(self) -> dict:
+        """Area statistics of the icons, in canvas pixels."""
+
+        counts = np.zeros(len(self) + 1, dtype=np.int64)
+        for key in np.flatnonzero(self._tiles[:, 1]).tolist():
+            tile = self.tile(key % self.columns, key // self.columns)
+            counts += np.bincount(tile.ravel(), minlength=len(self) + 1)
+        visible = counts[1:] / self.scale**2
+
+        return {
+            "icons": len(self),
+            "coverage": float(visible.sum() / (self.width * self.height)),
+            "area": {
+                "total": int(self.areas.sum()),
+                "median": float(np.median(self.areas)) if len(self) else 0.0,
+                "min": int(self.areas.min()) if len(self) else 0,
+                "max": int(self.areas.max()) if len(self) else 0,
+            },
+            # Partly covered by smaller icons
+            "covered": int((visible < self.areas * 0.99).sum()),
+        }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Write the raster of a map")
+    build_parser.add_argument("output", help="<output folder>/<map>/<map>.json")
+    build_parser.add_argument("annotation_page")
+    build_parser.add_argument("label_raster")
+    build_parser.add_argument("--scale", type=float, default=1.0)
+    build_parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+
+    at_parser = commands.add_parser("at", help="The icon at a canvas pixel")
+    at_parser.add_argument("label_raster")
+    at_parser.add_argument("x", type=float)
+    at_parser.add_argument("y", type=float)
+
+    region_parser = commands.add_parser("region", help="The icons in a region")
+    region_parser.add_argument("label_raster")
+    region_parser.add_argument("x", type=int)
+    region_parser.add_argument("y", type=int)
+    region_parser.add_argument("width", type=int)
+    region_parser.add_argument("height", type=int)
+
+    stats_parser = commands.add_parser("stats", help="Area statistics")
+    stats_parser.add_argument("label_raster")
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "build":
+        n = build_label_raster(
+            args.output,
+            args.annotation_page,
+            args.label_raster,
+            scale=args.scale,
+            tile_size=args.tile_size,
+        )
+        size = os.path.getsize(args.label_raster)
+        print(
+            f"Wrote {n} icons to {args.label_raster} ({size / 2**20:.1f} MB, "
+            f"{time.perf_counter() - start:.2f}s)"
+        )
+
+    else:
+        with LabelRaster(args.label_raster) as raster:
+            if args.command == "at":
+                print(raster.at(args.x, args.y))
+            elif args.command == "region":
+                region = raster.region(args.x, args.y, args.width, args.height)
+                for icon_id, area in sorted(region.items(), key=lambda i: -i[1]):
+                    print(f"{area:>12.0f}  {icon_id}")
+            else:
+                print(json.dumps(raster.stats(), indent=2))
+        print(f"({(time.perf_counter() - start) * 1000:.1f} ms)")
@@ -2,19 +2,14 @@ import os
 import sys
 import uuid
 import json
+import argparse
 from itertools import count, combinations
 import datetime
 
 import xml.etree.ElementTree as ET
-from shapely.geometry import Polygon
 
-import torch
-from pycocotools import mask as mask_utils
-
-from sam2.build_sam import build_sam2
-from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
-
-import cv2
+# torch, sam2, cv2, pycocotools and shapely are imported where they are used,
+# so filter_cutouts (and the neru.py commands) don't wait for torch to load
 from PIL import Image
 import numpy as np
 
@@ -22,7 +17,7 @@ Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
 
 MODEL = "./model/sam2.1_hiera_large.pt"  # large model
 MODEL_TYPE = "configs/sam2.1/sam2.1_hiera_l.yaml"
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+DEVICE = None  # cuda if available, see get_device
 
 # Thresholds, trial and error
 IOU = 0.9
@@ -30,10 +25,20 @@ STABILITY = 0.8
 MIN_AREA_THRESHOLD = 100
 MAX_AREA_THRESHOLD = 0.9  # 90% of the image
 BORDER_THRESHOLD = 5
+POINTS_PER_BATCH = 64  # SAM2's default
+
+# The settings autotune_segmentation.py recommends, and main takes
+CONFIG_KEYS = ("window_size", "step_size", "points_per_batch")
 
 ncounter = count()
 
 
+def get_device() -> str:
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
 def getSVG(coordinates):
 
     points = [f"{int(x)},{int(y)}" for x, y in coordinates + [coordinates[0]]]
@@ -48,7 +53,9 @@ def getSVG(coordinates):
     return ET.tostring(svg, encoding="unicode")
 
 
-def get_resized_images(image: Image, window_size: int, resize_factor: int = 2):
+def get_resized_images(
+    image: Image, window_size: int, resize_factor: int = 2, max_levels: int = None
+):
     # image_bgr = cv2.imread(image)
     # image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
 
@@ -59,15 +66,11 @@ def get_resized_images(image: Image, window_size: int, resize_factor: int = 2):
     # Let's make sure the image's size is divisible by the resize factor,
     # then we can easily resize the image and transpose the masks. This works by cropping.
     # And that single pixel doesn't matter much.
-    while height % resize_factor != 0:
-        image = image.crop((0, 0, width, height - 1))
-        # image_rgb = image_rgb[:-1, :, :]
-        height -= 1
-
-    while width % resize_factor != 0:
-        image = image.crop((0, 0, width - 1, height))
-        # image_rgb = image_rgb[:, :-1, :]
-        width -= 1
+    # (One crop, every crop is a copy of the whole scan)
+    height -= height % resize_factor
+    width -= width % resize_factor
+    if (width, height) != image.size:
+        image = image.crop((0, 0, width, height))
 
     # Get a minimum factor to resize the image to the window size
     f_min = min(window_size / width, window_size / height)
@@ -78,6 +81,10 @@ def get_resized_images(image: Image, window_size: int, resize_factor: int = 2):
 
     while width > window_size or height > window_size:
 
+        # The coarsest levels are left out to save memory (see memory_budget.py)
+        if max_levels is not None and n >= max_levels:
+            break
+
         # if n < 2:
         #     n += 1
         #     continue
@@ -121,7 +128,7 @@ def process_image(
     original_width: int,
     original_height: int,
     resize_factor: float,
-    mask_generator: SAM2AutomaticMaskGenerator,
+    mask_generator: "SAM2AutomaticMaskGenerator",
     output_folder: str = "",
     output_png: bool = True,
     output_web_annotation: bool = True,
@@ -129,6 +136,8 @@ def process_image(
     folder_prefix: str = "",
     max_area_threshold: float = MAX_AREA_THRESHOLD,
 ):
+    import cv2
+    from pycocotools import mask as mask_utils
 
     f_i = 1 / resize_factor
 
@@ -153,12 +162,6 @@ def process_image(
 
     # index_count = next(ncounter)
 
-    # original image crop
-    original_image_crop = original_image.crop(
-        (data["x"], data["y"], data["x"] + data["width"], data["y"] + data["height"])
-    )
-    original_image_crop_rgba = original_image_crop.convert("RGBA")
-
     # image.save(os.path.join(output_folder, f"{folder_prefix}_{index_count}.png"))
     # original_image_crop_rgba.save(
     #     os.path.join(output_folder, f"{folder_prefix}_{index_count}_original.png")
@@ -253,11 +256,6 @@ def process_image(
                 # cv2.imwrite(os.path.join(output_folder_prefix, f"{r['uuid']}.png"))", cutout)
 
                 ## PIL
-                masked_image_array = np.array(original_image_crop_rgba)
-
-                masked_image_array[:, :, 3] = mask * 255  # alpha channel
-                masked_image = Image.fromarray(masked_image_array, "RGBA")
-
                 r_x1, r_y1, r_w, r_h = r["bbox"]
 
                 r_x1 = int(r_x1)
@@ -265,7 +263,22 @@ def process_image(
                 r_y1 = int(r_y1)
                 r_y2 = r_y1 + int(r_h)
 
-                cutout = masked_image.crop((r_x1, r_y1, r_x2, r_y2))  # bbox
+                # Only the bbox of the original image, at the coarse levels a
+                # cutout covers most of the scan
+                cutout_array = np.array(
+                    original_image.crop(
+                        (
+                            data["x"] + r_x1,
+                            data["y"] + r_y1,
+                            data["x"] + r_x2,
+                            data["y"] + r_y2,
+                        )
+                    ).convert("RGBA")
+                )
+                cutout_array[:, :, 3] = (
+                    mask[r_y1:r_y2, r_x1:r_x2] * 255
+                )  # alpha channel
+                cutout = Image.fromarray(cutout_array, "RGBA")
 
                 cutout.save(os.path.join(output_folder_prefix, f"{r['uuid']}.png"))
 
@@ -316,7 +329,9 @@ def process_image(
     return data
 
 
-def svg_to_polygon(svg: str) -> Polygon:
+def svg_to_polygon(svg: str) -> "Polygon":
+    from shapely.geometry import Polygon
+
     tree = ET.fromstring(svg)
 
     namespace = {"svg": "http://www.w3.org/2000/svg"}
@@ -396,30 +411,29 @@ def filter_cutouts(
         json.dump(annotationPage, f, indent=4)
 
 
-def main(
-    images: list,
-    output_folder: str,
-    annotation_output_folder: str = "annotations",
-    window_size: int = 1000,  # to take VRAM into account
-    step_size: int = 750,
-    model: str = MODEL,
-    model_type: str = MODEL_TYPE,
-    device: str = DEVICE,
-    iou: float = IOU,
-    stability: float = STABILITY,
-    min_area_threshold: int = MIN_AREA_THRESHOLD,
-    max_area_threshold: float = MAX_AREA_THRESHOLD,
-):
+def build_model(model: str = MODEL, model_type: str = MODEL_TYPE, device=DEVICE):
+    from sam2.build_sam import build_sam2
+
     # sam = sam_model_registry[model_type](checkpoint=model)
     # sam.to(device=device)
 
-    sam2 = build_sam2(
+    return build_sam2(
         model_type,
         model,
-        device=device,
+        device=device or get_device(),
         apply_postprocessing=True,
     )
 
+
+def make_mask_generator(
+    sam2,
+    iou: float = IOU,
+    stability: float = STABILITY,
+    min_area_threshold: int = MIN_AREA_THRESHOLD,
+    points_per_batch: int = POINTS_PER_BATCH,
+):
+    from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
     # mask_generator = SamAutomaticMaskGenerator(
     #     sam,
     #     pred_iou_thresh=iou,
@@ -428,14 +442,52 @@ def main(
     #     output_mode="coco_rle",
     # )
 
-    mask_generator = SAM2AutomaticMaskGenerator(
+    return SAM2AutomaticMaskGenerator(
         sam2,
+        points_per_batch=points_per_batch,
         pred_iou_thresh=iou,
         stability_score_thresh=stability,
         min_mask_region_area=min_area_threshold,
         output_mode="coco_rle",
     )
 
+
+def load_config(path: str) -> dict:
+    """The main arguments in a configuration of autotune_segmentation.py."""
+
+    with open(path) as f:
+        config = json.load(f)
+
+    return {key: config[key] for key in CONFIG_KEYS if key in config}
+
+
+def main(
+    images: list,
+    output_folder: str,
+    annotation_output_folder: str = "annotations",
+    window_size: int = 1000,  # to take VRAM into account
+    step_size: int = 750,
+    model: str = MODEL,
+    model_type: str = MODEL_TYPE,
+    device: str = DEVICE,
+    iou: float = IOU,
+    stability: float = STABILITY,
+    min_area_threshold: int = MIN_AREA_THRESHOLD,
+    max_area_threshold: float = MAX_AREA_THRESHOLD,
+    image_cache=None,
+    max_levels: int = None,
+    points_per_batch: int = POINTS_PER_BATCH,
+):
+    sam2 = build_model(model, model_type, device)
+
+    mask_generator = make_mask_generator(
+        sam2,
+        iou=iou,
+        stability=stability,
+        min_area_threshold=min_area_threshold,
+        points_per_batch=points_per_batch,
+    )
+
     for image_path in images:
         image_name = os.path.basename(image_path)
         image_name_without_extension = os.path.splitext(image_name)[0]
@@ -446,7 +498,10 @@ def main(
         os.makedirs(image_output_folder, exist_ok=True)
 
         # height, width, _ = cv2.imread(image_path).shape
-        image = Image.open(image_path)
+        if image_cache is not None:  # already decoded, see data/scripts/image_cache.py
+            image = image_cache.open_image(image_path)
+        else:
+            image = Image.open(image_path)
         width, height = image.size
 
         data = {
@@ -456,7 +511,7 @@ def main(
             "cutouts": [],
         }
 
-        resized_images = get_resized_images(image, window_size)
+        resized_images = get_resized_images(image, window_size, max_levels=max_levels)
 
         for f, resized_image in resized_images:
 
@@ -501,21 +556,51 @@ def main(
         )
 
 
+def filter_outputs(output_folder: str, annotation_output_folder: str):
+    """Filter the cutouts of an earlier run (in output_folder) again."""
+
+    for folder in sorted(os.listdir(output_folder)):
+        path = os.path.join(output_folder, folder, f"{folder}.json")
+        if not os.path.exists(path):
+            continue
+
+        with open(path) as f:
+            data = json.load(f)
+
+        filter_cutouts(
+            data,
+            output_folder=annotation_output_folder,
+            image_name=folder,
+        )
+
+
 if __name__ == "__main__":
     # OUTPUT_FOLDER = "./results"
     # EXAMPLE = "./example/7beaf613-68bf-4070-b79b-bb5c9282edcd.jpg"
     # images = [EXAMPLE]
 
-    if len(sys.argv) < 4:
-        print(
-            "Usage: python segment_icons.py <image_folder> <output_folder> <annotation_folder>"
-        )
-        print("Example: python segment_icons.py ./images ./output ./annotations")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        usage="python segment_icons.py <image_folder> <output_folder> <annotation_folder>",
+        epilog="Example: python segment_icons.py ./images ./output ./annotations",
+    )
+    parser.add_argument("image_folder")
+    parser.add_argument("output_folder")
+    parser.add_argument("annotation_folder")
+    parser.add_argument(
+        "--image-cache",
+        metavar="FOLDER",
+        help="Decode every image once into this cache and memory-map it from there",
+    )
+    parser.add_argument(
+        "--config",
+        metavar="JSON",
+        help="Window size, step size and batch from autotune_segmentation.py",
+    )
+    args = parser.parse_args()
 
-    IMAGE_FOLDER = sys.argv[1]
-    OUTPUT_FOLDER = sys.argv[2]
-    ANNOTATION_FOLDER = sys.argv[3]
+    IMAGE_FOLDER = args.image_folder
+    OUTPUT_FOLDER = args.output_folder
+    ANNOTATION_FOLDER = args.annotation_folder
 
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
     os.makedirs(ANNOTATION_FOLDER, exist_ok=True)
@@ -523,21 +608,20 @@ if __name__ == "__main__":
     images = [
         os.path.join(IMAGE_FOLDER, image)
         for image in os.listdir(IMAGE_FOLDER)
-        if image.endswith(".jpg")
+        if image.endswith((".jpg", ".tif"))
     ]
 
-    main(
-        images, output_folder=OUTPUT_FOLDER, annotation_output_folder=ANNOTATION_FOLDER
-    )
-
-    # for folder in os.listdir(OUTPUT_FOLDER):
-    #     if os.path.isdir(os.path.join(OUTPUT_FOLDER, folder)):
+    image_cache = None
+    if args.image_cache:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        from image_cache import ImageCache
 
-    #         with open(os.path.join(OUTPUT_FOLDER, folder, f"{folder}.json"), "r") as f:
-    #             data = json.load(f)
+        image_cache = ImageCache(args.image_cache)
 
-    #         filter_cutouts(
-    #             data,
-    #             output_folder=ANNOTATION_FOLDER,
-    #             image_name=folder,
-    #         )
+    main(
+        images,
+        output_folder=OUTPUT_FOLDER,
+        annotation_output_folder=ANNOTATION_FOLDER,
+        image_cache=image_cache,
+        **(load_config(args.config) if args.config else {}),
+    )
@@ -0,0 +1,98 @@
+"""
+Benchmark the patch source of spot_text.py.
+
+Compares the on-disk path (mapreader's patchify_all writes every patch as an
+image file, MapTextRunner reads them back) with cropping the patches from the
+decoded map in memory. Inference is the same for both and is left out.
+
+Usage: python benchmark_patches.py [image_path] [repeat]
+Without an image, a synthetic 8000x6000 map is generated.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from mapreader import loader
+
+from spot_text import (
+    PATCH_SIZE,
+    OVERLAP,
+    load_image,
+    make_patch_dfs,
+    crop_patch,
+)
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+def make_synthetic_map(path: str, width: int = 8000, height: int = 6000):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(image).save(path, quality=90)
+
+
+def patches_from_disk(image_path: str, patch_folder: str) -> int:
+    map_loader = loader(image_path)
+    map_loader.patchify_all(
+        method="pixel", patch_size=PATCH_SIZE, overlap=OVERLAP, path_save=patch_folder
+    )
+
+    _, patch_df = map_loader.convert_images()
+
+    # This is what MapTextRunner.run_on_image does for every patch
+    for patch_path in patch_df["image_path"]:
+        _ = np.array(Image.open(patch_path).convert("RGB"))
+
+    return len(patch_df)
+
+
+def patches_in_memory(image_path: str) -> int:
+    image = load_image(image_path)
+    _, patch_df = make_patch_dfs(image_path, image)
+
+    for pixel_bounds in patch_df["pixel_bounds"]:
+        _ = crop_patch(image, pixel_bounds, PATCH_SIZE)
+
+    return len(patch_df)
+
+
+def main(image_path: str = "", repeat: int = 3):
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        if not image_path:
+            image_path = os.path.join(tmp, "synthetic.jpg")
+            make_synthetic_map(image_path)
+
+        timings = {"disk": [], "memory": []}
+
+        for n in range(repeat):
+            patch_folder = os.path.join(tmp, f"patches_{n}")
+
+            start = time.perf_counter()
+            n_disk = patches_from_disk(image_path, patch_folder)
+            timings["disk"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            n_memory = patches_in_memory(image_path)
+            timings["memory"].append(time.perf_counter() - start)
+
+        assert n_disk == n_memory, f"{n_disk} patches on disk, {n_memory} in memory"
+
+    disk, memory = min(timings["disk"]), min(timings["memory"])
+
+    print(f"{os.path.basename(image_path)}: {n_memory} patches of {PATCH_SIZE}px")
+    print(f"  patchify_all + read back: {disk:.2f}s")
+    print(f"  in memory:                {memory:.2f}s ({disk / memory:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    image_path = sys.argv[1] if len(sys.argv) > 1 else ""
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    main(image_path, repeat)
@@ -0,0 +1,113 @@
+"""
+Group the near-identical snippets of extract_snippets.py, so only one of
+every group goes through Loghi.
+
+Overlapping text spotting patches and repeated annotations give several
+snippets of the same word. Two snippets are near-identical when their
+bounding boxes on the map overlap (IoU of at least MIN_IOU) and their
+perceptual hashes (a difference hash of 64 bits, of the blurred snippet so
+the paper grain doesn't count) differ in at most MAX_DISTANCE bits. On the
+benchmark fixtures, snippets shifted by up to 3 pixels differ in 6 bits
+(median), different snippets in at least 19.
+
+Of every group, the largest snippet is the representative: extract_snippets
+only lists the representatives in lines.txt, and writes the other members
+of every group to groups.json:
+
+    {"<representative id>": ["<member id>", ...], ...}
+
+integrate_htr_results copies the transcription of a representative to the
+members of its group.
+"""
+
+import json
+
+import numpy as np
+import shapely
+from PIL import Image, ImageFilter
+
+HASH_SIZE = 8  # a hash of HASH_SIZE * HASH_SIZE bits
+MAX_DISTANCE = 12  # bits that differ
+BLUR = 2  # radius, in pixels
+MIN_IOU = 0.7  # of the bounding boxes
+
+
+def get_hash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash: is every pixel brighter than its right neighbour?"""
+
+    blurred = image.convert("L").filter(ImageFilter.GaussianBlur(BLUR))
+    small = blurred.resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def group_snippets(
+    ids: list,
+    bboxes: list,
+    hashes: list,
+    max_distance: int = MAX_DISTANCE,
+    min_iou: float = MIN_IOU,
+) -> dict:
+    """
+    The groups of near-identical snippets, as {representative id: [member
+    ids]}, without the snippets that are alone. Every member is near-identical
+    to its representative, which is the largest snippet of the group.
+    """
+
+    if len(ids) < 2:
+        return {}
+
+    boxes = shapely.box(*np.asarray(bboxes, dtype=float).T)
+    areas = shapely.area(boxes)
+
+    tree = shapely.STRtree(boxes)
+    left, right = tree.query(boxes, predicate="intersects")
+
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+
+    intersection = shapely.area(shapely.intersection(boxes[left], boxes[right]))
+    union = areas[left] + areas[right] - intersection
+    iou = np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+    # Hamming distance of the hashes
+    hashes = np.array(hashes, dtype=np.uint64)
+    xor = (hashes[left] ^ hashes[right]).view(np.uint8).reshape(-1, 8)
+    distance = np.unpackbits(xor, axis=1).sum(axis=1)
+
+    alike = (iou >= min_iou) & (distance <= max_distance)
+    left, right = left[alike], right[alike]
+
+    neighbours = [[] for _ in range(len(ids))]
+    for i, j in zip(left.tolist(), right.tolist()):
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+
+    # Greedy, largest snippet first
+    grouped = np.zeros(len(ids), dtype=bool)
+    groups = {}
+    for i in np.argsort(-areas, kind="stable"):
+        if grouped[i]:
+            continue
+        grouped[i] = True
+
+        members = [j for j in neighbours[i] if not grouped[j]]
+        if members:
+            grouped[members] = True
+            groups[ids[i]] = [ids[j] for j in members]
+
+    return groups
+
+
+def read_groups(groups_path: str) -> dict:
+    with open(groups_path) as f:
+        return json.load(f)
+
+
+def write_groups(groups_path: str, groups: dict):
+    with open(groups_path, "w") as f:
+        json.dump(groups, f, indent=2)
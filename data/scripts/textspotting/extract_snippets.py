@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import argparse
 
 from svgpathtools import svgstr2paths
 from PIL import Image
@@ -8,6 +9,8 @@ from PIL import Image
 import cv2
 import numpy as np
 
+from dedup_snippets import get_hash, group_snippets, write_groups
+
 Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombError
 
 MINIMUM_WIDTH = 35
@@ -29,16 +32,80 @@ def parse_annotation_page(annotation_page):
     return annotation2svg
 
 
+def crop_region(image, box) -> Image.Image:
+    """
+    image.crop(box) of a PIL image, a (memory-mapped) RGB array or a
+    pyramid.PyramidReader, which is black outside of the image either way.
+    """
+
+    if isinstance(image, Image.Image):
+        return image.crop(box)
+
+    left, top, right, bottom = box
+    if not isinstance(image, np.ndarray):
+        # Only the tiles of the pyramid under the box are decoded
+        return Image.fromarray(image.read(0, left, top, right - left, bottom - top))
+
+    region = np.zeros((bottom - top, right - left, 3), dtype=np.uint8)
+
+    height, width = image.shape[:2]
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(right, width), min(bottom, height)
+    if x0 < x1 and y0 < y1:
+        region[y0 - top : y1 - top, x0 - left : x1 - left] = image[y0:y1, x0:x1]
+
+    return Image.fromarray(region)
+
+
+def clip_to_frame(region: Image.Image, left: int, top: int, size: tuple) -> Image.Image:
+    """
+    The region at (left, top) of an image of `size`, black outside of that
+    image's frame, like a crop of the whole image rotated in place.
+    """
+
+    width, height = size
+    x0, y0 = max(-left, 0), max(-top, 0)
+    x1, y1 = min(width - left, region.width), min(height - top, region.height)
+    if (x0, y0, x1, y1) == (0, 0, region.width, region.height):
+        return region
+
+    clipped = Image.new(region.mode, region.size)
+    if x0 < x1 and y0 < y1:
+        clipped.paste(region.crop((x0, y0, x1, y1)), (x0, y0))
+    return clipped
+
+
 def extract_snippets(
-    image_file_path: str, annotation_page_path: str, output_folder: str
+    image_file_path: str,
+    annotation_page_path: str,
+    output_folder: str,
+    image_cache=None,
+    dedup: bool = True,
 ):
+    """
+    Cut out the spotted text of a map for Loghi. With `dedup`, near-identical
+    snippets are grouped (see dedup_snippets.py) and only one of every group
+    is listed in lines.txt. Returns the number of snippets and of listed ones.
+    """
 
     image_name_without_extension = os.path.splitext(os.path.basename(image_file_path))[
         0
     ]
 
-    # Load the image
-    image = Image.open(image_file_path)
+    # Load the image (without decoding it again, if it is in the image cache,
+    # or if it is a pyramidal TIFF of download_images.py --format tif: then
+    # only the regions around the snippets are read)
+    if image_cache is not None:
+        image = image_cache.open(image_file_path)
+        size = image.shape[1::-1]
+    elif image_file_path.endswith((".tif", ".tiff")):
+        from pyramid import PyramidReader
+
+        image = PyramidReader(image_file_path)
+        size = image.size(0)
+    else:
+        image = Image.open(image_file_path)
+        size = image.size
     # image = cv2.imread(f"/media/leon/HDE0069/GLOBALISE/maps/download/{image_uuid}.jpg")
 
     # Load the annotations
@@ -50,6 +117,7 @@ def extract_snippets(
     os.makedirs(snippets_image_folder, exist_ok=True)
 
     snippets = []
+    ids, bboxes, hashes = [], [], []
 
     print(f"Extracting snippets from {image_name_without_extension}")
     for annotation in annotations:
@@ -64,7 +132,7 @@ def extract_snippets(
             continue
 
         # Find minimum bounding box (rotated rectangle)
-        (center, (width, height), angle) = cv2.minAreaRect(np.array(coords))
+        center, (width, height), angle = cv2.minAreaRect(np.array(coords))
 
         # Check if the box is too small
         if width < MINIMUM_WIDTH or height < MINIMUM_HEIGHT:
@@ -72,32 +140,77 @@ def extract_snippets(
 
         box = cv2.boxPoints((center, (width, height), angle))
 
+        # Only the region around the box is rotated, not the whole image: it
+        # holds every pixel that rotates into the crop. The rotated region is
+        # then clipped to the frame of the image, where rotating the whole
+        # image would cut it off, so near the border the snippet is black
+        # outside the scan as before. PIL's nearest-neighbour rotation rounds
+        # a little differently in the smaller frame, so a few pixels (0.3% on
+        # a test map) are sampled from a different source pixel
+        radius = int(np.hypot(width, height) / 2) + 2
+        left, top = int(center[0]) - radius, int(center[1]) - radius
+        region = crop_region(image, (left, top, left + 2 * radius, top + 2 * radius))
+        region_center = (center[0] - left, center[1] - top)
+
         # Rotate the image and the box
         if width < height:
             M = cv2.getRotationMatrix2D(center, angle - 90, 1.0)
             rotated_box = cv2.transform(np.array([box]), M)[0]
 
-            image_rotated = image.rotate(angle - 90, center=center)
+            region_rotated = region.rotate(angle - 90, center=region_center)
         else:
             M = cv2.getRotationMatrix2D(center, angle, 1.0)
             rotated_box = cv2.transform(np.array([box]), M)[0]
 
-            image_rotated = image.rotate(angle, center=center)
+            region_rotated = region.rotate(angle, center=region_center)
+
+        region_rotated = clip_to_frame(region_rotated, left, top, size)
 
         rotated_box = np.intp(rotated_box)
 
         # Crop the image
         x, y, w, h = cv2.boundingRect(rotated_box)
-        square = image_rotated.crop((x, y, x + w, y + h))
+        square = region_rotated.crop((x - left, y - top, x - left + w, y - top + h))
 
         # Save
         # cv2.imwrite(f"snippets/{annotation_id}.png", image)
-        snippet_path = os.path.join(snippets_image_folder, f"{annotation_id}.png")  # for Loghi
+        snippet_path = os.path.join(
+            snippets_image_folder, f"{annotation_id}.png"
+        )  # for Loghi
         square.save(snippet_path)
         snippets.append(snippet_path)
+        ids.append(annotation_id)
+
+        if dedup:
+            xs, ys = [x for x, _ in coords], [y for _, y in coords]
+            bboxes.append((min(xs), min(ys), max(xs), max(ys)))
+            hashes.append(get_hash(square))
+
+    if not isinstance(image, np.ndarray):
+        image.close()
+
+    # Only the representative of every group goes to Loghi
+    groups = group_snippets(ids, bboxes, hashes) if dedup else {}
+    write_groups(os.path.join(snippets_image_folder, "groups.json"), groups)
+
+    duplicates = {member for members in groups.values() for member in members}
+    lines = [
+        snippet_path
+        for annotation_id, snippet_path in zip(ids, snippets)
+        if annotation_id not in duplicates
+    ]
 
     with open(f"{snippets_image_folder}/lines.txt", "w") as f:
-        f.write("\n".join(snippets))
+        f.write("\n".join(lines))
+
+    if snippets:
+        print(
+            f"Sending {len(lines)}/{len(snippets)} snippets to HTR, "
+            f"{len(duplicates)} duplicates in {len(groups)} groups "
+            f"({len(duplicates) / len(snippets):.0%} less HTR work)"
+        )
+
+    return len(snippets), len(lines)
 
 
 if __name__ == "__main__":
@@ -108,16 +221,38 @@ if __name__ == "__main__":
     # )
     # SNIPPET_FOLDER = "/home/leon/Documents/GLOBALISE/necessary-reunions/scripts/textspotting/snippets"
 
-    if len(sys.argv) != 4:
-        print(
-            "Usage: python extract_snippets.py <image_folder> <ap_folder> <snippet_folder>"
-        )
-        sys.exit(1)
-
-    IMAGE_FOLDER = sys.argv[1]
-    AP_FOLDER = sys.argv[2]
-    SNIPPET_FOLDER = sys.argv[3]
-
+    parser = argparse.ArgumentParser(
+        usage="python extract_snippets.py <image_folder> <ap_folder> <snippet_folder>"
+    )
+    parser.add_argument("image_folder")
+    parser.add_argument("ap_folder")
+    parser.add_argument("snippet_folder")
+    parser.add_argument(
+        "--image-cache",
+        metavar="FOLDER",
+        help="Open the decoded maps from this image cache (needs image_cache.py)",
+    )
+    parser.add_argument(
+        "--keep-duplicates",
+        action="store_true",
+        help="Send every snippet to HTR, also the near-identical ones",
+    )
+    args = parser.parse_args()
+
+    IMAGE_FOLDER = args.image_folder
+    AP_FOLDER = args.ap_folder
+    SNIPPET_FOLDER = args.snippet_folder
+
+    # image_cache.py and pyramid.py live in data/scripts
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+    image_cache = None
+    if args.image_cache:
+        from image_cache import ImageCache
+
+        image_cache = ImageCache(args.image_cache)
+
+    n_snippets, n_lines = 0, 0
     for image in os.listdir(IMAGE_FOLDER):
 
         image_file_path = os.path.join(IMAGE_FOLDER, image)
@@ -133,4 +268,18 @@ if __name__ == "__main__":
             print(f"Annotation page not found for {image_file_path}")
             continue
 
-        extract_snippets(image_file_path, annotation_page_file_path, SNIPPET_FOLDER)
+        n, n_sent = extract_snippets(
+            image_file_path,
+            annotation_page_file_path,
+            SNIPPET_FOLDER,
+            image_cache=image_cache,
+            dedup=not args.keep_duplicates,
+        )
+        n_snippets += n
+        n_lines += n_sent
+
+    if n_snippets:
+        print(
+            f"Sent {n_lines}/{n_snippets} snippets to HTR "
+            f"({1 - n_lines / n_snippets:.0%} less HTR work)"
+        )
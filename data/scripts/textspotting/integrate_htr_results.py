@@ -1,74 +1,108 @@
 import os
 import json
+import argparse
 import pandas as pd
 
+from dedup_snippets import read_groups
 
-def main(snippets_folder: str, annotation_page_folder: str):
 
-    for image_name in os.listdir(snippets_folder):
+def integrate_htr_results(
+    annotation_page_path: str,
+    results_file_path: str,
+    output_path: str = None,
+    groups_path: str = None,
+):
+    """
+    Add the Loghi transcriptions in `results_file_path` to the annotations of
+    one AnnotationPage, and drop the annotations without a transcription. The
+    page is written to `output_path`, or back to `annotation_page_path`.
+    With the groups.json of extract_snippets, the members of a group of
+    near-identical snippets get the transcription of its representative.
+    """
 
-        annotation_page_path = os.path.join(
-            annotation_page_folder, image_name + ".json"
-        )
-        with open(annotation_page_path, "r") as f:
-            annotation_page = json.load(f)
+    with open(annotation_page_path, "r") as f:
+        annotation_page = json.load(f)
 
-        results_file_path = os.path.join(snippets_folder, image_name, "results.tsv")
-        df = pd.read_csv(
-            results_file_path, sep="\t", header=None, names=["id", "confidence", "text"]
-        )
+    df = pd.read_csv(
+        results_file_path, sep="\t", header=None, names=["id", "confidence", "text"]
+    )
+
+    df["id"] = [i.rsplit("/", 1)[-1].replace(".png", "") for i in df["id"]]
+
+    if groups_path and os.path.exists(groups_path):
+        groups = read_groups(groups_path)
+        members = [
+            (member, confidence, text)
+            for annotation_id, confidence, text in df.itertuples(index=False)
+            for member in groups.get(annotation_id, [])
+        ]
+        df = pd.concat([df, pd.DataFrame(members, columns=df.columns)])
+
+    #                                        id  confidence     text
+    #      0e180836-48e5-4f7a-ab5a-fb4d518cd924    0.991326    Copie
 
-        df["id"] = [i.rsplit("/", 1)[-1].replace(".png", "") for i in df["id"]]
+    annotations = []
+    for annotation in annotation_page["items"]:
+        annotation_id = annotation["id"]
 
-        #                                        id  confidence     text
-        #      0e180836-48e5-4f7a-ab5a-fb4d518cd924    0.991326    Copie
+        result = df.loc[df["id"] == annotation_id, ["confidence", "text"]].values
 
-        annotations = []
-        for annotation in annotation_page["items"]:
-            annotation_id = annotation["id"]
+        if len(result) == 0:
+            continue
+        else:
+            confidence, text = result[0]
 
-            result = df.loc[df["id"] == annotation_id, ["confidence", "text"]].values
+        if pd.isna(text):
+            continue
 
-            if len(result) == 0:
-                continue
-            else:
-                confidence, text = result[0]
+        print(f"Annotation ID: {annotation_id}, Confidence: {confidence}, Text: {text}")
 
-            if pd.isna(text):
-                continue
+        body = {
+            "type": "TextualBody",
+            "value": text.strip(),
+            "format": "text/plain",
+            "purpose": "supplementing",
+            "generator": {
+                "id": "https://hdl.handle.net/10622/X2JZYY",
+                "type": "Software",
+                "label": "GLOBALISE Loghi Handwritten Text Recognition Model - August 2023",
+            },
+        }
 
-            print(
-                f"Annotation ID: {annotation_id}, Confidence: {confidence}, Text: {text}"
-            )
+        annotation["body"].append(body)
+        annotations.append(annotation)
 
-            body = {
-                "type": "TextualBody",
-                "value": text.strip(),
-                "format": "text/plain",
-                "purpose": "supplementing",
-                "generator": {
-                    "id": "https://hdl.handle.net/10622/X2JZYY",
-                    "type": "Software",
-                    "label": "GLOBALISE Loghi Handwritten Text Recognition Model - August 2023",
-                },
-            }
+    # update annotations
+    annotation_page["items"] = annotations
 
-            annotation["body"].append(body)
-            annotations.append(annotation)
+    with open(output_path or annotation_page_path, "w") as f:
+        json.dump(annotation_page, f, indent=2)
 
-        # update annotations
-        annotation_page["items"] = annotations
 
-        print(f"Writing {image_name} annotation page")
-        with open(annotation_page_path, "w") as f:
-            json.dump(annotation_page, f, indent=2)
+def main(snippets_folder: str, annotation_page_folder: str):
+
+    for image_name in os.listdir(snippets_folder):
+
+        annotation_page_path = os.path.join(
+            annotation_page_folder, image_name + ".json"
+        )
+        results_file_path = os.path.join(snippets_folder, image_name, "results.tsv")
+        groups_path = os.path.join(snippets_folder, image_name, "groups.json")
+
+        integrate_htr_results(
+            annotation_page_path, results_file_path, groups_path=groups_path
+        )
+
+        print(f"Wrote {image_name} annotation page")
 
 
 if __name__ == "__main__":
-    SNIPPETSFOLDER = "/home/leon/Documents/GLOBALISE/necessary-reunions/scripts/textspotting/snippets"
 
-    ANNOTATION_PAGE_FOLDER = (
-        "/home/leon/Documents/GLOBALISE/necessary-reunions/scripts/textspotting/results"
+    parser = argparse.ArgumentParser(
+        usage="python integrate_htr_results.py <snippets_folder> <annotation_page_folder>"
     )
+    parser.add_argument("snippets_folder", help="With a results.tsv from Loghi per map")
+    parser.add_argument("annotation_page_folder", help="Updated in place")
+    args = parser.parse_args()
 
-    main(SNIPPETSFOLDER, ANNOTATION_PAGE_FOLDER)
+    main(args.snippets_folder, args.annotation_page_folder)
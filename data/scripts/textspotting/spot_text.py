@@ -2,10 +2,13 @@ import os
 import sys
 import json
 import uuid
-from lxml import etree
+import argparse
+import functools
+import numpy as np
+import shapely
 
-from mapreader import loader
-from mapreader import MapTextRunner
+# pandas, lxml and mapreader (which loads torch and detectron2) are imported
+# where they are used, so importing this module for its helpers stays fast
 
 # paths to our config and weights files for the text spotting model
 cfg_file = "./MapTextPipeline/configs/ViTAEv2_S/rumsey/final_rumsey.yaml"
@@ -15,10 +18,165 @@ from PIL import Image
 
 Image.MAX_IMAGE_PIXELS = None
 
+PATCH_SIZE = 1024
+OVERLAP = 0.1
+DUPLICATE_OVERLAP = 0.7  # part of the smaller polygon covered by the other
+
+
+@functools.cache
+def get_in_memory_runner():
+    """InMemoryMapTextRunner, defined on first use (it needs mapreader)."""
+
+    from mapreader import MapTextRunner
+
+    class InMemoryMapTextRunner(MapTextRunner):
+        """
+        MapTextRunner that crops its patches from the decoded map in memory,
+        instead of reading patch files that were written to disk by patchify_all.
+        """
+
+        def __init__(self, image: np.ndarray, patch_size: int, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.image = image
+            self.patch_size = patch_size
+
+        def run_on_image(
+            self,
+            img_path: str,
+            return_outputs=False,
+            return_dataframe: bool = False,
+            min_ioa: float = 0.7,
+        ):
+            # img_path is the patch id, the pixel bounds tell us where to crop
+            patch = crop_patch(
+                self.image,
+                self.patch_df.loc[img_path, "pixel_bounds"],
+                self.patch_size,
+            )
+
+            outputs = self.predictor(patch)
+            outputs["image_id"] = img_path
+            outputs["img_path"] = img_path
+
+            if return_outputs:
+                return outputs
+
+            return self._get_patch_predictions(
+                outputs, return_dataframe=return_dataframe, min_ioa=min_ioa
+            )
+
+    return InMemoryMapTextRunner
+
+
+def load_image(image_path: str, image_cache=None) -> np.ndarray:
+    """
+    Decode the map once into an RGB array, or map the already decoded array
+    from an ImageCache (see data/scripts/image_cache.py).
+    """
+    if image_cache is not None:
+        return image_cache.open(image_path)
+
+    with Image.open(image_path) as image:
+        return np.asarray(image.convert("RGB"))
+
+
+def get_patch_bounds(width: int, height: int, patch_size: int, overlap: float):
+    """
+    Same patch grid as mapreader's patchify_all(method="pixel"): columns first,
+    the last row and column are cut off at the border of the map.
+    """
+    step = patch_size - int(patch_size * overlap)
+
+    for x in range(0, width, step):
+        for y in range(0, height, step):
+            yield x, y, min(x + patch_size, width), min(y + patch_size, height)
+
+
+def crop_patch(image: np.ndarray, pixel_bounds, patch_size: int) -> np.ndarray:
+    min_x, min_y, max_x, max_y = pixel_bounds
+
+    patch = image[min_y:max_y, min_x:max_x]
+
+    # Edge patches are padded with black to the full patch size, like mapreader does
+    if patch.shape[0] != patch_size or patch.shape[1] != patch_size:
+        padded = np.zeros((patch_size, patch_size, image.shape[2]), dtype=image.dtype)
+        padded[: patch.shape[0], : patch.shape[1]] = patch
+        return padded
+
+    return np.ascontiguousarray(patch)
+
+
+def make_patch_dfs(
+    image_path: str,
+    image: np.ndarray,
+    patch_size: int = PATCH_SIZE,
+    overlap: float = OVERLAP,
+):
+    """
+    Make the parent and patch dataframes that MapTextRunner expects, without
+    writing any patch to disk. The patch ids follow mapreader's naming.
+    """
+    import pandas as pd
+
+    height, width = image.shape[:2]
+    parent_id = os.path.basename(image_path)
+
+    parent_df = pd.DataFrame(
+        [{"image_path": os.path.abspath(image_path), "shape": image.shape}],
+        index=pd.Index([parent_id], name="image_id"),
+    )
+
+    patches = []
+    for min_x, min_y, max_x, max_y in get_patch_bounds(
+        width, height, patch_size, overlap
+    ):
+        patch_id = f"patch-{min_x}-{min_y}-{max_x}-{max_y}-#{parent_id}#.png"
+        patches.append(
+            {
+                "image_id": patch_id,
+                "image_path": patch_id,
+                "parent_id": parent_id,
+                "shape": (patch_size, patch_size, image.shape[2]),
+                "pixel_bounds": (min_x, min_y, max_x, max_y),
+            }
+        )
+
+    patch_df = pd.DataFrame(patches).set_index("image_id")
+
+    return parent_df, patch_df
+
+
+def recognize_text(image_path: str, in_memory: bool = True, image_cache=None):
+    if not in_memory:
+        return recognize_text_from_disk(image_path)
+
+    image = load_image(image_path, image_cache=image_cache)
+    parent_df, patch_df = make_patch_dfs(image_path, image)
+
+    map_text_runner = get_in_memory_runner()(
+        image,
+        PATCH_SIZE,
+        patch_df,
+        parent_df,
+        cfg_file=cfg_file,
+        weights_file=weights_file,
+    )
+
+    map_text_runner.run_all()
+
+    predictions_df = map_text_runner.convert_to_parent_pixel_bounds(
+        return_dataframe=True
+    )
+
+    return predictions_df
+
+
+def recognize_text_from_disk(image_path: str):
+    from mapreader import loader, MapTextRunner
 
-def recognize_text(image_path: str):
     map_loader = loader(image_path)
-    map_loader.patchify_all(method="pixel", patch_size=1024, overlap=0.1)
+    map_loader.patchify_all(method="pixel", patch_size=PATCH_SIZE, overlap=OVERLAP)
 
     parent_df, patch_df = map_loader.convert_images()
 
@@ -38,7 +196,67 @@ def recognize_text(image_path: str):
     return predictions_df
 
 
+def suppress_duplicates(predictions_df, min_overlap: float = DUPLICATE_OVERLAP):
+    """
+    Remove words that were spotted more than once where patches overlap.
+
+    Two predictions are duplicates when the intersection covers more than
+    `min_overlap` of the smaller polygon, which also catches words that were
+    cut off at a patch border. Of every group, the prediction with the most
+    complete text (then the highest score, then the largest polygon) is kept.
+    Candidate pairs come from an STRtree, so this stays close to linear in
+    the number of predictions.
+    """
+    if len(predictions_df) < 2:
+        return predictions_df
+
+    geometries = predictions_df["geometry"].to_numpy()
+    areas = shapely.area(geometries)
+    text_lengths = predictions_df["text"].fillna("").str.strip().str.len().to_numpy()
+    scores = predictions_df["score"].to_numpy()
+
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate="intersects")
+
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+
+    intersection = shapely.area(
+        shapely.intersection(geometries[left], geometries[right])
+    )
+    smallest = np.minimum(areas[left], areas[right])
+    overlap = np.divide(
+        intersection, smallest, out=np.zeros_like(intersection), where=smallest > 0
+    )
+
+    duplicates = overlap > min_overlap
+    left, right = left[duplicates], right[duplicates]
+
+    neighbours = [[] for _ in range(len(geometries))]
+    for i, j in zip(left.tolist(), right.tolist()):
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+
+    # Greedy, best prediction first
+    order = np.lexsort((-areas, -scores, -text_lengths))
+
+    suppressed = np.zeros(len(geometries), dtype=bool)
+    for i in order:
+        if suppressed[i]:
+            continue
+        for j in neighbours[i]:
+            suppressed[j] = True
+
+    n_duplicates = int(suppressed.sum())
+    print(
+        f"Deleted {n_duplicates}/{len(predictions_df)} duplicate predictions. Remaining: {len(predictions_df) - n_duplicates}."
+    )
+
+    return predictions_df[~suppressed]
+
+
 def getSVG(polygon):
+    from lxml import etree
 
     coordinates = list(polygon.exterior.coords)
 
@@ -108,16 +326,37 @@ def convert_to_annotations(predictions_df, canvas_id: str):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python recognize_text.py <image_path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_path")
+    parser.add_argument(
+        "--on-disk",
+        action="store_true",
+        help="Write the patches to disk with mapreader's patchify_all",
+    )
+    parser.add_argument(
+        "--image-cache",
+        metavar="FOLDER",
+        help="Open the decoded map from this image cache (needs image_cache.py)",
+    )
+    args = parser.parse_args()
 
-    image_path = str(sys.argv[1])
+    image_path = args.image_path
     image_name = os.path.splitext(os.path.basename(image_path))[0]
 
     canvas_id = "canvas:" + image_name
 
-    predictions_df = recognize_text(image_path)
+    image_cache = None
+    if args.image_cache:
+        # image_cache.py lives in data/scripts, or next to this script in the container
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        from image_cache import ImageCache
+
+        image_cache = ImageCache(args.image_cache)
+
+    predictions_df = recognize_text(
+        image_path, in_memory=not args.on_disk, image_cache=image_cache
+    )
+    predictions_df = suppress_duplicates(predictions_df)
     annotationPage = convert_to_annotations(predictions_df, canvas_id)
 
     with open(f"results/{image_name}.json", "w") as f:
@@ -1,44 +1,203 @@
+"""
+Point the annotations of every AnnotationPage to the canvas of their map in
+the manifest (`target.source`).
+
+The pages are rewritten as a stream with ijson: one annotation is parsed,
+updated and written at a time, so memory stays flat even for pages of
+hundreds of MB. The output is the same as json.dump(page, f, indent=2).
+Pages are rewritten in parallel, pages that already point to the right
+canvas are skipped, and a page is only replaced once it is completely written.
+
+Needs ijson (pip install ijson).
+"""
+
 import os
-import sys
 import json
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import ijson
+
+INDENT = 2
+
+START_EVENTS = ("start_map", "start_array")
+END_EVENTS = ("end_map", "end_array")
+
+
+def get_canvas_ids(manifest_path: str) -> dict:
+    """Map the filename (from the metadata) of every canvas to its id."""
+
+    canvas_ids = {}
+
+    with open(manifest_path, "rb") as f:
+        for canvas in ijson.items(f, "items.item", use_float=True):
+
+            for m in canvas.get("metadata", []):
+                if m["label"]["en"][0] == "Filename":
+                    canvas_ids[m["value"]["none"][0]] = canvas["id"]
+                    break
+
+    return canvas_ids
+
+
+def has_canvas_id(annotation_page_path: str, canvas_id: str) -> bool:
+    """Whether all annotations target `canvas_id` (stops at the first that doesn't)."""
+
+    with open(annotation_page_path, "rb") as f:
+        for source in ijson.items(f, "items.item.target.source"):
+            if source != canvas_id:
+                return False
+
+    return True
+
+
+def build_value(event: str, value, events):
+    """Build the (possibly nested) value that starts with this event."""
+
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+
+    depth = 1 if event in START_EVENTS else 0
+    while depth:
+        event, value = next(events)
+        builder.event(event, value)
+
+        if event in START_EVENTS:
+            depth += 1
+        elif event in END_EVENTS:
+            depth -= 1
+
+    return builder.value
+
 
+def dumps(value, depth: int) -> str:
+    """json.dumps(value, indent=INDENT), for a value nested `depth` levels deep."""
+    return json.dumps(value, indent=INDENT).replace("\n", "\n" + " " * INDENT * depth)
 
-def main(manifest_path: str, annotation_page_folder: str):
-    with open(manifest_path) as f:
-        manifest = json.load(f)
 
-    for canvas in manifest["items"]:
-        canvas_id = canvas["id"]
+def rewrite_annotation_page(infile, outfile, canvas_id: str):
+    """Copy the AnnotationPage from infile to outfile, with the new canvas id."""
 
-        # Extract the scan name from the metadata
-        scan_name = [
-            m["value"]["none"][0]
-            for m in canvas["metadata"]
-            if m["label"]["en"][0] == "Filename"
-        ][0]
+    padding = " " * INDENT
+    events = ijson.basic_parse(infile, use_float=True)
 
-        annotation_page_path = os.path.join(annotation_page_folder, f"{scan_name}.json")
-        with open(annotation_page_path) as f:
-            annotation_page = json.load(f)
+    event, _ = next(events)
+    if event != "start_map":
+        raise ValueError("Not an AnnotationPage")
 
-        print(f"Updating annotation page for {scan_name} with canvas ID {canvas_id}")
-        for annotation in annotation_page["items"]:
+    outfile.write("{")
+
+    n_keys = 0
+    for event, key in events:
+        if event == "end_map":
+            break
+
+        outfile.write(f"{',' if n_keys else ''}\n{padding}{json.dumps(key)}: ")
+        n_keys += 1
+
+        event, value = next(events)
+
+        if key != "items" or event != "start_array":
+            outfile.write(dumps(build_value(event, value, events), depth=1))
+            continue
+
+        # The annotations, one at a time
+        outfile.write("[")
+
+        n_items = 0
+        for event, value in events:
+            if event == "end_array":
+                break
+
+            annotation = build_value(event, value, events)
             annotation["target"]["source"] = canvas_id
 
-        with open(annotation_page_path, "w") as f:
-            json.dump(annotation_page, f, indent=2)
+            outfile.write(f"{',' if n_items else ''}\n{padding * 2}")
+            outfile.write(dumps(annotation, depth=2))
+            n_items += 1
+
+        outfile.write(f"\n{padding}]" if n_items else "]")
+
+    outfile.write("\n}" if n_keys else "}")
+
+
+def update_annotation_page(annotation_page_path: str, canvas_id: str) -> str:
+    """Rewrite one page, if needed. Returns what happened, for the summary."""
+
+    if not os.path.exists(annotation_page_path):
+        return "missing"
+
+    if has_canvas_id(annotation_page_path, canvas_id):
+        return "skipped"
+
+    # Write next to the page, then replace it: an interrupted run leaves the
+    # original page intact
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(annotation_page_path) or ".", suffix=".tmp"
+    )
+    try:
+        with open(annotation_page_path, "rb") as infile, os.fdopen(fd, "w") as outfile:
+            rewrite_annotation_page(infile, outfile, canvas_id)
+        # mkstemp creates the file readable by its owner only
+        shutil.copymode(annotation_page_path, tmp_path)
+        os.replace(tmp_path, annotation_page_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return "updated"
+
+
+def main(manifest_path: str, annotation_page_folder: str, max_workers: int = None):
+
+    canvas_ids = get_canvas_ids(manifest_path)
+
+    counts = {"updated": 0, "skipped": 0, "missing": 0}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                update_annotation_page,
+                os.path.join(annotation_page_folder, f"{scan_name}.json"),
+                canvas_id,
+            ): (scan_name, canvas_id)
+            for scan_name, canvas_id in canvas_ids.items()
+        }
+
+        for future, (scan_name, canvas_id) in futures.items():
+            result = future.result()
+            counts[result] += 1
+
+            if result == "updated":
+                print(f"Updated annotation page for {scan_name} to {canvas_id}")
+            elif result == "missing":
+                print(f"No annotation page for {scan_name}")
+
+    print(
+        f"{counts['updated']} updated, {counts['skipped']} already up to date, "
+        f"{counts['missing']} missing."
+    )
 
 
 if __name__ == "__main__":
 
-    manifest_path = sys.argv[1] if len(sys.argv) > 1 else "manifest.json"
-    annotation_page_folder = sys.argv[2] if len(sys.argv) > 2 else "results"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("manifest_path", nargs="?", default="manifest.json")
+    parser.add_argument("annotation_page_folder", nargs="?", default="results")
+    parser.add_argument(
+        "--max-workers", type=int, default=None, help="Default: number of CPUs"
+    )
+    args = parser.parse_args()
 
-    if not os.path.exists(manifest_path):
-        print(f"Manifest file not found: {manifest_path}")
-        sys.exit(1)
-    if not os.path.exists(annotation_page_folder):
-        print(f"Annotation page folder not found: {annotation_page_folder}")
-        sys.exit(1)
+    if not os.path.exists(args.manifest_path):
+        print(f"Manifest file not found: {args.manifest_path}")
+        parser.exit(1)
+    if not os.path.exists(args.annotation_page_folder):
+        print(f"Annotation page folder not found: {args.annotation_page_folder}")
+        parser.exit(1)
 
-    main(manifest_path, annotation_page_folder)
+    main(args.manifest_path, args.annotation_page_folder, args.max_workers)
@@ -0,0 +1,435 @@
+"""
+Spread the pipeline over several machines that share a filesystem.
+
+    python data/scripts/work_queue.py init          # once, and after adding maps
+    python data/scripts/work_queue.py work --stages download segment spot
+    python data/scripts/work_queue.py status
+
+The job table (one job per map of data/selection.csv) is an SQLite database
+in the shared work folder. A worker claims a map with a lease, renews the
+lease with heartbeats while pipeline.py runs the stages for it, and records
+the outcome of every stage. When a worker dies, its lease expires and the
+map goes back to the queue; a map that failed --max-attempts times is
+marked as failed. Because the pipeline skips stages whose outputs are up to
+date, a map that is picked up again continues where it stopped.
+
+The leases rely on SQLite's file locking on the shared filesystem (fine on
+NFSv4 and Lustre, not on NFS mounted with nolock) and on clocks that are in
+sync between the machines.
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+
+import pipeline
+
+DATABASE = os.path.join(pipeline.WORK_FOLDER, "queue.sqlite")
+LEASE = 600  # seconds before an unrenewed lease expires
+HEARTBEAT = 60  # seconds between lease renewals
+POLL = 30  # seconds between looks at the queue when all maps are leased
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',  -- queued, leased, done or failed
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    name TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    outcome TEXT  -- done, failed or lost (the lease expired)
+);
+CREATE TABLE IF NOT EXISTS stage_runs (
+    name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    status TEXT NOT NULL,  -- see Pipeline.run
+    seconds REAL NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+class WorkQueue:
+    """
+    The job table. Every thread needs its own WorkQueue, as sqlite3
+    connections can't be shared between threads.
+    """
+
+    def __init__(
+        self, path: str = DATABASE, lease: float = LEASE, max_attempts=MAX_ATTEMPTS
+    ):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        # No WAL: it needs shared memory, which doesn't work across machines.
+        # Transactions are explicit (BEGIN IMMEDIATE) and wait for each other.
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def transaction(self):
+        return _Transaction(self.db)
+
+    def add(self, maps: list) -> int:
+        """Add the maps that aren't in the table yet. Returns how many were added."""
+
+        with self.transaction():
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO jobs (name, url) VALUES (?, ?)",
+                [(m["name"], m["url"]) for m in maps],
+            )
+            return self.db.total_changes - before
+
+    def register(self, worker: str):
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "INSERT OR REPLACE INTO workers (worker, started, heartbeat) VALUES (?, ?, ?)",
+                (worker, now, now),
+            )
+
+    def _expire_leases(self, now: float):
+        """Put the maps whose lease expired back in the queue (or give up on them)."""
+
+        self.db.execute(
+            "UPDATE attempts SET finished = ?, outcome = 'lost' WHERE finished IS NULL"
+            " AND name IN (SELECT name FROM jobs WHERE status = 'leased' AND lease_expires < ?)",
+            (now, now),
+        )
+        self.db.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+            " worker = NULL, lease_expires = NULL"
+            " WHERE status = 'leased' AND lease_expires < ?",
+            (self.max_attempts, now),
+        )
+
+    def claim(self, worker: str) -> dict:
+        """Lease the next queued map to `worker`. Returns None when there is none."""
+
+        now = time.time()
+        with self.transaction():
+            self._expire_leases(now)
+
+            row = self.db.execute(
+                "SELECT name, url FROM jobs WHERE status = 'queued'"
+                " ORDER BY attempts, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.db.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE name = ?",
+                (worker, now + self.lease, row["name"]),
+            )
+            self.db.execute(
+                "INSERT INTO attempts (name, worker, started) VALUES (?, ?, ?)",
+                (row["name"], worker, now),
+            )
+
+        return {"name": row["name"], "url": row["url"]}
+
+    def heartbeat(self, worker: str, name: str) -> bool:
+        """Renew the lease on `name`. Returns False when the worker has lost it."""
+
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "UPDATE workers SET heartbeat = ? WHERE worker = ?", (now, worker)
+            )
+            renewed = self.db.execute(
+                "UPDATE jobs SET lease_expires = ?"
+                " WHERE name = ? AND worker = ? AND status = 'leased'",
+                (now + self.lease, name, worker),
+            ).rowcount
+
+        return renewed == 1
+
+    def record_stage(
+        self, name: str, stage: str, worker: str, status: str, seconds: float
+    ):
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO stage_runs (name, stage, worker, status, seconds, finished)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (name, stage, worker, status, seconds, time.time()),
+            )
+
+    def finish(self, worker: str, name: str, ok: bool) -> bool:
+        """Release the lease on `name`. Returns False when the worker had lost it."""
+
+        now = time.time()
+        with self.transaction():
+            released = self.db.execute(
+                "UPDATE jobs SET status = CASE WHEN ? THEN 'done'"
+                " WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+                " worker = NULL, lease_expires = NULL"
+                " WHERE name = ? AND worker = ? AND status = 'leased'",
+                (ok, self.max_attempts, name, worker),
+            ).rowcount
+
+            if released:
+                self.db.execute(
+                    "UPDATE attempts SET finished = ?, outcome = ?"
+                    " WHERE name = ? AND worker = ? AND finished IS NULL",
+                    (now, "done" if ok else "failed", name, worker),
+                )
+
+        return released == 1
+
+    def requeue(self, names: list = None, failed: bool = False) -> int:
+        """Put maps (by name, or all failed ones) back in the queue, with a clean slate."""
+
+        query = "UPDATE jobs SET status = 'queued', worker = NULL, lease_expires = NULL, attempts = 0"
+        if names:
+            where, params = f" WHERE name IN ({', '.join('?' * len(names))})", names
+        elif failed:
+            where, params = " WHERE status = 'failed'", []
+        else:
+            return 0
+
+        with self.transaction():
+            return self.db.execute(query + where, params).rowcount
+
+    def count(self, status: str) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+        ).fetchone()[0]
+
+    def status(self) -> dict:
+        """Jobs per status, and the throughput of every worker and stage."""
+
+        now = time.time()
+
+        jobs = {
+            row["status"]: row["n"]
+            for row in self.db.execute(
+                "SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"
+            )
+        }
+        jobs["expired"] = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'leased' AND lease_expires < ?",
+            (now,),
+        ).fetchone()[0]
+
+        workers = [
+            dict(row)
+            for row in self.db.execute(
+                "SELECT w.worker, w.heartbeat,"
+                " (SELECT name FROM jobs j WHERE j.worker = w.worker"
+                "  AND j.status = 'leased') AS current,"
+                " COUNT(CASE WHEN a.outcome = 'done' THEN 1 END) AS done,"
+                " COUNT(CASE WHEN a.outcome IN ('failed', 'lost') THEN 1 END) AS failed,"
+                " MIN(a.started) AS first_started, MAX(a.finished) AS last_finished"
+                " FROM workers w LEFT JOIN attempts a ON a.worker = w.worker"
+                " GROUP BY w.worker ORDER BY w.worker"
+            )
+        ]
+        for w in workers:
+            # Maps per hour over the time the worker has been working
+            busy = (w["last_finished"] or now) - (w["first_started"] or now)
+            w["per_hour"] = w["done"] / busy * 3600 if busy > 0 else 0.0
+            w["heartbeat_age"] = now - w["heartbeat"]
+
+        stages = [
+            dict(row)
+            for row in self.db.execute(
+                "SELECT worker, stage, COUNT(*) AS runs,"
+                " COUNT(CASE WHEN status = 'failed' THEN 1 END) AS failed,"
+                " AVG(seconds) AS mean_seconds"
+                " FROM stage_runs WHERE status IN ('ran', 'failed')"
+                " GROUP BY worker, stage ORDER BY worker, stage"
+            )
+        ]
+
+        return {"jobs": jobs, "workers": workers, "stages": stages}
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on an exception."""
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def keep_lease(
+    queue: WorkQueue, worker: str, name: str, stop: threading.Event, interval: float
+):
+    """Heartbeat thread: renew the lease on `name` until `stop` is set."""
+
+    # A connection of its own, see WorkQueue
+    queue = WorkQueue(queue.path, lease=queue.lease, max_attempts=queue.max_attempts)
+    while not stop.wait(interval):
+        if not queue.heartbeat(worker, name):
+            print(f"Lost the lease on {name}, another worker may take it over")
+            return
+
+
+def work(
+    queue: WorkQueue,
+    runner: pipeline.Pipeline,
+    stage_names: list,
+    worker: str,
+    heartbeat: float = HEARTBEAT,
+    poll: float = POLL,
+    max_workers: int = pipeline.MAX_WORKERS,
+    gpu_workers: int = pipeline.GPU_WORKERS,
+):
+    """Claim and process maps until the queue is empty and nothing is leased."""
+
+    queue.register(worker)
+
+    while True:
+        m = queue.claim(worker)
+
+        if m is None:
+            # Leases of other workers may still expire and come back
+            if queue.count("leased") == 0:
+                break
+            time.sleep(poll)
+            continue
+
+        print(f"{worker} claimed {m['name']}")
+
+        stop = threading.Event()
+        heartbeat_thread = threading.Thread(
+            target=keep_lease,
+            args=(queue, worker, m["name"], stop, heartbeat),
+            daemon=True,
+        )
+        heartbeat_thread.start()
+
+        try:
+            status = runner.run(
+                [m],
+                stage_names,
+                max_workers=max_workers,
+                gpu_workers=gpu_workers,
+                on_task=lambda task_map, stage, s, seconds: queue.record_stage(
+                    task_map["name"], stage, worker, s, seconds
+                ),
+            )
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+        ok = all(s in ("ran", "cached") for s in status.values())
+        if not queue.finish(worker, m["name"], ok):
+            print(f"{m['name']} was no longer leased to {worker}, outcome not recorded")
+
+
+def print_status(status: dict):
+    jobs = status["jobs"]
+    print(
+        ", ".join(
+            f"{jobs.get(s, 0)} {s}" for s in ("queued", "leased", "done", "failed")
+        )
+        + f" ({jobs['expired']} leases expired)"
+    )
+
+    if status["workers"]:
+        print(
+            f"\n{'worker':30} {'done':>6} {'failed':>6} {'maps/h':>7} {'heartbeat':>10}  current"
+        )
+    for w in status["workers"]:
+        print(
+            f"{w['worker']:30} {w['done']:6} {w['failed']:6} {w['per_hour']:7.1f}"
+            f" {w['heartbeat_age']:9.0f}s  {w['current'] or '-'}"
+        )
+
+    if status["stages"]:
+        print(f"\n{'worker':30} {'stage':10} {'runs':>6} {'failed':>6} {'mean':>8}")
+    for s in status["stages"]:
+        print(
+            f"{s['worker']:30} {s['stage']:10} {s['runs']:6} {s['failed']:6}"
+            f" {s['mean_seconds']:7.0f}s"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--database", default=DATABASE)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = commands.add_parser("init", help="Add the maps of a selection")
+    init_parser.add_argument("--csv-file", default="data/selection.csv")
+    init_parser.add_argument("--name-column", default="file_name")
+    init_parser.add_argument("--url-column", default="iiif_info_url")
+
+    work_parser = commands.add_parser("work", help="Process maps until none are left")
+    work_parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(pipeline.STAGES_BY_NAME),
+        default=["download", "segment", "spot"],
+    )
+    work_parser.add_argument(
+        "--worker", default=f"{socket.gethostname()}-{os.getpid()}"
+    )
+    work_parser.add_argument("--lease", type=float, default=LEASE)
+    work_parser.add_argument("--heartbeat", type=float, default=HEARTBEAT)
+    work_parser.add_argument("--poll", type=float, default=POLL)
+    work_parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    pipeline.add_pipeline_arguments(work_parser)
+
+    requeue_parser = commands.add_parser("requeue", help="Queue maps again")
+    requeue_parser.add_argument("names", nargs="*", metavar="MAP")
+    requeue_parser.add_argument("--failed", action="store_true")
+
+    commands.add_parser("status", help="Jobs and throughput per worker")
+
+    args = parser.parse_args()
+
+    if args.command == "init":
+        queue = WorkQueue(args.database)
+        maps = pipeline.load_maps(args.csv_file, args.name_column, args.url_column)
+        print(f"Added {queue.add(maps)} of {len(maps)} maps")
+
+    elif args.command == "work":
+        work(
+            WorkQueue(args.database, lease=args.lease, max_attempts=args.max_attempts),
+            pipeline.make_pipeline(args),
+            args.stages,
+            args.worker,
+            heartbeat=args.heartbeat,
+            poll=args.poll,
+            max_workers=args.max_workers,
+            gpu_workers=args.gpu_workers,
+        )
+
+    elif args.command == "requeue":
+        print(
+            f"Queued {WorkQueue(args.database).requeue(args.names, args.failed)} maps"
+        )
+
+    elif args.command == "status":
+        print_status(WorkQueue(args.database).status())
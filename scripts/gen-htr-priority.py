@@ -7,20 +7,113 @@ Strategy:
 
 Output: JSON keyed by canvas index (0-based) -> { priority, link? }
 
-Usage: python3 scripts/gen-htr-priority-v2.py
+Step 2 first scores a short list of candidate canvases per TSV row, taken
+from an inverted index of character trigrams, keywords and COLLBN codes. Every
+other free canvas is then scored too, unless an upper bound of its score (the
+longest common subsequence instead of SequenceMatcher) shows it cannot beat
+the best candidate, so the result is that of the full scan. With
+--check-parity, the whole step is also run with the full scan and the
+differences are printed (data/scripts/benchmark_label_parity.py does this on
+synthetic collections).
+
+Remote manifests are cached on disk and revalidated with ETag/Last-Modified,
+so an unchanged manifest costs a 304. With --offline, only the cache is used.
+
+Usage:
+    python3 scripts/gen-htr-priority.py [MANIFEST TSV OUTPUT] [--check-parity]
+    python3 scripts/gen-htr-priority.py --batch collections.json [--offline]
+
+MANIFEST is a URL or a local file. A batch file is a JSON list of
+{"manifest": ..., "tsv": ..., "output": ...} objects, one per collection;
+relative paths in it are taken from the batch file's folder.
+
+The stages are plain functions, so the script can also be loaded with
+importlib and driven from Python (see generate_priorities).
 """
+import argparse
+import hashlib
+import heapq
 import json
 import re
 import os
+import sys
+import tempfile
+import time
+import urllib.error
 import urllib.request
+from collections import Counter
 from difflib import SequenceMatcher
 
-# Load manifest
-url = "https://surinametimemachine.github.io/iiif-suriname/manifest.json"
-with urllib.request.urlopen(url) as resp:
-    m = json.load(resp)
-
-items = m.get("items", [])
+MIN_SCORE = 0.45
+MAX_CANDIDATES = 50  # per TSV row, by trigram similarity
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DEFAULT_MANIFEST = "https://surinametimemachine.github.io/iiif-suriname/manifest.json"
+DEFAULT_TSV = os.path.join(ROOT, "Surinaams kaartmateriaal - for HTR_OCR (5).tsv")
+DEFAULT_OUTPUT = os.path.join(ROOT, "public", "suriname-htr-priority.json")
+DEFAULT_CACHE = os.path.join(ROOT, "data", ".cache", "manifests")
+
+TIMEOUT = 60  # seconds
+
+def fetch_cached(url, cache_dir=DEFAULT_CACHE, offline=False, timeout=TIMEOUT):
+    """
+    Return the body of `url`, cached in `cache_dir`. A cached copy is
+    revalidated with If-None-Match/If-Modified-Since; offline, it is returned
+    as is, and a missing one raises FileNotFoundError.
+    """
+    key = hashlib.sha1(url.encode()).hexdigest()
+    body_path = os.path.join(cache_dir, key + ".body")
+    meta_path = os.path.join(cache_dir, key + ".json")
+
+    meta = None
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    if offline:
+        if meta is None:
+            raise FileNotFoundError(f"{url} is not in the cache ({cache_dir}), run once without --offline")
+        with open(body_path, "rb") as f:
+            return f.read()
+
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as resp:
+            body = resp.read()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or meta is None:
+            raise
+        with open(body_path, "rb") as f:
+            return f.read()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Body first, then metadata, each swapped in whole, so a crash leaves no half entry
+    for path, data in [
+        (body_path, body),
+        (meta_path, json.dumps({"url": url, "etag": etag, "last_modified": last_modified,
+                                "fetched": time.time()}).encode()),
+    ]:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    return body
+
+def load_manifest(source, cache_dir=DEFAULT_CACHE, offline=False):
+    """Load a manifest from a URL (through the cache) or a local file."""
+    if re.match(r'^https?://', source):
+        return json.loads(fetch_cached(source, cache_dir, offline))
+    with open(source) as f:
+        return json.load(f)
 
 def get_label(canvas):
     label = canvas.get("label", {})
@@ -77,81 +170,110 @@ def extract_keywords(lbl, min_len=4):
             'kolonie', 'colonie', 'suriname', 'surinaame', 'riviere', 'rivier'}
     return [w.lower() for w in words if w.lower() not in stop]
 
-# Build URL -> canvas index map
-url_to_canvas = {}
-for i, c in enumerate(items):
-    for u in get_image_service_ids(c):
-        url_to_canvas[normalize_url(u)] = i
-
-# Build canvas data for matching
-canvas_data = []
-for i, c in enumerate(items):
-    lbl = get_label(c)
-    canvas_data.append({
-        "index": i,
-        "label": lbl,
-        "norm": normalize_for_compare(lbl),
-        "stripped": normalize_for_compare(strip_archive_prefix(lbl)),
-        "keywords": extract_keywords(lbl),
-    })
-
-# Load TSV
-tsv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
-                         "Surinaams kaartmateriaal - for HTR_OCR (5).tsv")
-with open(tsv_path, "r") as f:
-    lines = f.read().strip().split("\n")
-
-# Parse TSV rows
-tsv_rows = []
-for row_idx in range(1, len(lines)):
-    cols = lines[row_idx].split("\t")
-    label = cols[6] if len(cols) > 6 else ""
-    tsv_rows.append({
-        "row": row_idx,
-        "id": cols[0],
-        "handle_a": cols[2].strip() if len(cols) > 2 else "",
-        "prio": int(cols[3]) if len(cols) > 3 and cols[3].strip().isdigit() else 0,
-        "label": label,
-        "label_norm": normalize_for_compare(label),
-        "label_stripped": normalize_for_compare(strip_archive_prefix(label)),
-        "keywords": extract_keywords(label),
-        "scans": int(cols[16]) if len(cols) > 16 and cols[16].strip().isdigit() else 1,
-        "handle_b": cols[20].strip() if len(cols) > 20 else "",
-        "iiif_manifest": cols[21].strip() if len(cols) > 21 else "",
-        "iiif_info": cols[22].strip() if len(cols) > 22 else "",
-    })
-
-print(f"Manifest: {len(items)} canvases")
-print(f"TSV: {len(tsv_rows)} rows\n")
-
-# Step 1: Match by IIIF Info URL
-matched_canvases = {}  # canvas_index -> tsv_row
-matched_tsv = set()
-
-for tr in tsv_rows:
-    if tr["iiif_info"] and tr["iiif_info"] != "-":
-        norm = normalize_url(tr["iiif_info"])
-        if norm in url_to_canvas:
-            ci = url_to_canvas[norm]
-            matched_canvases[ci] = tr
-            matched_tsv.add(tr["row"])
-
-print(f"Step 1 (IIIF URL): {len(matched_tsv)} TSV rows matched")
-
-# Step 2: For remaining TSV rows, match by label
-unmatched_tsv = [tr for tr in tsv_rows if tr["row"] not in matched_tsv]
-matched_canvas_set = set(matched_canvases.keys())
-
-def compute_match_score(tr, cd):
-    """Score how well a TSV row matches a canvas."""
+def extract_codes(lbl):
+    """Archive/COLLBN numbers, normalized for comparison."""
+    codes = re.findall(r'COLLBN[\s\-]+[\w\-]+', lbl, re.IGNORECASE)
+    return [c.replace(" ", "").lower() for c in codes]
+
+def get_char_masks(lbl):
+    """Character -> bit mask of its positions in the label, for ratio_upper_bound."""
+    masks = {}
+    for i, ch in enumerate(lbl):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks
+
+def get_trigrams(*labels):
+    """Character trigrams of normalized labels, padded so short words count too."""
+    grams = set()
+    for lbl in labels:
+        if lbl:
+            padded = f" {lbl} "
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def build_url_index(items):
+    """Normalized image/service URL -> canvas index."""
+    url_to_canvas = {}
+    for i, c in enumerate(items):
+        for u in get_image_service_ids(c):
+            url_to_canvas[normalize_url(u)] = i
+    return url_to_canvas
+
+def build_canvas_data(items):
+    """Normalized labels, keywords, codes and trigrams of every canvas."""
+    canvas_data = []
+    for i, c in enumerate(items):
+        lbl = get_label(c)
+        canvas_data.append({
+            "index": i,
+            "label": lbl,
+            "norm": normalize_for_compare(lbl),
+            "stripped": normalize_for_compare(strip_archive_prefix(lbl)),
+            "keywords": extract_keywords(lbl),
+            "codes": extract_codes(lbl),
+        })
+        canvas_data[-1]["trigrams"] = get_trigrams(canvas_data[-1]["norm"], canvas_data[-1]["stripped"])
+        canvas_data[-1]["norm_masks"] = get_char_masks(canvas_data[-1]["norm"])
+        canvas_data[-1]["stripped_masks"] = get_char_masks(canvas_data[-1]["stripped"])
+    return canvas_data
+
+def load_tsv(tsv_path):
+    """Parse the rows of an HTR/OCR selection TSV (header skipped)."""
+    with open(tsv_path, "r") as f:
+        lines = f.read().strip().split("\n")
+
+    tsv_rows = []
+    for row_idx in range(1, len(lines)):
+        cols = lines[row_idx].split("\t")
+        label = cols[6] if len(cols) > 6 else ""
+        tsv_rows.append({
+            "row": row_idx,
+            "id": cols[0],
+            "handle_a": cols[2].strip() if len(cols) > 2 else "",
+            "prio": int(cols[3]) if len(cols) > 3 and cols[3].strip().isdigit() else 0,
+            "label": label,
+            "label_norm": normalize_for_compare(label),
+            "label_stripped": normalize_for_compare(strip_archive_prefix(label)),
+            "keywords": extract_keywords(label),
+            "codes": extract_codes(label),
+            "scans": int(cols[16]) if len(cols) > 16 and cols[16].strip().isdigit() else 1,
+            "handle_b": cols[20].strip() if len(cols) > 20 else "",
+            "iiif_manifest": cols[21].strip() if len(cols) > 21 else "",
+            "iiif_info": cols[22].strip() if len(cols) > 22 else "",
+        })
+        tsv_rows[-1]["trigrams"] = get_trigrams(tsv_rows[-1]["label_norm"], tsv_rows[-1]["label_stripped"])
+    return tsv_rows
+
+def match_by_url(tsv_rows, url_to_canvas):
+    """Step 1. Match TSV rows by their IIIF Info URL. Returns (matched_canvases, matched_tsv)."""
+    matched_canvases = {}  # canvas_index -> tsv_row
+    matched_tsv = set()
+
+    for tr in tsv_rows:
+        if tr["iiif_info"] and tr["iiif_info"] != "-":
+            norm = normalize_url(tr["iiif_info"])
+            if norm in url_to_canvas:
+                ci = url_to_canvas[norm]
+                matched_canvases[ci] = tr
+                matched_tsv.add(tr["row"])
+
+    return matched_canvases, matched_tsv
+
+def compute_match_score(tr, cd, ratio=None):
+    """
+    Score how well a TSV row matches a canvas. `ratio` compares two labels;
+    SequenceMatcher by default, see score_upper_bound for the other one.
+    """
+    if ratio is None:
+        ratio = lambda a, b, b_masks: SequenceMatcher(None, a, b).ratio()
     scores = []
 
     # Full normalized label similarity
-    scores.append(SequenceMatcher(None, tr["label_norm"], cd["norm"]).ratio())
+    scores.append(ratio(tr["label_norm"], cd["norm"], cd["norm_masks"]))
 
     # Stripped label similarity (without archive prefix)
     if tr["label_stripped"] and cd["stripped"]:
-        scores.append(SequenceMatcher(None, tr["label_stripped"], cd["stripped"]).ratio())
+        scores.append(ratio(tr["label_stripped"], cd["stripped"], cd["stripped_masks"]))
 
     # Substring containment
     if len(tr["label_norm"]) > 8:
@@ -171,94 +293,300 @@ def compute_match_score(tr, cd):
                 scores.append(kw_score * 0.8 + 0.1)
 
     # Archive/COLLBN number match
-    tsv_codes = re.findall(r'COLLBN[\s\-]+[\w\-]+', tr["label"], re.IGNORECASE)
-    if tsv_codes:
-        canvas_codes = re.findall(r'COLLBN[\s\-]+[\w\-]+', cd["label"], re.IGNORECASE)
-        for tc in tsv_codes:
-            for cc in canvas_codes:
-                if tc.replace(" ", "").lower() == cc.replace(" ", "").lower():
-                    scores.append(0.95)
+    for tc in tr["codes"]:
+        for cc in cd["codes"]:
+            if tc == cc:
+                scores.append(0.95)
 
     return max(scores) if scores else 0
 
-for tr in unmatched_tsv:
-    if not tr["label_norm"]:
-        continue
-
+def ratio_upper_bound(a, b, b_masks):
+    """
+    An upper bound of SequenceMatcher(None, a, b).ratio(). The matching
+    blocks of SequenceMatcher are a common subsequence of a and b, so at most
+    as long as the longest one, which is found bit-parallel (Hyyro 2004), one
+    big integer operation per character of a, with `b_masks` from
+    get_char_masks(b).
+    """
+    length = len(a) + len(b)
+    if not length:
+        return 1.0
+    if 2 * min(len(a), len(b)) < length * MIN_SCORE:
+        return 2 * min(len(a), len(b)) / length
+
+    full = (1 << len(b)) - 1
+    v = full
+    for ch in a:
+        u = v & b_masks.get(ch, 0)
+        v = ((v + u) | (v - u)) & full
+    return 2 * (len(b) - bin(v).count("1")) / length
+
+def score_upper_bound(tr, cd):
+    """compute_match_score, with the label similarities replaced by an upper bound."""
+    return compute_match_score(tr, cd, ratio_upper_bound)
+
+def build_candidate_index(canvas_data):
+    """Inverted index: trigram / keyword / COLLBN code -> canvas indices."""
+    index = {"trigrams": {}, "keywords": {}, "codes": {}}
+    for cd in canvas_data:
+        for field in index:
+            for key in set(cd[field]):
+                index[field].setdefault(key, []).append(cd["index"])
+    return index
+
+def get_candidates(index, canvas_data, tr, exclude=(), max_candidates=MAX_CANDIDATES):
+    """
+    Canvases worth scoring first for a TSV row, as a list: the ones sharing a COLLBN
+    code, plus the best ones by an estimate of their label score, the highest
+    of the trigram overlap (Dice) and the keyword score of compute_match_score.
+    Canvases in `exclude` (already matched) are left out before the cut.
+    """
+    candidates = set()
+    for code in tr["codes"]:
+        candidates.update(index["codes"].get(code, []))
+    candidates.difference_update(exclude)
+
+    shared_trigrams = Counter()
+    for gram in tr["trigrams"]:
+        shared_trigrams.update(index["trigrams"].get(gram, []))
+
+    shared_keywords = Counter()
+    keywords = set(tr["keywords"])
+    for keyword in keywords:
+        shared_keywords.update(index["keywords"].get(keyword, []))
+
+    def estimate(ci):
+        cd = canvas_data[ci]
+        dice = 2 * shared_trigrams[ci] / (len(tr["trigrams"]) + len(cd["trigrams"]))
+        common = shared_keywords[ci]
+        if not common:
+            return dice
+        jaccard = common / (len(keywords) + len(set(cd["keywords"])) - common)
+        return max(dice, jaccard * 0.8 + 0.1)
+
+    best = heapq.nlargest(
+        max_candidates, (shared_trigrams.keys() | shared_keywords.keys()) - set(exclude), key=estimate
+    )
+
+    # Best first, so a good score is found early
+    return sorted(candidates) + [ci for ci in best if ci not in candidates]
+
+def find_best_canvas(tr, canvas_data, matched_canvas_set, index=None):
+    """
+    The free canvas with the highest score for a TSV row, the first one on a
+    tie, as (score, canvas index). Without an index, every canvas is scored.
+    With one, the candidates are tried first, then the other canvases; a
+    canvas is only scored if its upper bound can still beat (or, being
+    earlier, tie) the best score so far, so the result is the same.
+    """
     best_score = 0
     best_canvas = -1
 
-    for cd in canvas_data:
-        if cd["index"] in matched_canvas_set:
+    if index is None:
+        for cd in canvas_data:
+            if cd["index"] in matched_canvas_set:
+                continue
+            score = compute_match_score(tr, cd)
+            if score > best_score:
+                best_score = score
+                best_canvas = cd["index"]
+        return best_score, best_canvas
+
+    candidates = get_candidates(index, canvas_data, tr, matched_canvas_set)
+    first = set(candidates)
+    for ci in candidates + [cd["index"] for cd in canvas_data if cd["index"] not in first]:
+        if ci in matched_canvas_set:
+            continue
+        cd = canvas_data[ci]
+        # Below MIN_SCORE, no canvas is matched anyway
+        bound = score_upper_bound(tr, cd)
+        if bound < max(best_score, MIN_SCORE) or (bound == best_score and ci > best_canvas):
             continue
         score = compute_match_score(tr, cd)
-        if score > best_score:
+        if score > best_score or (score == best_score and ci < best_canvas):
             best_score = score
-            best_canvas = cd["index"]
-
-    if best_score >= 0.45 and best_canvas >= 0:
-        matched_canvases[best_canvas] = tr
-        matched_canvas_set.add(best_canvas)
-        matched_tsv.add(tr["row"])
-
-        # For multi-scan entries, tag adjacent canvases with similar labels
-        if tr["scans"] > 1:
-            base_norm = normalize_for_compare(get_label(items[best_canvas]))[:40]
-            for offset in range(1, tr["scans"] + 5):
-                for ci2 in [best_canvas - offset, best_canvas + offset]:
-                    if 0 <= ci2 < len(items) and ci2 not in matched_canvas_set:
-                        other_norm = normalize_for_compare(get_label(items[ci2]))
-                        sim = SequenceMatcher(None, base_norm, other_norm[:40]).ratio()
-                        if sim > 0.6:
-                            matched_canvases[ci2] = tr
-                            matched_canvas_set.add(ci2)
-
-print(f"Step 2 (label): {len(matched_tsv)} TSV rows matched, {len(matched_canvases)} canvases covered")
-
-# Show some matches for verification
-print("\n--- Sample matches (first 15) ---")
-for ci in sorted(matched_canvases.keys())[:15]:
-    tr = matched_canvases[ci]
-    clabel = get_label(items[ci])[:60]
-    print(f"  canvas {ci:3d} (prio={tr['prio']}): '{clabel}' <- TSV id={tr['id']} '{tr['label'][:40]}'")
-
-# Key check
-if 7 in matched_canvases:
-    tr = matched_canvases[7]
-    print(f"\n*** Canvas 7: prio={tr['prio']} from TSV id={tr['id']} '{tr['label'][:60]}'")
-else:
-    print("\n*** Canvas 7: NOT MATCHED")
-
-# Unmatched
-still_unmatched = [tr for tr in tsv_rows if tr["row"] not in matched_tsv]
-if still_unmatched:
-    print(f"\n--- {len(still_unmatched)} unmatched TSV rows ---")
-    for tr in still_unmatched:
-        print(f"  row {tr['row']} id={tr['id']}: {tr['label'][:60]}")
-
-# Build output JSON keyed by canvas index (0-based)
-result = {}
-for ci, tr in matched_canvases.items():
-    handle = tr["handle_a"]
-    if not handle or handle == "-":
-        handle = tr["handle_b"]
-    if not handle or handle == "-":
-        handle = tr["iiif_manifest"]
-    if not handle or handle == "-":
-        handle = None
-
-    entry = {"priority": tr["prio"]}
-    if handle:
-        entry["link"] = handle
-    result[str(ci)] = entry
-
-out_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "suriname-htr-priority.json")
-with open(out_path, "w") as f:
-    json.dump(result, f, indent=2)
-
-print(f"\nWrote {len(result)} entries to {out_path}")
-
-counts = {}
-for v in result.values():
-    counts[v["priority"]] = counts.get(v["priority"], 0) + 1
-print(f"By priority: {json.dumps(dict(sorted(counts.items())))}")
+            best_canvas = ci
+
+    return best_score, best_canvas
+
+def match_by_label(unmatched_tsv, canvas_data, matched_canvases, matched_tsv, index=None):
+    """
+    Step 2. Match each TSV row to the best scoring canvas that is still free.
+    Returns updated copies of matched_canvases and matched_tsv.
+    """
+    matched_canvases = dict(matched_canvases)
+    matched_tsv = set(matched_tsv)
+    matched_canvas_set = set(matched_canvases.keys())
+
+    for tr in unmatched_tsv:
+        if not tr["label_norm"]:
+            continue
+
+        best_score, best_canvas = find_best_canvas(tr, canvas_data, matched_canvas_set, index)
+
+        if best_score >= MIN_SCORE and best_canvas >= 0:
+            matched_canvases[best_canvas] = tr
+            matched_canvas_set.add(best_canvas)
+            matched_tsv.add(tr["row"])
+
+            # For multi-scan entries, tag adjacent canvases with similar labels
+            if tr["scans"] > 1:
+                base_norm = canvas_data[best_canvas]["norm"][:40]
+                for offset in range(1, tr["scans"] + 5):
+                    for ci2 in [best_canvas - offset, best_canvas + offset]:
+                        if 0 <= ci2 < len(canvas_data) and ci2 not in matched_canvas_set:
+                            other_norm = canvas_data[ci2]["norm"]
+                            sim = SequenceMatcher(None, base_norm, other_norm[:40]).ratio()
+                            if sim > 0.6:
+                                matched_canvases[ci2] = tr
+                                matched_canvas_set.add(ci2)
+
+    return matched_canvases, matched_tsv
+
+def compare_matches(indexed_canvases, full_canvases):
+    """Canvas indices that are matched to a different TSV row (or only once) in the two results."""
+    indexed = {ci: tr["row"] for ci, tr in indexed_canvases.items()}
+    full = {ci: tr["row"] for ci, tr in full_canvases.items()}
+    return sorted(ci for ci in set(indexed) | set(full) if indexed.get(ci) != full.get(ci))
+
+def build_priorities(matched_canvases):
+    """Output JSON keyed by canvas index (0-based) -> { priority, link? }."""
+    result = {}
+    for ci, tr in sorted(matched_canvases.items()):
+        handle = tr["handle_a"]
+        if not handle or handle == "-":
+            handle = tr["handle_b"]
+        if not handle or handle == "-":
+            handle = tr["iiif_manifest"]
+        if not handle or handle == "-":
+            handle = None
+
+        entry = {"priority": tr["prio"]}
+        if handle:
+            entry["link"] = handle
+        result[str(ci)] = entry
+    return result
+
+def generate_priorities(manifest, tsv_path, output_path=None, cache_dir=DEFAULT_CACHE,
+                        offline=False, check_parity=False):
+    """
+    Run both matching steps for one manifest/TSV pair and write the priority
+    JSON to `output_path` (if given). Returns (priorities, parity_differences);
+    the differences are None unless `check_parity` is set.
+    """
+    m = manifest if isinstance(manifest, dict) else load_manifest(manifest, cache_dir, offline)
+    items = m.get("items", [])
+
+    url_to_canvas = build_url_index(items)
+    canvas_data = build_canvas_data(items)
+    tsv_rows = load_tsv(tsv_path)
+
+    print(f"Manifest: {len(items)} canvases")
+    print(f"TSV: {len(tsv_rows)} rows\n")
+
+    step1_canvases, step1_tsv = match_by_url(tsv_rows, url_to_canvas)
+    print(f"Step 1 (IIIF URL): {len(step1_tsv)} TSV rows matched")
+
+    # Step 2: For remaining TSV rows, match by label
+    unmatched_tsv = [tr for tr in tsv_rows if tr["row"] not in step1_tsv]
+    index = build_candidate_index(canvas_data)
+    matched_canvases, matched_tsv = match_by_label(
+        unmatched_tsv, canvas_data, step1_canvases, step1_tsv, index
+    )
+
+    differences = None
+    if check_parity:
+        full_canvases, _ = match_by_label(unmatched_tsv, canvas_data, step1_canvases, step1_tsv)
+        differences = compare_matches(matched_canvases, full_canvases)
+        print(f"Parity check: {len(differences)} canvases matched differently than the full scan")
+        for ci in differences:
+            indexed_tr, full_tr = matched_canvases.get(ci), full_canvases.get(ci)
+            print(f"  canvas {ci}: index -> row {indexed_tr and indexed_tr['row']}, "
+                  f"full scan -> row {full_tr and full_tr['row']}")
+
+    print(f"Step 2 (label): {len(matched_tsv)} TSV rows matched, {len(matched_canvases)} canvases covered")
+
+    # Show some matches for verification
+    print("\n--- Sample matches (first 15) ---")
+    for ci in sorted(matched_canvases.keys())[:15]:
+        tr = matched_canvases[ci]
+        clabel = canvas_data[ci]["label"][:60]
+        print(f"  canvas {ci:3d} (prio={tr['prio']}): '{clabel}' <- TSV id={tr['id']} '{tr['label'][:40]}'")
+
+    # Unmatched
+    still_unmatched = [tr for tr in tsv_rows if tr["row"] not in matched_tsv]
+    if still_unmatched:
+        print(f"\n--- {len(still_unmatched)} unmatched TSV rows ---")
+        for tr in still_unmatched:
+            print(f"  row {tr['row']} id={tr['id']}: {tr['label'][:60]}")
+
+    result = build_priorities(matched_canvases)
+
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nWrote {len(result)} entries to {output_path}")
+
+    counts = {}
+    for v in result.values():
+        counts[v["priority"]] = counts.get(v["priority"], 0) + 1
+    print(f"By priority: {json.dumps(dict(sorted(counts.items())))}")
+
+    return result, differences
+
+def load_batch(batch_path):
+    """Read a batch file: a JSON list of {manifest, tsv, output} jobs."""
+    with open(batch_path) as f:
+        jobs = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(batch_path))
+    resolve = lambda p: p if re.match(r'^https?://', p) else os.path.join(base, p)
+
+    for job in jobs:
+        missing = {"manifest", "tsv", "output"} - set(job)
+        if missing:
+            raise ValueError(f"{batch_path}: job {job} lacks {', '.join(sorted(missing))}")
+        yield {key: resolve(job[key]) for key in ("manifest", "tsv", "output")}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate HTR priority JSON from a manifest and a TSV.")
+    parser.add_argument("manifest", nargs="?", default=DEFAULT_MANIFEST, help="Manifest URL or file")
+    parser.add_argument("tsv", nargs="?", default=DEFAULT_TSV, help="HTR/OCR selection TSV")
+    parser.add_argument("output", nargs="?", default=DEFAULT_OUTPUT, help="Priority JSON to write")
+    parser.add_argument("--batch", help="JSON list of {manifest, tsv, output} jobs, run instead of the positionals")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="Folder for cached manifests")
+    parser.add_argument("--offline", action="store_true", help="Only use cached manifests, never the network")
+    parser.add_argument("--check-parity", action="store_true",
+                        help="Also match without the candidate index and fail on differences")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        jobs = list(load_batch(args.batch))
+    else:
+        jobs = [{"manifest": args.manifest, "tsv": args.tsv, "output": args.output}]
+
+    failed = []
+    for job in jobs:
+        if len(jobs) > 1:
+            print(f"\n=== {job['manifest']} ===")
+        try:
+            _, differences = generate_priorities(
+                job["manifest"], job["tsv"], job["output"],
+                cache_dir=args.cache, offline=args.offline, check_parity=args.check_parity,
+            )
+        except (OSError, ValueError) as e:
+            # One broken collection should not stop the rest of the batch
+            print(f"Failed: {e}", file=sys.stderr)
+            failed.append(job["manifest"])
+            continue
+        if differences:
+            failed.append(job["manifest"])
+
+    if failed:
+        print(f"\n{len(failed)} of {len(jobs)} collections failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())